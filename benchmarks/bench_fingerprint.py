@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+Compare request fingerprint versions: time per request, fingerprint size and
+how many URL variants each version collapses.
+
+    python benchmarks/bench_fingerprint.py --number 100000
+"""
+
+import gc
+import sys
+import time
+import random
+import argparse
+from os.path import abspath, dirname
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from scrapy import Request
+
+from workerbee.request import RequestFingerprinter
+
+
+def make_urls(number, seed=0):
+    """
+    return URLs of number distinct pages, every one in a random variant:
+    shuffled query, tracking parameters, fragment, upper case host or default port
+    """
+    rnd = random.Random(seed)
+    urls = []
+    for i in range(number):
+        params = ['id=%d' % i, 'page=%d' % (i % 50), 'sort=desc']
+        rnd.shuffle(params)
+        if rnd.random() < 0.5:
+            params.insert(rnd.randrange(len(params) + 1), 'utm_source=feed%d' % rnd.randrange(10))
+        host = rnd.choice(['www.example.com', 'WWW.Example.com', 'www.example.com:80'])
+        fragment = rnd.choice(['', '#top', '#comments'])
+        urls.append('http://%s/list/%d?%s%s' % (host, i % 1000, '&'.join(params), fragment))
+    return urls
+
+
+def make_plain_urls(number):
+    """
+    return URLs of number distinct pages without query or fragment, already canonical
+    """
+    return ['http://www.example.com/list/%d/item-%d.html' % (i % 1000, i) for i in range(number)]
+
+
+def bench(name, fingerprinter, urls, repeat=3):
+    # best of repeat runs with the garbage collector paused, collections of the Requests are noise
+    elapsed = None
+    for _ in range(repeat):
+        # new Requests for every run, the per-request cache must not hide the hashing cost
+        requests = [Request(url) for url in urls]
+        gc.collect()
+        gc.disable()
+        try:
+            start = time.perf_counter()
+            fps = [fingerprinter(request) for request in requests]
+            run = time.perf_counter() - start
+        finally:
+            gc.enable()
+        elapsed = run if elapsed is None else min(elapsed, run)
+    print('%-10s %8.2f us/request %10.0f requests/s %4d bytes %8d distinct' % (
+        name, elapsed / len(urls) * 1e6, len(urls) / elapsed, len(fps[0]), len(set(fps))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark request fingerprint versions')
+    parser.add_argument('--number', type=int, default=100000, help='requests hashed by every version')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of every version, the fastest is reported')
+    args = parser.parse_args()
+
+    urls = make_urls(args.number) + make_urls(args.number, seed=1)
+    print('%d requests of %d distinct pages, URL variants' % (len(urls), args.number))
+    bench('v1', RequestFingerprinter(version=1), urls, args.repeat)
+    bench('v2 hex', RequestFingerprinter(version=2), urls, args.repeat)
+    bench('v2 raw', RequestFingerprinter(version=2, raw=True), urls, args.repeat)
+    urls = make_plain_urls(args.number)
+    print('%d requests without query or fragment' % len(urls))
+    bench('v1', RequestFingerprinter(version=1), urls, args.repeat)
+    bench('v2 hex', RequestFingerprinter(version=2), urls, args.repeat)
+    bench('v2 raw', RequestFingerprinter(version=2, raw=True), urls, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+Memory held by items waiting in the pipelines: items carrying their Request in item['request']
+against items stamped by ItemStampMiddleware with the request fingerprint.
+
+    python benchmarks/bench_item_memory.py --number 10000
+"""
+
+import sys
+import gc
+import argparse
+import tracemalloc
+from os.path import abspath, dirname
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+import scrapy
+from scrapy import Request
+from scrapy.http import HtmlResponse
+from scrapy.settings import Settings
+
+from workerbee.items import Item
+from workerbee.spidermiddlewares import ItemStampMiddleware
+
+
+class DemoItem(Item):
+    title = scrapy.Field()
+    price = scrapy.Field()
+    fp = scrapy.Field()
+
+    def fingerprint(self):
+        return self['fp']
+
+    def make_fingerprint(self):
+        self['fp'] = '%s:%s' % (self['title'], self['price'])
+
+
+def make_response(i):
+    """
+    return a response whose request looks like one after the downloader middlewares
+    """
+    request = Request(
+        'http://www.example.com/list/%d?id=%d&page=%d&sort=desc' % (i % 1000, i, i % 50),
+        headers={
+            'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0',
+            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+            'Accept-Language': 'en', 'Accept-Encoding': 'gzip, deflate, br',
+            'Referer': 'http://www.example.com/list/%d' % (i % 1000),
+            'Cookie': 'session=%032x; theme=dark' % i,
+        },
+        meta={
+            'depth': 3, 'download_slot': 'www.example.com', 'download_latency': 0.25, 'retry_times': 0,
+            'proxy': 'http://127.0.0.1:1081', 'redirect_urls': ['http://example.com/list/%d' % (i % 1000)],
+            'category': {'id': i % 97, 'name': 'category %d' % (i % 97), 'path': ['home', 'list', str(i % 1000)]},
+        },
+        cb_kwargs={'page': i % 50},
+    )
+    return HtmlResponse(request.url, body=b'<html>%d</html>' % i, encoding='utf-8', request=request)
+
+
+def parse(response, i):
+    item = DemoItem(title='item %d' % i, price=i / 100.0)
+    item['request'] = response.request
+    item.make_fingerprint()
+    yield item
+
+
+def held_per_item(number, stamp):
+    middleware = ItemStampMiddleware(Settings()) if stamp else None
+    gc.collect()
+    tracemalloc.start()
+    baseline = tracemalloc.take_snapshot()
+    items = []
+    for i in range(number):
+        response = make_response(i)
+        output = parse(response, i)
+        if middleware is not None:
+            output = middleware.process_spider_output(response, output, None)
+        items.extend(output)
+        # the response is released once parsed, only the items stay in flight
+        del response, output
+    gc.collect()
+    held = sum(stat.size_diff for stat in tracemalloc.take_snapshot().compare_to(baseline, 'filename'))
+    tracemalloc.stop()
+    return held / number, items
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark memory of items in flight')
+    parser.add_argument('--number', type=int, default=10000, help='items in flight')
+    args = parser.parse_args()
+
+    legacy, _ = held_per_item(args.number, stamp=False)
+    stamped, items = held_per_item(args.number, stamp=True)
+    assert items[0].request_stamp() and 'request' not in items[0]
+    print('%d items in flight' % args.number)
+    print('%-14s %8.0f bytes/item' % ("item['request']", legacy))
+    print('%-14s %8.0f bytes/item' % ('stamped', stamped))
+    print('saved %.0f%%' % (100 * (1 - stamped / legacy)))
+
+
+if __name__ == '__main__':
+    main()
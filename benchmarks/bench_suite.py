@@ -0,0 +1,408 @@
+# -*- coding: utf-8 -*-
+"""
+Throughput, latency percentiles and memory of the dedupe and storage hot paths: bloom filter hashing,
+request fingerprints, BloomFilter, RFPDupeFilterAlter / BloomDupeFilter and MysqlPipeline, at several
+dataset sizes and block counts. No service is needed, Redis is fakeredis unless told otherwise and
+Mysql is SQLite behind the same pool interface.
+
+    python benchmarks/bench_suite.py --sizes 10000 100000 --blocks 1 4 --output results.json
+    python benchmarks/bench_suite.py --components bloom dupefilter --redis spawn --compare results.json
+
+Every case preloads `size` values, then times `--ops` operations one by one, batch operations are timed
+per batch of `--batch` values. Pipeline latency is the time an item spends in process_item with
+`--concurrency` items in flight, like CONCURRENT_ITEMS. Memory is the peak of Python allocations
+while a case runs again under tracemalloc, with fakeredis it includes the data held by the fake server,
+and the bytes of the case's Redis keys.
+"""
+
+import sys
+import gc
+import json
+import time
+import hashlib
+import argparse
+import platform
+import subprocess
+import tracemalloc
+from os.path import abspath, dirname
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from local import KEY_PREFIX, install_mysqldb_shim, redis_server, redis_bytes, clear, SQLitePool
+
+install_mysqldb_shim()
+
+import scrapy
+from scrapy import Request
+from scrapy.settings import Settings
+from twisted.internet import defer, task
+
+from workerbee.filter import BloomFilter, LegacyHash, DigestHash, RFPDupeFilterAlter, BloomDupeFilter
+from workerbee.items import Item
+from workerbee.pipelines import MysqlPipeline
+from workerbee.request import RequestFingerprinter
+
+COMPONENTS = ('hash', 'fingerprint', 'bloom', 'dupefilter', 'pipeline')
+FALSE_POSITIVE_RATE = 0.001
+
+
+class BenchItem(Item):
+    id = scrapy.Field()
+    title = scrapy.Field()
+    price = scrapy.Field()
+
+    def fingerprint(self):
+        return hashlib.sha1(str(self['id']).encode('utf-8')).hexdigest()
+
+    def make_fingerprint(self):
+        pass
+
+
+class BenchSpider(object):
+
+    def __init__(self, name):
+        self.name = name
+
+
+def make_values(number, start=0):
+    """
+    return hex fingerprints of number distinct values
+    """
+    return [hashlib.sha1(b'value-%d' % i).hexdigest() for i in range(start, start + number)]
+
+
+def make_requests(number, start=0):
+    return [Request('http://www.example.com/list/%d?id=%d&page=%d&utm_source=feed' % (i % 1000, i, i % 50))
+            for i in range(start, start + number)]
+
+
+def mixed(known, new):
+    """
+    return known and new values interleaved, half of the lookups hit
+    """
+    result = []
+    for pair in zip(known, new):
+        result.extend(pair)
+    return result
+
+
+def timed(func, args):
+    """
+    Call func once per argument
+    :return: latencies in seconds, elapsed seconds
+    """
+    clock = time.perf_counter
+    latencies = []
+    start = clock()
+    for arg in args:
+        begin = clock()
+        func(arg)
+        latencies.append(clock() - begin)
+    return latencies, clock() - start
+
+
+def batches(values, size):
+    return [values[i:i + size] for i in range(0, len(values), size)]
+
+
+def preload(bloomfilter, values):
+    """
+    Insert values the way bloom rebuild does, bits are set locally and the blocks written at once
+    """
+    bitmaps = bloomfilter.bitmaps()
+    bloomfilter.set_local(bitmaps, values)
+    bloomfilter.write_local(bitmaps, chunk_size=1 << 16)
+
+
+class Suite(object):
+    """
+    Runs the cases of the selected components and collects one result per case
+    """
+
+    def __init__(self, server, args):
+        self.server = server
+        self.args = args
+        self.results = []
+        self.runs = 0
+
+    def key(self):
+        """
+        return a fresh key prefix, every run of a case writes its own keys
+        """
+        self.runs += 1
+        return '%s%d' % (KEY_PREFIX, self.runs)
+
+    async def run(self, component, case, size, blocks, func, ops):
+        """
+        Time a case, then run it again under tracemalloc for its memory
+        :param func: callable taking a key prefix and returning (latencies, elapsed, keys) or a Deferred of it
+        :param ops: operations done by one run
+        """
+        key = self.key()
+        latencies, elapsed, keys = await defer.maybeDeferred(func, key)
+        stored = redis_bytes(self.server, keys)
+        self._clear(key)
+        peak = None
+        if self.args.memory:
+            gc.collect()
+            tracemalloc.start()
+            key = self.key()
+            await defer.maybeDeferred(func, key)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            self._clear(key)
+        result = dict(
+            component=component, case=case, size=size, blocks=blocks, ops=ops,
+            ops_per_second=ops / elapsed if elapsed else 0.0, memory_peak=peak, redis_bytes=stored,
+            **latency_summary(latencies)
+        )
+        self.results.append(result)
+        print_result(result)
+
+    def _clear(self, key):
+        keys = list(self.server.scan_iter(key + '*', count=1000))
+        for i in range(0, len(keys), 1000):
+            self.server.delete(*keys[i:i + 1000])
+
+    async def hash(self, size):
+        values = make_values(size)
+        for name, engine in (('legacy', LegacyHash(1 << 31)), ('digest', DigestHash(1 << 31))):
+            await self.run('hash', name + '/offsets', size, None,
+                           lambda key: timed(engine.offsets, values) + ([],), size)
+            await self.run('hash', name + '/offsets_many', size, None,
+                           lambda key: timed(engine.offsets_many, batches(values, self.args.batch)) + ([],), size)
+
+    async def fingerprint(self, size):
+        for version in (1, 2):
+            fingerprinter = RequestFingerprinter(version=version)
+            # new requests for every run, the per-request cache must not hide the hashing cost
+            await self.run('fingerprint', 'v%d' % version, size, None,
+                           lambda key: timed(fingerprinter, make_requests(size)) + ([],), size)
+
+    def _bloomfilter(self, key, size, blocks):
+        return BloomFilter.for_capacity(self.server, size + 2 * self.args.ops, FALSE_POSITIVE_RATE,
+                                        blocknum=blocks, key=key + ':bloom')
+
+    async def bloom(self, size, blocks):
+        ops, batch = self.args.ops, self.args.batch
+        known, new = make_values(size), make_values(ops, start=size)
+        lookups = mixed(known[:ops // 2], new[:ops - ops // 2])
+
+        def case(operation, args):
+            def run(key):
+                bloomfilter = self._bloomfilter(key, size, blocks)
+                preload(bloomfilter, known)
+                keys = [bloomfilter.key + str(n) for n in range(blocks)]
+                return timed(getattr(bloomfilter, operation), args) + (keys,)
+            return run
+
+        await self.run('bloom', 'isContains', size, blocks, case('isContains', lookups), ops)
+        await self.run('bloom', 'insert', size, blocks, case('insert', new), ops)
+        await self.run('bloom', 'check_many', size, blocks, case('check_many', batches(lookups, batch)), ops)
+        await self.run('bloom', 'check_and_insert', size, blocks, case('check_and_insert', batches(new, batch)), ops)
+
+    async def dupefilter(self, size, blocks):
+        ops, batch = self.args.ops, self.args.batch
+        fingerprinter = RequestFingerprinter()
+        known = [fingerprinter(request) for request in make_requests(size)]
+
+        def lookups():
+            # new requests for every run, the fingerprint is part of the cost
+            return mixed(make_requests(ops // 2), make_requests(ops - ops // 2, start=size))
+
+        def set_case(operation, batched):
+            def run(key):
+                df = RFPDupeFilterAlter(self.server, key + ':dupefilter', fingerprinter=fingerprinter)
+                for chunk in batches(known, 1000):
+                    self.server.sadd(df.key, *chunk)
+                requests = lookups()
+                return timed(getattr(df, operation), batches(requests, batch) if batched else requests) + ([df.key],)
+            return run
+
+        def bloom_case(operation, batched):
+            def run(key):
+                bloomfilter = self._bloomfilter(key, size, blocks)
+                df = BloomDupeFilter(self.server, key + ':dupefilter', fingerprinter=fingerprinter,
+                                     bloomfilter=bloomfilter)
+                preload(bloomfilter, known)
+                requests = lookups()
+                keys = [bloomfilter.key + str(n) for n in range(blocks)]
+                return timed(getattr(df, operation), batches(requests, batch) if batched else requests) + (keys,)
+            return run
+
+        if blocks == self.args.blocks[0]:
+            # the SET dupefilter has no blocks
+            await self.run('dupefilter', 'set/request_seen', size, None, set_case('request_seen', False), ops)
+            await self.run('dupefilter', 'set/requests_seen', size, None, set_case('requests_seen', True), ops)
+        await self.run('dupefilter', 'bloom/request_seen', size, blocks, bloom_case('request_seen', False), ops)
+        await self.run('dupefilter', 'bloom/requests_seen', size, blocks, bloom_case('requests_seen', True), ops)
+
+    async def pipeline(self, size, blocks):
+        ops = self.args.ops
+        # one item in ten is already stored
+        duplicates = min(size, ops // 10)
+        ids = list(range(size - duplicates, size)) + list(range(size, size + ops - duplicates))
+
+        def case(batch_size):
+            @defer.inlineCallbacks
+            def run(key):
+                pool = SQLitePool()
+                pool.execute('CREATE TABLE bench (id INTEGER PRIMARY KEY, title TEXT, price REAL)')
+                pool.db.executemany('INSERT INTO bench VALUES (?, ?, ?)',
+                                    ((i, 'item %d' % i, i / 100.0) for i in range(size)))
+                bloomfilter = self._bloomfilter(key, size, blocks)
+                preload(bloomfilter, [BenchItem(id=i).fingerprint() for i in range(size)])
+                pipeline = MysqlPipeline(self.server, pool, 'bench', False, bloomfilter, batch_size=batch_size,
+                                         flush_interval=0.05, settings=Settings())
+                spider = BenchSpider(key)
+                pipeline.open_spider(spider)
+                items = []
+                for i in ids:
+                    item = BenchItem(id=i, title='item %d' % i, price=i / 100.0)
+                    item.stamp(hashlib.sha1(b'request-%d' % i).hexdigest())
+                    items.append(item)
+
+                # at most CONCURRENT_ITEMS items in the pipeline, like Scrapy
+                semaphore = defer.DeferredSemaphore(self.args.concurrency)
+                latencies = []
+
+                def process(item):
+                    begin = time.perf_counter()
+                    d = pipeline.process_item(item, spider)
+                    d.addErrback(lambda failure: None)
+                    d.addBoth(lambda _: latencies.append(time.perf_counter() - begin))
+                    return d
+
+                start = time.perf_counter()
+                yield defer.DeferredList([semaphore.run(process, item) for item in items])
+                yield pipeline.close_spider(spider)
+                elapsed = time.perf_counter() - start
+                keys = [bloomfilter.key + str(n) for n in range(blocks)] + [key + ':dupefilter']
+                return latencies, elapsed, keys
+            return run
+
+        for batch_size in self.args.pipeline_batches:
+            await self.run('pipeline', 'batch_size=%d' % batch_size, size, blocks, case(batch_size), ops)
+
+    async def __call__(self):
+        for size in self.args.sizes:
+            if 'hash' in self.args.components:
+                await self.hash(size)
+            if 'fingerprint' in self.args.components:
+                await self.fingerprint(size)
+            for blocks in self.args.blocks:
+                for component in ('bloom', 'dupefilter', 'pipeline'):
+                    if component in self.args.components:
+                        await getattr(self, component)(size, blocks)
+
+
+def latency_summary(latencies):
+    """
+    return p50, p90, p99 and max latency in microseconds
+    """
+    latencies = sorted(latencies)
+    if not latencies:
+        return dict(p50_us=None, p90_us=None, p99_us=None, max_us=None)
+
+    def at(p):
+        return round(latencies[min(len(latencies) - 1, len(latencies) * p // 100)] * 1e6, 2)
+
+    return dict(p50_us=at(50), p90_us=at(90), p99_us=at(99), max_us=round(latencies[-1] * 1e6, 2))
+
+
+HEADER = '%-10s %-22s %8s %6s %7s %12s %10s %10s %10s %10s %11s %11s' % (
+    'component', 'case', 'size', 'blocks', 'ops', 'ops/s', 'p50 us', 'p90 us', 'p99 us', 'max us',
+    'peak KiB', 'redis KiB')
+
+
+def kib(value):
+    return '-' if value is None else '%.0f' % (value / 1024.0)
+
+
+def print_result(result):
+    print('%-10s %-22s %8d %6s %7d %12.0f %10s %10s %10s %10s %11s %11s' % (
+        result['component'], result['case'], result['size'], result['blocks'] or '-', result['ops'],
+        result['ops_per_second'], result['p50_us'], result['p90_us'], result['p99_us'], result['max_us'],
+        kib(result['memory_peak']), kib(result['redis_bytes'])))
+
+
+def compare(results, path):
+    """
+    Print the change of throughput and p99 latency against the results of an earlier run
+    """
+    with open(path) as f:
+        previous = dict(((r['component'], r['case'], r['size'], r['blocks']), r) for r in json.load(f)['results'])
+    print('\nCompared to %s' % path)
+    print('%-10s %-22s %8s %6s %12s %10s' % ('component', 'case', 'size', 'blocks', 'ops/s', 'p99'))
+    for result in results:
+        old = previous.get((result['component'], result['case'], result['size'], result['blocks']))
+        if old is None or not old['ops_per_second'] or not old['p99_us']:
+            continue
+        print('%-10s %-22s %8d %6s %+11.1f%% %+9.1f%%' % (
+            result['component'], result['case'], result['size'], result['blocks'] or '-',
+            (result['ops_per_second'] / old['ops_per_second'] - 1) * 100,
+            (result['p99_us'] / old['p99_us'] - 1) * 100))
+
+
+def environment(description):
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=dirname(abspath(__file__)),
+                                         stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        commit = None
+    try:
+        import numpy
+        numpy_version = numpy.__version__
+    except ImportError:
+        numpy_version = None
+    return {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'commit': commit, 'python': platform.python_version(),
+        'implementation': platform.python_implementation(), 'platform': platform.platform(),
+        'numpy': numpy_version, 'redis': description,
+    }
+
+
+async def main(args):
+    server, description = redis_server(args.redis)
+    meta = environment(description)
+    print('WorkerBee benchmarks, %s, Python %s, numpy %s, commit %s' % (
+        meta['redis'], meta['python'], meta['numpy'], meta['commit']))
+    print(HEADER)
+    suite = Suite(server, args)
+    try:
+        await suite()
+    finally:
+        clear(server)
+    if args.output:
+        meta['args'] = dict((name, value) for name, value in vars(args).items() if name not in ('output', 'compare'))
+        with open(args.output, 'w') as f:
+            json.dump({'meta': meta, 'results': suite.results}, f, indent=2)
+        print('\nResults saved to %s' % args.output)
+    if args.compare:
+        compare(suite.results, args.compare)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark the dedupe and storage hot paths of WorkerBee')
+    parser.add_argument('--components', nargs='+', choices=COMPONENTS, default=list(COMPONENTS))
+    parser.add_argument('--sizes', nargs='+', type=int, default=[10000, 100000],
+                        help='values preloaded before timing, hashed values for hash and fingerprint')
+    parser.add_argument('--blocks', nargs='+', type=int, default=[1, 4], help='bloom filter block counts')
+    parser.add_argument('--ops', type=int, default=2000, help='operations timed by every case')
+    parser.add_argument('--batch', type=int, default=100, help='values of one batch operation')
+    parser.add_argument('--pipeline-batches', nargs='+', type=int, default=[1, 100],
+                        help='MYSQL_BATCH_SIZE values of the pipeline cases')
+    parser.add_argument('--concurrency', type=int, default=100, help='items in the pipeline at once')
+    parser.add_argument('--redis', default='fake',
+                        help="'fake' for fakeredis, 'spawn' to start a redis-server, "
+                             "or a Redis URL, only keys under %s are touched" % KEY_PREFIX)
+    parser.add_argument('--no-memory', dest='memory', action='store_false',
+                        help='skip the tracemalloc run of every case')
+    parser.add_argument('--output', help='save the results to this JSON file')
+    parser.add_argument('--compare', help='JSON file of an earlier run to compare with')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    arguments = parse_args()
+    task.react(lambda reactor: defer.ensureDeferred(main(arguments)))
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""
+Local stand-ins of the services WorkerBee talks to, so benchmarks run without Redis or Mysql:
+a Redis client (fakeredis, a spawned redis-server or a given URL) and a SQLite connection pool
+speaking the Mysql dialect MysqlPipeline generates.
+"""
+
+import sys
+import time
+import types
+import atexit
+import shutil
+import socket
+import sqlite3
+import subprocess
+
+from twisted.internet import reactor, threads
+from twisted.python.threadpool import ThreadPool
+
+# keys written to a Redis given by URL, deleted before and after the run
+KEY_PREFIX = 'workerbee-bench:'
+
+
+def install_mysqldb_shim():
+    """
+    Make `import MySQLdb` work without mysqlclient, the shim only carries what WorkerBee imports.
+    Does nothing if mysqlclient is installed.
+    :return: the MySQLdb module
+    """
+    try:
+        import MySQLdb
+        return MySQLdb
+    except ImportError:
+        pass
+    mysqldb = types.ModuleType('MySQLdb')
+    mysqldb.IntegrityError = sqlite3.IntegrityError
+    mysqldb.OperationalError = sqlite3.OperationalError
+    cursors = types.ModuleType('MySQLdb.cursors')
+    cursors.SSCursor = None
+    mysqldb.cursors = cursors
+    sys.modules['MySQLdb'] = mysqldb
+    sys.modules['MySQLdb.cursors'] = cursors
+    return mysqldb
+
+
+def redis_server(target='fake'):
+    """
+    :param target: 'fake' for fakeredis, 'spawn' to start a redis-server on a free port, or a Redis URL
+    :return: (Redis client, description)
+    """
+    import redis
+
+    if target == 'fake':
+        try:
+            import fakeredis
+        except ImportError:
+            raise SystemExit('fakeredis is not installed: pip install fakeredis, or use --redis spawn or a URL')
+        return fakeredis.FakeStrictRedis(), 'fakeredis %s' % fakeredis.__version__
+    if target == 'spawn':
+        executable = shutil.which('redis-server')
+        if executable is None:
+            raise SystemExit('redis-server not found in PATH')
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            port = s.getsockname()[1]
+        process = subprocess.Popen([executable, '--port', str(port), '--bind', '127.0.0.1', '--save', '',
+                                    '--appendonly', 'no'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        atexit.register(process.terminate)
+        server = redis.StrictRedis(port=port)
+        for _ in range(100):
+            try:
+                server.ping()
+                break
+            except redis.ConnectionError:
+                time.sleep(0.05)
+        else:
+            raise SystemExit('redis-server did not start')
+        return server, 'redis-server %s' % server.info()['redis_version']
+    server = redis.StrictRedis.from_url(target)
+    clear(server)
+    atexit.register(clear, server)
+    return server, 'redis-server %s' % server.info()['redis_version']
+
+
+def clear(server):
+    """
+    Delete every key written by the benchmarks
+    """
+    keys = list(server.scan_iter(KEY_PREFIX + '*', count=1000))
+    for i in range(0, len(keys), 1000):
+        server.delete(*keys[i:i + 1000])
+
+
+def redis_bytes(server, keys):
+    """
+    return bytes used by keys, by MEMORY USAGE when the server supports it,
+    else the length of strings and members, which is what fakeredis can tell
+    """
+    total = 0
+    for key in keys:
+        try:
+            total += server.memory_usage(key) or 0
+            continue
+        except Exception:
+            pass
+        kind = server.type(key)
+        if kind == b'string':
+            total += server.strlen(key)
+        elif kind == b'set':
+            total += sum(len(member) for member in server.sscan_iter(key, count=10000))
+    return total
+
+
+class SQLiteCursor(object):
+    """
+    Cursor running the Mysql statements of MysqlPipeline on SQLite:
+    %s placeholders, backquoted names and both forms of ON DUPLICATE KEY UPDATE
+    """
+
+    def __init__(self, cursor, integrity_error):
+        self.cursor = cursor
+        self.integrity_error = integrity_error
+
+    @staticmethod
+    def translate(sql):
+        """
+        return the SQLite statement and whether parameters of an upsert are doubled
+        """
+        sql = sql.replace('%s', '?')
+        if ' ON DUPLICATE KEY UPDATE ' not in sql:
+            return sql, False
+        insert, update = sql.split(' ON DUPLICATE KEY UPDATE ', 1)
+        return insert.replace('INSERT INTO', 'INSERT OR REPLACE INTO', 1), 'VALUES(' not in update
+
+    def execute(self, sql, values=()):
+        sql, doubled = self.translate(sql)
+        values = list(values)
+        try:
+            self.cursor.execute(sql, values[:len(values) // 2] if doubled else values)
+        except sqlite3.IntegrityError as e:
+            raise self.integrity_error(*e.args)
+
+    def executemany(self, sql, rows):
+        sql, _ = self.translate(sql)
+        # a failed statement changes nothing, like a multi-row INSERT on Mysql
+        self.cursor.execute('SAVEPOINT statement')
+        try:
+            self.cursor.executemany(sql, rows)
+        except sqlite3.IntegrityError as e:
+            self.cursor.execute('ROLLBACK TO statement')
+            self.cursor.execute('RELEASE statement')
+            raise self.integrity_error(*e.args)
+        self.cursor.execute('RELEASE statement')
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+class SQLitePool(object):
+    """
+    Stand-in of adbapi.ConnectionPool on one SQLite connection, interactions run in a worker thread
+    and are committed or rolled back like adbapi transactions
+    """
+
+    def __init__(self, path=':memory:'):
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.integrity_error = install_mysqldb_shim().IntegrityError
+        self.threadpool = ThreadPool(1, 1, name='sqlite')
+        self.threadpool.start()
+
+    def execute(self, sql, *args):
+        """
+        Run a statement at once, to create and fill tables before a benchmark
+        """
+        return self.db.execute(sql, *args)
+
+    def _run(self, interaction, *args, **kwargs):
+        cursor = SQLiteCursor(self.db.cursor(), self.integrity_error)
+        self.db.execute('BEGIN')
+        try:
+            result = interaction(cursor, *args, **kwargs)
+        except BaseException:
+            self.db.execute('ROLLBACK')
+            raise
+        self.db.execute('COMMIT')
+        return result
+
+    def runInteraction(self, interaction, *args, **kwargs):
+        return threads.deferToThreadPool(reactor, self.threadpool, self._run, interaction, *args, **kwargs)
+
+    def close(self):
+        if self.threadpool.started:
+            self.threadpool.stop()
+        self.db.close()
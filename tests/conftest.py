@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import types
+
+
+def _mock_mysqldb():
+    """
+    Stand in for mysqlclient when it is not installed, the tests never connect to Mysql,
+    the pipelines only need the module and its exception classes
+    """
+    try:
+        import MySQLdb  # noqa: F401
+        return
+    except ImportError:
+        pass
+    mysqldb = types.ModuleType('MySQLdb')
+
+    class Error(Exception):
+        pass
+
+    mysqldb.Error = Error
+    mysqldb.IntegrityError = type('IntegrityError', (Error,), {})
+    mysqldb.OperationalError = type('OperationalError', (Error,), {})
+    cursors = types.ModuleType('MySQLdb.cursors')
+    cursors.SSCursor = object
+    mysqldb.cursors = cursors
+    sys.modules['MySQLdb'] = mysqldb
+    sys.modules['MySQLdb.cursors'] = cursors
+
+
+_mock_mysqldb()
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+import os
+from unittest import mock
+
+import fakeredis
+import pytest
+from scrapy.settings import Settings
+from twisted.internet import defer, task
+
+from workerbee import backends
+from workerbee.backends import MmapBackend, RedisBackend, ShardedRedisBackend
+from workerbee.filter import BloomFilter, bloomfilter_from_settings
+
+
+@pytest.fixture
+def backend(tmp_path):
+    backend = MmapBackend(str(tmp_path / 'blocks'), sync_interval=60)
+    yield backend
+    backend.close()
+
+
+def test_mmap_set_and_get_bits(backend):
+    assert backend.bitfield({'b0': [(0, [0, 9])]}, ['GET', 'u1']) == [[0, 0]]
+    assert backend.bitfield({'b0': [(0, [0, 9]), (1, [9, 9000000])]}, ['SET', 'u1', 1]) == [[0, 0, 1, 0]]
+    assert backend.bitfield({'b0': [(0, [0, 9, 9000000, 10])]}, ['GET', 'u1']) == [[1, 1, 1, 0]]
+    # Redis bit order, offset 0 is the high bit of byte 0
+    assert backend.read('b0')[:2] == bytearray([0x80, 0x40])
+    # files grow in steps and stay sparse
+    assert os.path.getsize(backend._path('b0')) == 2 * MmapBackend.GROW_STEP
+
+    assert backend.bitfield({'b0': [(0, [9])]}, ['SET', 'u1', 0]) == [[1]]
+    assert backend.bitfield({'b0': [(0, [9])], 'missing': [(0, [9])]}, ['GET', 'u1']) == [[0], [0]]
+    assert backend.read('missing') == bytearray()
+
+
+def test_mmap_blocks_copy_to_and_from_redis(backend):
+    server = fakeredis.FakeStrictRedis()
+    values = ['%040x' % n for n in range(100)]
+    local = BloomFilter.for_capacity(server, 1000, 0.001, key='bloom', backend=backend)
+    local.check_and_insert(values)
+    remote = BloomFilter.for_capacity(server, 1000, 0.001, key='bloom')
+    local.copy_to(RedisBackend(server))
+    assert remote.check_many(values) == [True] * 100
+
+    backend.replace('bloom0', b'')
+    assert local.check_many(values) == [False] * 100
+    local.copy_from(RedisBackend(server))
+    assert local.check_many(values) == [True] * 100
+
+
+def test_mmap_flushes_quiet_periods(backend):
+    clock = task.Clock()
+
+    class LoopingCall(task.LoopingCall):
+        def __init__(self, *args, **kwargs):
+            super(LoopingCall, self).__init__(*args, **kwargs)
+            self.clock = clock
+
+    with mock.patch.object(backends.task, 'LoopingCall', LoopingCall), \
+            mock.patch.object(backends.threads, 'deferToThread', lambda f: defer.maybeDeferred(f)):
+        backend.start()
+        backend.bitfield({'b0': [(0, [1])]}, ['SET', 'u1', 1])
+        assert backend.dirty
+        with mock.patch.object(backend, '_sync', wraps=backend._sync) as sync:
+            clock.advance(60)
+            assert sync.call_count == 1 and not backend.dirty
+            # nothing written, nothing flushed
+            clock.advance(60)
+            assert sync.call_count == 1
+        backend.close()
+    assert not backend.sync_task.running
+
+
+@pytest.mark.parametrize('option', [{'BLOOM_SCALABLE': True}, {'BLOOM_TTL_DAYS': 7}])
+def test_scalable_and_generational_reject_mmap_before_creating_files(tmp_path, option):
+    directory = tmp_path / 'blocks'
+    settings = Settings(dict(option, BLOOM_BACKEND='mmap', BLOOM_MMAP_DIR=str(directory)))
+    with pytest.raises(ValueError):
+        bloomfilter_from_settings(fakeredis.FakeStrictRedis(), settings)
+    assert not directory.exists()
+
+
+def sharded(names, segment_bits=1 << 10):
+    servers = {name: fakeredis.FakeStrictRedis(server=fakeredis.FakeServer()) for name in names}
+    return ShardedRedisBackend(servers, segment_bits=segment_bits), servers
+
+
+def test_sharded_spreads_one_block_over_all_nodes():
+    backend, servers = sharded(['a', 'b', 'c'])
+    bloomfilter = BloomFilter(None, blocknum=1, key='bloom', hash_mode='digest', bit_size=1 << 16, backend=backend)
+    values = ['%040x' % (n * 7919) for n in range(300)]
+    assert bloomfilter.check_and_insert(values) == [False] * 300
+    assert bloomfilter.check_and_insert(values) == [True] * 300
+    assert all(server.keys('bloom0:*') for server in servers.values())
+    assert set(backend.segments('bloom0')) == set(range(64))
+
+    data = backend.read('bloom0')
+    assert bitmap_of(bloomfilter, values) == data
+    backend.replace('bloom0', data[:100])
+    assert backend.read('bloom0') == data[:100]
+    assert set(backend.segments('bloom0')) == {0}
+
+
+def bitmap_of(bloomfilter, values):
+    bitmaps = bloomfilter.bitmaps()
+    bloomfilter.set_local(bitmaps, values)
+    return bitmaps['bloom0'].rstrip(b'\0')
+
+
+def test_reshard_moves_segments_and_keeps_new_writes():
+    old, servers = sharded(['a', 'b'])
+    new = ShardedRedisBackend(dict(servers, c=fakeredis.FakeStrictRedis(server=fakeredis.FakeServer())),
+                              segment_bits=1 << 10)
+    before = ['%040x' % (n * 7919) for n in range(300)]
+    after = ['%040x' % (n * 104729 + 1) for n in range(50)]
+    BloomFilter(None, key='bloom', hash_mode='digest', bit_size=1 << 16, backend=old).check_and_insert(before)
+    bloomfilter = BloomFilter(None, key='bloom', hash_mode='digest', bit_size=1 << 16, backend=new)
+    # writers switched to the new node list before resharding
+    bloomfilter.check_and_insert(after)
+
+    taken_over = [segment for segment in old.segments('bloom0') if new.node('bloom0:%d' % segment) == 'c']
+    assert taken_over
+    assert new.reshard(old, ['bloom0']) == len(taken_over)
+    assert bloomfilter.check_many(before + after) == [True] * 350
+    for name, server in new.nodes.items():
+        assert all(new.node(key.decode()) == name for key in server.keys('bloom0:*'))
+    assert new.reshard(old, ['bloom0']) == 0
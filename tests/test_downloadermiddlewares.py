@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+from unittest import mock
+
+import pytest
+from scrapy import Request, Spider
+from scrapy.utils.test import get_crawler
+from twisted.internet import defer
+
+pytest.importorskip('selenium')
+
+from workerbee import downloadermiddlewares
+from workerbee.downloadermiddlewares import BrowserPool, SeleniumChromeMiddleware, chrome_driver
+
+
+class StubDriver(object):
+    """
+    WebDriver serving a fixed page for every URL
+    """
+
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.current_url = None
+        self.page_source = None
+        self.loaded = []
+        self.cdp = []
+        self.quitted = False
+
+    def get(self, url):
+        if self.fail:
+            raise RuntimeError('browser crashed')
+        self.loaded.append(url)
+        self.current_url = url
+        self.page_source = '<html><body>%s</body></html>' % url
+
+    def set_page_load_timeout(self, seconds):
+        pass
+
+    def execute_cdp_cmd(self, cmd, params):
+        self.cdp.append((cmd, params))
+
+    def quit(self):
+        self.quitted = True
+
+
+class StubFactory(object):
+
+    def __init__(self):
+        self.drivers = []
+
+    def __call__(self, *args):
+        driver = StubDriver()
+        self.drivers.append(driver)
+        return driver
+
+
+def test_pool_returns_browser_after_page():
+    factory = StubFactory()
+    pool = BrowserPool(factory, size=1, max_pages=0)
+    url, html = pool.render('http://example.com/1')
+    assert (url, html) == ('http://example.com/1', '<html><body>http://example.com/1</body></html>')
+    pool.render('http://example.com/2')
+    assert pool.started == 1
+    assert factory.drivers[0].loaded == ['http://example.com/1', 'http://example.com/2']
+
+    pool.close()
+    assert factory.drivers[0].quitted
+
+
+def test_pool_recycles_browser_after_max_pages():
+    factory = StubFactory()
+    pool = BrowserPool(factory, size=1, max_pages=2)
+    for i in range(3):
+        pool.render('http://example.com/%d' % i)
+    assert pool.started == 2
+    assert pool.recycled == 1
+    assert factory.drivers[0].quitted and not factory.drivers[1].quitted
+
+
+def test_pool_replaces_crashed_browser():
+    factory = StubFactory()
+    pool = BrowserPool(factory, size=1, max_pages=0)
+    pool.render('http://example.com/1')
+    factory.drivers[0].fail = True
+    with pytest.raises(RuntimeError):
+        pool.render('http://example.com/2')
+    assert pool.crashed == 1
+    assert factory.drivers[0].quitted
+
+    pool.render('http://example.com/3')
+    assert pool.started == 2
+    assert factory.drivers[1].loaded == ['http://example.com/3']
+
+
+def test_chrome_driver_blocks_stylesheets():
+    with mock.patch.object(downloadermiddlewares.webdriver, 'Chrome', lambda options: StubDriver()):
+        browser = chrome_driver(get_crawler(Spider).settings)
+    assert browser.cdp[0] == ('Network.enable', {})
+    assert browser.cdp[1][0] == 'Network.setBlockedURLs'
+    assert '*.css' in browser.cdp[1][1]['urls']
+
+
+@pytest.fixture
+def middleware(tmp_path):
+    crawler = get_crawler(Spider, {'SELENIUM_DRIVER_FACTORY': StubFactory(), 'RENDER_CACHE_DIR': str(tmp_path)})
+    mw = SeleniumChromeMiddleware.from_crawler(crawler)
+    # settings hold a copy of the factory, keep the one the tests look at
+    mw.pool.factory = StubFactory()
+    # run the thread jobs at once, the tests do not start the reactor
+    with mock.patch.object(downloadermiddlewares.threads, 'deferToThread',
+                           lambda f, *args: defer.maybeDeferred(f, *args)), \
+            mock.patch.object(downloadermiddlewares.threads, 'deferToThreadPool',
+                              lambda reactor, pool, f, *args: defer.maybeDeferred(f, *args)):
+        yield mw
+    mw.spider_closed(None)
+
+
+def fetch(mw, request):
+    results = []
+    defer.ensureDeferred(mw.process_request(request, None)).addCallback(results.append)
+    return results[0]
+
+
+def test_render_cache_hit_needs_no_browser(middleware):
+    request = Request('http://example.com/page', meta={'render': True})
+    middleware.cache.set(middleware.request_fingerprint(request), request.url, '<html>cached</html>')
+
+    response = fetch(middleware, request)
+    assert response.flags == ['cached']
+    assert response.text == '<html>cached</html>'
+    assert middleware.pool.factory.drivers == []
+    assert middleware.cache.hits == 1
+
+
+def test_render_cache_miss_renders_and_stores(middleware):
+    request = Request('http://example.com/page', meta={'render': True})
+    response = fetch(middleware, request)
+    assert response.flags == []
+    assert middleware.pool.started == 1
+
+    response = fetch(middleware, Request('http://example.com/page', meta={'render': True}))
+    assert response.flags == ['cached']
+    assert middleware.pool.started == 1
+    assert middleware.pool.factory.drivers[0].loaded == ['http://example.com/page']
@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+
+from scrapy import Spider
+from scrapy.utils.test import get_crawler
+
+from workerbee.extensions import Monitor
+
+
+def test_feedback_reports_unchanged_items_apart():
+    crawler = get_crawler(Spider, {'MONITOR_FEEDBACK': False})
+    monitor = Monitor.from_crawler(crawler)
+    crawler.stats.set_value('item_dropped_count', 10)
+    crawler.stats.set_value('item_unchanged_count', 4)
+    data = monitor._feedback_data(False, '')
+    # unchanged items are dropped items too, itemDropped keeps counting them
+    assert data['itemDropped'] == 10
+    assert data['itemUnchanged'] == 4
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import random
+from unittest import mock
+
+import fakeredis
+import pytest
+
+from workerbee import filter as bloom
+from workerbee.filter import GenerationalBloomFilter, LegacyHash, ScalableBloomFilter, SimpleHash
+
+# offsets of the original SimpleHash for seeds 5, 7, 11, 13, 31, 37, 61, Redis bitmaps hold these bits
+LEGACY_OFFSETS = {
+    1 << 31: {
+        'b6589fc6ab0dc82cf12099d1c2d40ab994e8410c':
+            [1239667495, 287733283, 496087347, 830716743, 1301989987, 1922125479, 382139015],
+        '356a192b7913b04c54574d18c28d46e6395428ab':
+            [1129430680, 1700935018, 327054830, 1122031328, 760867970, 776725432, 582971024],
+        'da4b9237bacccdf19c0760cab7aec4a8359010b0':
+            [1015939764, 1196683584, 352851592, 580774436, 890850416, 2135260788, 1768340420],
+        'http://example.com/ü':
+            [776987842, 657599412, 1712322752, 627787386, 577321692, 1643719842, 1859721290],
+    },
+    1 << 20: {
+        'b6589fc6ab0dc82cf12099d1c2d40ab994e8410c': [250663, 423459, 110899, 244551, 707171, 85671, 457351],
+        '356a192b7913b04c54574d18c28d46e6395428ab': [114328, 144746, 947694, 55008, 650370, 779192, 1011344],
+        'da4b9237bacccdf19c0760cab7aec4a8359010b0': [918196, 258368, 530056, 911908, 609392, 360052, 441284],
+        'http://example.com/ü': [1041602, 142260, 1046720, 738938, 604892, 601250, 596042],
+    },
+    1000: {
+        'b6589fc6ab0dc82cf12099d1c2d40ab994e8410c': [807, 547, 291, 839, 611, 679, 647],
+        '356a192b7913b04c54574d18c28d46e6395428ab': [640, 354, 486, 736, 130, 928, 640],
+        'da4b9237bacccdf19c0760cab7aec4a8359010b0': [676, 320, 640, 548, 96, 612, 964],
+        'http://example.com/ü': [194, 932, 192, 610, 708, 162, 66],
+    },
+}
+
+
+def original_hash(cap, seed, value):
+    # the SimpleHash of the first release, on unbounded integers
+    ret = 0
+    for i in range(len(value)):
+        ret += seed * ret + ord(value[i])
+    return (cap - 1) & ret
+
+
+@pytest.mark.parametrize('cap', sorted(LEGACY_OFFSETS))
+def test_legacy_hash_keeps_original_offsets(cap):
+    hasher = LegacyHash(cap)
+    values = list(LEGACY_OFFSETS[cap])
+    expected = [LEGACY_OFFSETS[cap][value] for value in values]
+    assert [hasher.offsets(value) for value in values] == expected
+    assert hasher.offsets_many(values) == expected
+    assert [[SimpleHash(cap, seed).hash(value) for seed in hasher.seeds] for value in values] == expected
+
+
+@pytest.mark.parametrize('cap', [1 << 31, 1 << 24, 1000, 12345])
+def test_legacy_hash_matches_original_algorithm(cap):
+    rnd = random.Random(cap)
+    values = [hashlib.sha1(str(rnd.random()).encode()).hexdigest() for _ in range(50)]
+    values += ['http://example.com/%d?q=中文' % i for i in range(10)] + ['a', 'ab']
+    hasher = LegacyHash(cap, hash_count=len(LegacyHash.SEEDS))
+    expected = [[original_hash(cap, seed, value) for seed in hasher.seeds] for value in values]
+    assert [hasher.offsets(value) for value in values] == expected
+    assert hasher.offsets_many(values) == expected
+
+
+def fingerprints(number, start=0):
+    return [hashlib.sha1(str(i).encode()).hexdigest() for i in range(start, start + number)]
+
+
+@pytest.fixture
+def server():
+    return fakeredis.FakeStrictRedis()
+
+
+def test_scalable_filter_grows(server):
+    bf = ScalableBloomFilter(server, 100, 0.01)
+    values = fingerprints(500)
+    exist = []
+    for i in range(0, len(values), 10):
+        exist += bf.check_and_insert(values[i:i + 10])
+    assert sum(exist) < 5
+    assert len(bf.filters) > 2
+    assert bf.check_and_insert(values) == [True] * 500
+    assert all(bf.check_many(values))
+    assert sum(bf.check_many(fingerprints(1000, 10000))) < 10
+
+
+def test_scalable_filter_skips_newest_for_older_hits(server):
+    bf = ScalableBloomFilter(server, 100, 0.01)
+    old = fingerprints(100)
+    bf.check_and_insert(old)
+    server.hset(bf.meta_key, 'filters', 2)
+    undo_log = []
+    assert bf.check_and_insert(old, undo_log) == [True] * 100
+    assert len(bf.filters) == 2
+    assert undo_log == []
+    assert not any(bf.filters[1].check_many(old))
+
+
+def test_scalable_filter_sees_filters_of_other_workers(server):
+    writer = ScalableBloomFilter(server, 100, 0.01)
+    reader = ScalableBloomFilter(server, 100, 0.01)
+    values = fingerprints(400)
+    for i in range(0, len(values), 10):
+        writer.check_and_insert(values[i:i + 10])
+    assert len(writer.filters) > 1
+    assert all(reader.check_many(values))
+    assert len(reader.filters) == len(writer.filters)
+
+
+DAY = 86400
+
+
+@pytest.fixture
+def clock():
+    # fakeredis expires keys by the same patched clock
+    with mock.patch.object(bloom.time, 'time', return_value=1000 * DAY) as now:
+        yield now
+
+
+def test_generational_insert_and_undo(server, clock):
+    bf = GenerationalBloomFilter(server, 1000, 0.001, 4 * DAY)
+    values = fingerprints(20)
+    undo_log = []
+    assert bf.check_and_insert(values[:10], undo_log) == [False] * 10
+    assert bf.check_and_insert(values[5:15], undo_log) == [True] * 5 + [False] * 5
+    # found values turned no bit on
+    assert [offsets for _, _, offsets in undo_log[10:15]] == [[]] * 5
+    assert all(offsets for _, _, offsets in undo_log[:10] + undo_log[15:])
+
+    bf.undo(undo_log[10:])
+    assert bf.check_many(values[10:15]) == [False] * 5
+    assert bf.check_many(values[:10]) == [True] * 10
+
+
+def test_generational_forgets_after_ttl(server, clock):
+    bf = GenerationalBloomFilter(server, 1000, 0.001, 4 * DAY)
+    values = fingerprints(10)
+    bf.check_and_insert(values)
+    key = bf.filters[-1].key + '0'
+    # expires one window after its generation left the live ones
+    assert server.pexpiretime(key) == (1000 + 4 + 1) * DAY * 1000
+
+    clock.return_value = 1003.9 * DAY
+    assert bf.check_many(values) == [True] * 10
+    clock.return_value = 1004 * DAY
+    assert bf.check_many(values) == [False] * 10
+    # dropped at once by the rotation
+    assert not server.exists(key)
+    assert bf.check_and_insert(values) == [False] * 10
+
+
+def test_generational_keys_expire_without_workers(server, clock):
+    bf = GenerationalBloomFilter(server, 1000, 0.001, 4 * DAY)
+    bf.check_and_insert(fingerprints(10))
+    key = bf.filters[-1].key + '0'
+    clock.return_value = 1004.9 * DAY
+    assert server.exists(key)
+    clock.return_value = 1005.01 * DAY
+    assert not server.exists(key)
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+import decimal
+import json
+
+import pytest
+import scrapy
+
+from workerbee.journal import SpillJournal, decode_value, encode_value
+
+
+class JournalItem(scrapy.Item):
+    id = scrapy.Field()
+    value = scrapy.Field()
+
+
+class OtherItem(scrapy.Item):
+    id = scrapy.Field()
+
+
+@pytest.fixture
+def journal(tmp_path):
+    journal = SpillJournal(str(tmp_path / 'demo.journal'))
+    yield journal
+    journal.close()
+
+
+def replay(journal):
+    assert journal.rotate()
+    items = journal.read(100)
+    journal.commit()
+    return items
+
+
+@pytest.mark.parametrize('value', [
+    b'\x00\xffbytes',
+    datetime.datetime(2020, 1, 2, 3, 4, 5, 678),
+    datetime.datetime(2020, 1, 2, 3, 4, tzinfo=datetime.timezone(datetime.timedelta(hours=8))),
+    datetime.date(2020, 1, 2),
+    datetime.time(3, 4, 5),
+    decimal.Decimal('1.10'),
+    {'$bytes': 'not tagged'},
+    {'$dict': [1]},
+    {'nested': [b'x', decimal.Decimal('2')]},
+    ['ü', None, 1.5, True],
+])
+def test_values_keep_their_type(value):
+    assert decode_value(json.loads(json.dumps(encode_value(value)))) == value
+
+
+def test_replay_items(journal):
+    journal.append(JournalItem(id=1, value=b'raw'))
+    journal.append(JournalItem(id=2, value=decimal.Decimal('3.14')))
+    items = replay(journal)
+    assert [type(item) for item in items] == [JournalItem, JournalItem]
+    assert [dict(item) for item in items] == [
+        {'id': 1, 'value': b'raw'}, {'id': 2, 'value': decimal.Decimal('3.14')}
+    ]
+    assert not journal.replaying
+
+
+def test_replay_skips_bad_lines(journal, tmp_path):
+    journal.append(JournalItem(id=1))
+    journal._file.write(b'garbage\n')
+    journal._file.write(b'{"class": "os.system", "item": {"command": "touch pwned"}}\n')
+    journal._file.write(json.dumps({'class': __name__ + '.JournalItem', 'item': {'id': 2}}).encode('utf-8') + b'\n')
+    journal._file.write(b'{"class": "cut short')
+    journal._file.flush()
+    assert [item['id'] for item in replay(journal)] == [1, 2]
+    assert not (tmp_path / 'pwned').exists()
+
+
+def test_explicit_allow_list(tmp_path):
+    path = str(tmp_path / 'demo.journal')
+    writer = SpillJournal(path)
+    writer.append(JournalItem(id=1))
+    writer.append(OtherItem(id=2))
+    writer.close()
+
+    reader = SpillJournal(path, allowed=[OtherItem])
+    assert [type(item) for item in replay(reader)] == [OtherItem]
+    reader.close()
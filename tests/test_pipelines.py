@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+from unittest import mock
+
+import MySQLdb
+import pytest
+import scrapy
+from scrapy.exceptions import DropItem
+from scrapy.settings import Settings
+from twisted.internet import defer
+from twisted.python.failure import Failure
+
+fakeredis = pytest.importorskip('fakeredis')
+
+from workerbee.filter import BloomFilter
+from workerbee.items import Item
+from workerbee import pipelines
+from workerbee.pipelines import AsyncMysqlPipeline, MysqlPipeline
+
+
+class DemoItem(Item):
+    id = scrapy.Field()
+    name = scrapy.Field()
+
+    def fingerprint(self):
+        return hashlib.sha1(str(self['id']).encode('utf-8')).hexdigest()
+
+    def make_fingerprint(self):
+        pass
+
+
+class Transaction(object):
+    """
+    Cursor of a table with a unique key on id, the rows are visible to every transaction at once
+    """
+
+    def __init__(self, rows=None, error=None):
+        self.statements = []
+        self.rows = rows if rows is not None else set()
+        self.error = error
+
+    def execute(self, sql, values):
+        if self.error is not None:
+            raise self.error
+        if values[0] in self.rows and 'ON DUPLICATE KEY UPDATE' not in sql:
+            raise MySQLdb.IntegrityError('Duplicate entry %s' % values[0])
+        self.rows.add(values[0])
+        self.statements.append((sql, values))
+
+    def executemany(self, sql, rows):
+        if any(row[0] in self.rows for row in rows) and 'ON DUPLICATE KEY UPDATE' not in sql:
+            raise MySQLdb.IntegrityError('Duplicate entry')
+        for row in rows:
+            self.execute(sql, row)
+
+
+class Writer(object):
+
+    def __init__(self):
+        self.fingerprints = []
+
+    def add(self, fingerprints):
+        self.fingerprints.extend(fingerprints)
+
+
+def make_pipeline(upsert):
+    server = fakeredis.FakeStrictRedis()
+    bloomfilter = BloomFilter.for_capacity(server, 1000, 0.001, key='test:bloom')
+    pipeline = MysqlPipeline(server, None, 'demo', upsert, bloomfilter)
+    pipeline.fingerprint_writer = Writer()
+    return pipeline
+
+
+@pytest.fixture(autouse=True)
+def sync_threads():
+    # run the thread jobs at once, the tests do not start the reactor
+    with mock.patch.object(pipelines.threads, 'deferToThread',
+                           lambda f, *args, **kwargs: defer.maybeDeferred(f, *args, **kwargs)):
+        yield
+
+
+@pytest.fixture
+def pipeline():
+    return make_pipeline(upsert=False)
+
+
+@pytest.fixture
+def upsert_pipeline():
+    return make_pipeline(upsert=True)
+
+
+def write(pipeline, tb, item):
+    """
+    run _process_item like an interaction and fire its result like runInteraction, return the result
+    """
+    try:
+        result = pipeline._process_item(tb, item, None)
+    except Exception:
+        result = Failure()
+    pipeline.in_flight += 1
+    result = pipeline._item_done(result, item, 'request')
+    return result.value if isinstance(result, Failure) else result
+
+
+def test_item_marked_in_filter_after_commit(pipeline):
+    tb = Transaction()
+    item = DemoItem(id=1, name='first')
+    pipeline._process_item(tb, item, None)
+    assert not pipeline.bloomfilter.isContains(item.fingerprint())
+
+    pipeline._item_done(item, item, 'request')
+    assert pipeline.bloomfilter.isContains(item.fingerprint())
+    assert pipeline.fingerprint_writer.fingerprints == ['request']
+    assert isinstance(write(pipeline, tb, DemoItem(id=1, name='again')), DropItem)
+    assert len(tb.statements) == 1
+
+
+def test_failed_write_leaves_item_unseen(pipeline):
+    item = DemoItem(id=1, name='first')
+    result = write(pipeline, Transaction(error=MySQLdb.OperationalError('gone away')), item)
+    assert isinstance(result, MySQLdb.OperationalError)
+    assert not pipeline.bloomfilter.isContains(item.fingerprint())
+    assert pipeline.fingerprint_writer.fingerprints == []
+
+    tb = Transaction()
+    assert write(pipeline, tb, item) is item
+    assert len(tb.statements) == 1
+
+
+def test_concurrent_duplicate_left_to_unique_key(pipeline):
+    rows = set()
+    first, second = DemoItem(id=1, name='first'), DemoItem(id=1, name='second')
+    # both pass the filter before either transaction committed
+    pipeline._process_item(Transaction(rows), first, None)
+    with pytest.raises(DropItem):
+        pipeline._process_item(Transaction(rows), second, None)
+    # the stored record is marked at once
+    assert pipeline.bloomfilter.isContains(second.fingerprint())
+
+
+def test_upsert_marks_written_item_in_filter(upsert_pipeline):
+    tb = Transaction()
+    item = DemoItem(id=1, name='first')
+    assert write(upsert_pipeline, tb, item) is item
+    assert upsert_pipeline.bloomfilter.isContains(item.fingerprint())
+
+    # the filter never skips an upsert
+    write(upsert_pipeline, tb, DemoItem(id=1, name='second'))
+    assert len(tb.statements) == 2
+    assert 'ON DUPLICATE KEY UPDATE' in tb.statements[1][0]
+
+
+def run_batch(pipeline, tb, items):
+    entries = [(item, item.fingerprint(), 'request %d' % n, defer.Deferred()) for n, item in enumerate(items)]
+    try:
+        result = pipeline._process_batch(tb, entries, None)
+    except Exception:
+        result = Failure()
+    pipeline.in_flight += len(entries)
+    pipeline._batch_done(result, entries, None)
+    results = []
+    for _, _, _, d in entries:
+        d.addBoth(results.append)
+    return [r.value if isinstance(r, Failure) else r for r in results]
+
+
+def test_upsert_batch_marks_written_items_in_filter(upsert_pipeline):
+    items = [DemoItem(id=i, name='item %d' % i) for i in range(5)]
+    assert run_batch(upsert_pipeline, Transaction(), items) == items
+    assert upsert_pipeline.bloomfilter.check_many([item.fingerprint() for item in items]) == [True] * 5
+
+
+def test_batch_drops_duplicates_and_marks_written_items(pipeline):
+    items = [DemoItem(id=i, name='item %d' % i) for i in range(4)]
+    result = run_batch(pipeline, Transaction(rows={1}), items + [DemoItem(id=0, name='copy')])
+    assert result[0] is items[0] and result[2:4] == items[2:4]
+    assert isinstance(result[1], DropItem) and isinstance(result[4], DropItem)
+    assert pipeline.bloomfilter.check_many([item.fingerprint() for item in items]) == [True] * 4
+
+    # a failed batch leaves its items unseen
+    others = [DemoItem(id=i, name='item %d' % i) for i in range(10, 13)]
+    result = run_batch(pipeline, Transaction(error=MySQLdb.OperationalError('gone away')), others)
+    assert all(isinstance(r, MySQLdb.OperationalError) for r in result)
+    assert pipeline.bloomfilter.check_many([item.fingerprint() for item in others]) == [False] * 3
+
+
+def test_unchanged_item_skipped_until_content_hash_expires(upsert_pipeline):
+    pipeline = upsert_pipeline
+    pipeline.skip_unchanged = True
+    pipeline.content_ttl = 10 * 86400
+    tb = Transaction()
+    item = DemoItem(id=1, name='first')
+    with mock.patch.object(pipelines.time, 'time', return_value=100 * 86400):
+        assert write(pipeline, tb, item) is item
+        assert isinstance(write(pipeline, tb, DemoItem(id=1, name='first')), pipelines.UnchangedItem)
+        assert write(pipeline, tb, DemoItem(id=1, name='second')) is not None
+        assert len(tb.statements) == 2
+        key = pipeline.content_key + ':20'
+        assert pipeline.redis_server.expiretime(key) == 110 * 86400
+
+    # found in the previous generation
+    with mock.patch.object(pipelines.time, 'time', return_value=106 * 86400):
+        assert isinstance(write(pipeline, tb, DemoItem(id=1, name='second')), pipelines.UnchangedItem)
+    # expired with its generation, the time is patched for fakeredis too
+    with mock.patch.object(pipelines.time, 'time', return_value=111 * 86400):
+        assert not pipeline.redis_server.exists(key)
+        write(pipeline, tb, DemoItem(id=1, name='second'))
+    assert len(tb.statements) == 3
+
+
+@pytest.mark.parametrize('priority', ['project', 'spider', 'cmdline'])
+def test_async_redis_settings_override_any_priority(priority):
+    redis_asyncio = pytest.importorskip('redis.asyncio')
+    settings = Settings()
+    settings.set('REDIS_PARAMS', {'socket_timeout': 3}, priority=priority)
+    redis_settings = AsyncMysqlPipeline.async_redis_settings(settings)
+    assert redis_settings.getdict('REDIS_PARAMS') == {'socket_timeout': 3, 'redis_cls': redis_asyncio.Redis}
+    assert 'redis_cls' not in settings.getdict('REDIS_PARAMS')
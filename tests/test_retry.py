@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+
+from unittest import mock
+
+import pytest
+from scrapy import Request, Spider
+from scrapy.http import Response
+from scrapy.utils.test import get_crawler
+from twisted.internet import task
+from twisted.internet.error import ConnectionRefusedError
+
+pytest.importorskip('selenium')
+
+from workerbee import downloadermiddlewares
+from workerbee.downloadermiddlewares import DomainHealth, RetryMiddleware, RetryScheduled
+
+
+def test_budget_refills_on_first_attempts():
+    health = DomainHealth(ratio=0.5, burst=2)
+    assert health.withdraw() and health.withdraw()
+    assert not health.withdraw()
+
+    # retries refill nothing
+    health.record(True, False, now=0)
+    assert not health.withdraw()
+    health.record(False, True, now=0)
+    health.record(False, True, now=0)
+    assert health.withdraw()
+    assert not health.withdraw()
+
+    # never more than burst tokens
+    for _ in range(10):
+        health.record(False, True, now=0)
+    assert health.tokens == 2
+
+
+def test_breaker_opens_and_closes():
+    health = DomainHealth(window=60, min_requests=4, threshold=0.5, cooldown=30)
+    assert not health.record(True, True, now=0)
+    assert not health.record(False, True, now=1)
+    assert not health.record(True, True, now=2)
+    assert not health.is_open(now=2)
+
+    assert health.record(False, True, now=3)
+    assert health.is_open(now=3)
+    assert health.is_open(now=32.9)
+    assert not health.is_open(now=33)
+
+    # outcomes before the breaker opened are forgotten
+    assert not health.record(True, True, now=34)
+    assert list(health.outcomes) == [(34, True)]
+
+
+def test_breaker_window_forgets_old_failures():
+    health = DomainHealth(window=10, min_requests=4, threshold=0.5)
+    for now in range(3):
+        health.record(True, True, now=now)
+    for now in range(20, 23):
+        assert not health.record(False, True, now=now)
+    assert health.failures == 0
+    assert len(health.outcomes) == 3
+
+
+@pytest.fixture
+def crawler():
+    crawler = get_crawler(Spider, {
+        'RETRY_TIMES': 3,
+        'RETRY_BACKOFF_BASE': 2,
+        'RETRY_BACKOFF_MAX': 10,
+        'RETRY_BUDGET_BURST': 1,
+        'RETRY_BREAKER_MIN_REQUESTS': 2,
+        'RETRY_BREAKER_COOLDOWN': 30,
+    })
+    crawler.spider = Spider('demo')
+    crawler.engine = mock.Mock()
+    return crawler
+
+
+@pytest.fixture
+def clock():
+    clock = task.Clock()
+    with mock.patch.object(downloadermiddlewares, 'reactor', clock), \
+            mock.patch.object(downloadermiddlewares.time, 'time', clock.seconds):
+        yield clock
+
+
+@pytest.fixture
+def middleware(crawler, clock):
+    mw = RetryMiddleware.from_crawler(crawler)
+    mw.spider_opened(crawler.spider)
+    # take the longest delay of the jitter
+    with mock.patch.object(downloadermiddlewares.random, 'uniform', lambda a, b: b):
+        yield mw
+    mw.spider_closed(crawler.spider)
+
+
+def test_backoff_doubles_up_to_max(middleware):
+    assert [middleware._backoff(retries) for retries in range(1, 6)] == [2, 4, 8, 10, 10]
+    assert middleware._backoff(1, retry_after=7) == 7
+    assert middleware._backoff(1, retry_after=100) == 10
+
+
+def test_failed_response_is_retried_later(crawler, middleware, clock):
+    request = Request('http://example.com/page')
+    with pytest.raises(RetryScheduled):
+        middleware.process_response(request, Response(request.url, status=503), crawler.spider)
+    assert request.meta['retry_scheduled']
+    assert crawler.stats.get_value('retry/scheduled') == 1
+    assert crawler.stats.get_value('retry/domain/example.com/count') == 1
+
+    clock.advance(1.9)
+    assert not crawler.engine.crawl.called
+    clock.advance(0.1)
+    retried = crawler.engine.crawl.call_args[0][0]
+    assert retried.url == request.url
+    assert retried.meta['retry_times'] == 1
+    assert not middleware.delayed
+
+
+def test_retry_after_header_sets_delay(crawler, middleware, clock):
+    request = Request('http://example.com/page')
+    response = Response(request.url, status=429, headers={'Retry-After': '5'})
+    with pytest.raises(RetryScheduled):
+        middleware.process_response(request, response, crawler.spider)
+    clock.advance(4.9)
+    assert not crawler.engine.crawl.called
+    clock.advance(0.1)
+    assert crawler.engine.crawl.called
+
+
+def test_exhausted_budget_gives_up(crawler, middleware):
+    with pytest.raises(RetryScheduled):
+        middleware.process_exception(Request('http://example.com/1'), ConnectionRefusedError(), crawler.spider)
+    request = Request('http://example.com/2')
+    assert middleware.process_exception(request, ConnectionRefusedError(), crawler.spider) is None
+    assert crawler.stats.get_value('retry/budget_exhausted') == 1
+    assert crawler.stats.get_value('retry/gave_up') == 1
+    assert crawler.stats.get_value('request_ignore_count') == 1
+    assert 'retry_scheduled' not in request.meta
+
+
+def test_open_breaker_puts_off_domain(crawler, middleware, clock):
+    for i in range(2):
+        middleware._record(Request('http://example.com/%d' % i), True)
+    assert crawler.stats.get_value('retry/breaker_opened') == 1
+
+    request = Request('http://example.com/page')
+    with pytest.raises(RetryScheduled):
+        middleware.process_request(request, crawler.spider)
+    assert crawler.stats.get_value('retry/domain/example.com/paused') == 1
+    # other domains are not held up
+    assert middleware.process_request(Request('http://example.org/page'), crawler.spider) is None
+
+    # the copy is crawled once the breaker closes
+    clock.advance(30)
+    assert not crawler.engine.crawl.called
+    clock.advance(1)
+    assert crawler.engine.crawl.call_args[0][0].url == request.url
+    assert middleware.process_request(Request('http://example.com/page'), crawler.spider) is None
+
+
+def test_ignored_request_does_not_open_breaker(crawler, middleware):
+    for i in range(4):
+        request = Request('http://example.com/%d' % i, meta={'dont_retry': True})
+        middleware.process_exception(request, downloadermiddlewares.IgnoreRequest(), crawler.spider)
+    assert not middleware.domains['example.com'].is_open()
+    assert crawler.stats.get_value('retry/breaker_opened') is None
+
+
+def test_idle_spider_waits_for_delayed_retries(crawler, middleware, clock):
+    request = Request('http://example.com/page')
+    with pytest.raises(RetryScheduled):
+        middleware.process_response(request, Response(request.url, status=503), crawler.spider)
+    with pytest.raises(downloadermiddlewares.DontCloseSpider):
+        middleware.spider_idle(crawler.spider)
+    clock.advance(2)
+    middleware.spider_idle(crawler.spider)
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+from unittest import mock
+
+import fakeredis
+import pytest
+from scrapy import Request, Spider, signals
+from scrapy.utils.test import get_crawler
+from twisted.internet import defer
+
+from workerbee import scheduler as scheduler_module
+from workerbee.scheduler import BatchScheduler
+
+
+class DemoSpider(Spider):
+    name = 'demo'
+
+
+@pytest.fixture
+def crawler():
+    crawler = get_crawler(DemoSpider, {
+        'REDIS_PARAMS': {'redis_cls': fakeredis.FakeStrictRedis},
+        'DUPEFILTER_CLASS': 'workerbee.filter.RFPDupeFilterAlter',
+        'SCHEDULER_BATCH_SIZE': 3,
+        # the queue survives close
+        'SCHEDULER_PERSIST': True,
+    })
+    crawler.spider = DemoSpider.from_crawler(crawler)
+    return crawler
+
+
+@pytest.fixture
+def scheduler(crawler):
+    scheduler = BatchScheduler.from_crawler(crawler)
+    scheduler.open(crawler.spider)
+    # check in the test thread, the tests do not start the reactor
+    with mock.patch.object(scheduler_module.threads, 'deferToThread',
+                           lambda f, *args: defer.maybeDeferred(f, *args)):
+        yield scheduler
+
+
+def test_batch_drops_seen_requests(crawler, scheduler):
+    dropped = []
+
+    def request_dropped(request, spider):
+        dropped.append(request.url)
+
+    crawler.signals.connect(request_dropped, signal=signals.request_dropped)
+    seen = Request('http://example.com/seen')
+    scheduler.df.server.sadd(scheduler.df.key, scheduler.df.fingerprinter(seen))
+
+    scheduler.enqueue_request(Request('http://example.com/1'))
+    scheduler.enqueue_request(Request('http://example.com/seen'))
+    assert len(scheduler) == 2 and len(scheduler.queue) == 0
+    # a full batch is checked at once
+    scheduler.enqueue_request(Request('http://example.com/seen', dont_filter=True))
+    assert len(scheduler.queue) == 2
+    assert dropped == ['http://example.com/seen']
+    assert crawler.stats.get_value('dupefilter/batch/count') == 1
+    assert crawler.stats.get_value('dupefilter/batch/requests') == 3
+    assert crawler.stats.get_value('scheduler/enqueued/redis') == 2
+
+    urls = sorted(scheduler.next_request().url for _ in range(2))
+    assert urls == ['http://example.com/1', 'http://example.com/seen']
+    assert scheduler.next_request() is None
+
+
+def test_close_flushes_pending_requests(scheduler):
+    scheduler.enqueue_request(Request('http://example.com/1'))
+    assert scheduler.flush_call is not None
+    results = []
+    scheduler.close('finished').addCallback(results.append)
+    assert results
+    assert scheduler.flush_call is None
+    assert len(scheduler.queue) == 1 and len(scheduler) == 1
+
+
+def test_failed_batch_is_released(scheduler):
+    with mock.patch.object(scheduler.df, 'requests_seen', side_effect=ConnectionError('redis down')):
+        for n in range(3):
+            scheduler.enqueue_request(Request('http://example.com/%d' % n))
+    assert len(scheduler) == 0
+    assert not scheduler.flushing
@@ -0,0 +1,400 @@
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import mmap
+import time
+import bisect
+import hashlib
+import logging
+import threading
+import redis
+from concurrent.futures import ThreadPoolExecutor
+from twisted.internet import task, threads
+
+logger = logging.getLogger(__name__)
+
+
+class RedisBackend(object):
+    """
+    Bloom filter blocks stored as Redis strings, bits are read and written by BITFIELD
+    """
+
+    def __init__(self, server):
+        """
+        :param server: Redis client instance
+        """
+        self.server = server
+
+    def queue(self, pipe, groups, operation):
+        """
+        Queue one BITFIELD command per block key into pipe
+        :param groups: dict of block key to list of (index, offsets)
+        :param operation: BITFIELD sub command without offset, e.g. ['GET', 'u1']
+        """
+        for key, entries in groups.items():
+            args = ['BITFIELD', key]
+            for _, offsets in entries:
+                for offset in offsets:
+                    args += operation[:2] + [offset] + operation[2:]
+            pipe.execute_command(*args)
+
+    def bitfield(self, groups, operation):
+        """
+        Run operation on the offsets of every block in one pipelined round trip
+        :param groups: dict of block key to list of (index, offsets)
+        :param operation: ['GET', 'u1'] or ['SET', 'u1', bit]
+        :return: list of bits for each block key, old bits for SET
+        """
+        pipe = self.server.pipeline(transaction=False)
+        self.queue(pipe, groups, operation)
+        return pipe.execute()
+
+    def read(self, key, chunk_size=1 << 24):
+        """
+        return the content of a block, empty if missing
+        """
+        data = bytearray()
+        size = self.server.strlen(key)
+        for start in range(0, size, chunk_size):
+            data += self.server.getrange(key, start, min(start + chunk_size, size) - 1)
+        return data
+
+    def replace(self, key, data, chunk_size=1 << 24):
+        """
+        Replace a block. The non-zero chunks are written to a temporary key by SETRANGE and renamed over the block,
+        so readers never see a half written block
+        :param data: bytes-like content
+        :param chunk_size: bytes sent by one SETRANGE
+        """
+        zero = bytes(chunk_size)
+        tmp = key + ':rebuild'
+        self.server.delete(tmp)
+        view = memoryview(data)
+        written = False
+        for start in range(0, len(data), chunk_size):
+            chunk = view[start:start + chunk_size]
+            if chunk != zero[:len(chunk)]:
+                self.server.setrange(tmp, start, chunk.tobytes())
+                written = True
+        if written:
+            self.server.rename(tmp, key)
+        else:
+            self.server.delete(key)
+
+    def close(self):
+        pass
+
+
+class ShardedRedisBackend(object):
+    """
+    Bloom filter blocks spread over several Redis nodes. Every block is cut into segments of segment_bits bits,
+    stored as '<block key>:<segment>' and placed on a consistent hash ring, so even a single block spreads over
+    all nodes and adding a node only moves the segments it takes over. Batches fan out to the nodes in parallel.
+    """
+
+    def __init__(self, nodes, replicas=160, segment_bits=1 << 24):
+        """
+        :param nodes: dict of node name to Redis client instance, names place the nodes on the ring
+        :param replicas: points of every node on the ring
+        :param segment_bits: bits of one segment, a multiple of 8, every writer must use the same
+        """
+        if segment_bits <= 0 or segment_bits % 8:
+            raise ValueError('Segment bits must be a positive multiple of 8')
+        self.nodes = nodes
+        self.segment_bits = segment_bits
+        self.ring = sorted((self._hash('%s#%d' % (name, n)), name) for name in nodes for n in range(replicas))
+        self._points = [point for point, _ in self.ring]
+        self._executor = ThreadPoolExecutor(max_workers=len(nodes)) if len(nodes) > 1 else None
+
+    @classmethod
+    def from_settings(cls, settings):
+        urls = settings.getlist('BLOOM_REDIS_NODES')
+        if not urls:
+            raise ValueError('BLOOM_REDIS_NODES must list the Redis nodes of the sharded backend')
+        return cls.from_urls(urls, segment_bits=settings.getint('BLOOM_SHARD_BITS', 1 << 24))
+
+    @classmethod
+    def from_urls(cls, urls, segment_bits=1 << 24):
+        """
+        :param urls: Redis URLs, e.g. redis://10.0.0.1:6379/0
+        """
+        return cls({url: redis.StrictRedis.from_url(url) for url in urls}, segment_bits=segment_bits)
+
+    @staticmethod
+    def _hash(value):
+        return int.from_bytes(hashlib.md5(value.encode('utf-8')).digest()[:8], 'big')
+
+    def node(self, key):
+        """
+        return the name of the node owning a segment key
+        """
+        index = bisect.bisect(self._points, self._hash(key)) % len(self.ring)
+        return self.ring[index][1]
+
+    def bitfield(self, groups, operation):
+        """
+        Run operation on the offsets of every block, one pipeline per node, all nodes at once
+        :param groups: dict of block key to list of (index, offsets)
+        :param operation: ['GET', 'u1'] or ['SET', 'u1', bit]
+        :return: list of bits for each block key, old bits for SET
+        """
+        # offsets of every segment, and where the bit of each block offset is found in the replies
+        segments = {}
+        places = []
+        for key, entries in groups.items():
+            place = []
+            for _, offsets in entries:
+                for offset in offsets:
+                    segment, local = divmod(offset, self.segment_bits)
+                    local_offsets = segments.setdefault('%s:%d' % (key, segment), [])
+                    place.append(('%s:%d' % (key, segment), len(local_offsets)))
+                    local_offsets.append(local)
+            places.append(place)
+        by_node = {}
+        for segment_key, local_offsets in segments.items():
+            by_node.setdefault(self.node(segment_key), {})[segment_key] = [(None, local_offsets)]
+
+        def run(name):
+            return RedisBackend(self.nodes[name]).bitfield(by_node[name], operation)
+
+        if self._executor is None or len(by_node) == 1:
+            replies = dict((name, run(name)) for name in by_node)
+        else:
+            replies = dict(zip(by_node, self._executor.map(run, list(by_node))))
+        bits = {}
+        for name, node_groups in by_node.items():
+            bits.update(zip(node_groups, replies[name]))
+        return [[bits[segment_key][n] for segment_key, n in place] for place in places]
+
+    def segments(self, key):
+        """
+        return dict of segment number to node name of the stored segments of a block, found by SCAN on every node
+        """
+        pattern = re.sub(r'([*?\[\]\\])', r'\\\1', key) + ':*'
+        found = {}
+        for name, server in self.nodes.items():
+            for segment_key in server.scan_iter(match=pattern, count=1000):
+                segment = segment_key.decode('utf-8')[len(key) + 1:]
+                # keys of other blocks and temporary keys share the pattern
+                if segment.isdigit() and self.node('%s:%s' % (key, segment)) == name:
+                    found[int(segment)] = name
+        return found
+
+    def read(self, key, chunk_size=1 << 24):
+        """
+        return the content of a block, empty if missing
+        """
+        data = bytearray()
+        segment_bytes = self.segment_bits // 8
+        for segment, name in sorted(self.segments(key).items()):
+            content = RedisBackend(self.nodes[name]).read('%s:%d' % (key, segment), chunk_size)
+            if content:
+                data += bytes(segment * segment_bytes - len(data)) + content
+        return data
+
+    def replace(self, key, data, chunk_size=1 << 24):
+        """
+        Replace a block segment by segment, every segment is renamed over the old one
+        """
+        segment_bytes = self.segment_bits // 8
+        view = memoryview(data)
+        count = (len(data) + segment_bytes - 1) // segment_bytes
+        for segment in range(count):
+            segment_key = '%s:%d' % (key, segment)
+            RedisBackend(self.nodes[self.node(segment_key)]).replace(
+                segment_key, view[segment * segment_bytes:(segment + 1) * segment_bytes], chunk_size
+            )
+        for segment, name in self.segments(key).items():
+            if segment >= count:
+                self.nodes[name].delete('%s:%d' % (key, segment))
+
+    def reshard(self, old, keys, chunk_size=1 << 24):
+        """
+        Move segments whose owner differs between an old backend and this one. A moved segment is merged into
+        the one of its new owner with BITOP OR, bits set there meanwhile by writers of the new node list are kept,
+        writers must switch to the new node list before resharding, or bits they set on the old owners are lost
+        :param old: ShardedRedisBackend of the previous node list
+        :param keys: block keys
+        :return: number of segments moved
+        """
+        if old.segment_bits != self.segment_bits:
+            raise ValueError('Resharding cannot change the segment size')
+        moved = 0
+        for key in keys:
+            for segment, source in sorted(old.segments(key).items()):
+                segment_key = '%s:%d' % (key, segment)
+                target = self.node(segment_key)
+                if target == source:
+                    continue
+                data = RedisBackend(old.nodes[source]).read(segment_key, chunk_size)
+                if data:
+                    self._merge(self.nodes[target], segment_key, data, chunk_size)
+                    moved += 1
+                old.nodes[source].delete(segment_key)
+        return moved
+
+    @staticmethod
+    def _merge(server, key, data, chunk_size):
+        """
+        OR data into a Redis string atomically
+        """
+        tmp = key + ':reshard'
+        server.delete(tmp)
+        for start in range(0, len(data), chunk_size):
+            server.setrange(tmp, start, bytes(data[start:start + chunk_size]))
+        server.bitop('OR', key, key, tmp)
+        server.delete(tmp)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+
+
+class MmapBackend(object):
+    """
+    Bloom filter blocks stored in local memory-mapped files with the bit layout of Redis strings,
+    offset 0 is the high bit of byte 0, so blocks can be copied to and from Redis as they are.
+
+    Like a Redis string, a block file grows when a bit beyond its end is set and reads as zero past it.
+    A lock makes every batch check-and-set atomic between threads of one process, the files must not be
+    shared by several processes. Dirty pages are flushed to disk by writes coming sync_interval seconds after the
+    last flush, once started every sync_interval seconds from the reactor too, and on close.
+    """
+
+    # files grow in steps of 1M to limit remapping
+    GROW_STEP = 1 << 20
+
+    def __init__(self, directory, sync_interval=60.0):
+        """
+        :param directory: directory of block files, created if missing
+        :param sync_interval: max seconds between two msync, 0 syncs after every write
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.sync_interval = sync_interval
+        self.last_sync = time.time()
+        self.dirty = False
+        self.sync_task = None
+        self._blocks = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(settings.get('BLOOM_MMAP_DIR', 'bloomfilter'),
+                   sync_interval=settings.getfloat('BLOOM_MMAP_SYNC_INTERVAL', 60.0))
+
+    def _path(self, key):
+        return os.path.join(self.directory, key.replace(':', '_') + '.bloom')
+
+    def _block(self, key, size=0):
+        """
+        return the mmap of a block holding at least size bytes, None if the block is empty
+        """
+        block = self._blocks.get(key)
+        if block is not None and len(block) >= size:
+            return block
+        path = self._path(key)
+        if not os.path.exists(path):
+            if not size:
+                return None
+            open(path, 'wb').close()
+        with open(path, 'r+b') as f:
+            current = os.fstat(f.fileno()).st_size
+            if current < size:
+                # sparse growth, unwritten pages take no disk space
+                f.truncate((size + self.GROW_STEP - 1) // self.GROW_STEP * self.GROW_STEP)
+            elif not current:
+                return None
+            if block is not None:
+                block.close()
+            block = self._blocks[key] = mmap.mmap(f.fileno(), 0)
+        return block
+
+    def bitfield(self, groups, operation):
+        """
+        Run operation on the offsets of every block, atomically for the whole batch
+        :param groups: dict of block key to list of (index, offsets)
+        :param operation: ['GET', 'u1'] or ['SET', 'u1', bit]
+        :return: list of bits for each block key, old bits for SET
+        """
+        write = operation[0] == 'SET'
+        replies = []
+        with self._lock:
+            for key, entries in groups.items():
+                offsets = [offset for _, offset_list in entries for offset in offset_list]
+                block = self._block(key, (max(offsets) >> 3) + 1 if write else 0)
+                bits = []
+                for offset in offsets:
+                    byte, mask = offset >> 3, 0x80 >> (offset & 7)
+                    old = block[byte] if block is not None and byte < len(block) else 0
+                    bits.append(1 if old & mask else 0)
+                    if write:
+                        block[byte] = old | mask if operation[2] else old & ~mask
+                replies.append(bits)
+            self.dirty = self.dirty or write
+            if write and time.time() - self.last_sync >= self.sync_interval:
+                self._sync()
+        return replies
+
+    def read(self, key, chunk_size=None):
+        """
+        return the content of a block, empty if missing
+        """
+        with self._lock:
+            block = self._block(key)
+            return bytearray(block[:]) if block is not None else bytearray()
+
+    def replace(self, key, data, chunk_size=None):
+        """
+        Replace a block by writing a temporary file and renaming it over the block file
+        """
+        path = self._path(key)
+        with self._lock:
+            block = self._blocks.pop(key, None)
+            if block is not None:
+                block.close()
+            with open(path + '.tmp', 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(path + '.tmp', path)
+
+    def start(self):
+        """
+        Flush dirty pages every sync_interval seconds from the reactor, a quiet period after writes is flushed too
+        """
+        if self.sync_interval > 0 and self.sync_task is None:
+            self.sync_task = task.LoopingCall(self._sync_in_thread)
+            self.sync_task.start(self.sync_interval, now=False)
+
+    def _sync_in_thread(self):
+        if not self.dirty:
+            return None
+        # msync of many dirty pages blocks, keep it off the reactor thread
+        d = threads.deferToThread(self.sync)
+        d.addErrback(lambda failure: logger.error('Failed to flush bloom filter blocks: %s', failure.value))
+        return d
+
+    def _sync(self):
+        for block in self._blocks.values():
+            block.flush()
+        self.last_sync = time.time()
+        self.dirty = False
+
+    def sync(self):
+        """
+        Flush dirty pages of all blocks to disk
+        """
+        with self._lock:
+            self._sync()
+
+    def close(self):
+        if self.sync_task is not None and self.sync_task.running:
+            self.sync_task.stop()
+        with self._lock:
+            self._sync()
+            for block in self._blocks.values():
+                block.close()
+            self._blocks = {}
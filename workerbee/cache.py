@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    Bounded in-process set of recently seen keys with LRU eviction.
+
+    Only positive answers are cached, a miss always falls through to Redis.
+    Thread safe, MysqlPipeline uses it from adbapi threads.
+    """
+
+    def __init__(self, maxsize):
+        """
+        :param maxsize: max number of keys kept in memory
+        """
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls, settings):
+        """
+        return a cache sized by WORKERBEE_L1_CACHE_SIZE, None if disabled
+        """
+        maxsize = settings.getint('WORKERBEE_L1_CACHE_SIZE', 0)
+        return cls(maxsize) if maxsize > 0 else None
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+
+    def add(self, key):
+        with self._lock:
+            self._data[key] = None
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def publish(self, stats, prefix):
+        """
+        Report hit/miss counters to Scrapy stats
+        :param stats: Scrapy stats collector
+        :param prefix: stats key prefix, e.g. l1cache/bloomfilter
+        """
+        stats.set_value(prefix + '/hits', self.hits)
+        stats.set_value(prefix + '/misses', self.misses)
+        stats.set_value(prefix + '/size', len(self._data))
@@ -4,7 +4,8 @@ import sys
 import argparse
 
 from workerbee.__version__ import VERSION
-from workerbee.cmd.commands import startproject, genspider
+from workerbee.cmd.commands import startproject, genspider, bloom_migrate, bloom_rebuild, \
+    bloom_snapshot, bloom_reshard, seed
 
 optional_title = 'Optional arguments'
 
@@ -72,6 +73,35 @@ parser_init.add_argument('projectname', default='WorkerBeeTemplate', nargs='?',
 parser_init = subparsers.add_parser('genspider', help='Generate new spider using pre-defined templates')
 parser_init.add_argument('spidername', default='default', nargs='?', type=str, help='spider name')
 
+parser_init = subparsers.add_parser('seed', help='Push start URLs of a spider which are not seen by its dupefilter')
+parser_init.add_argument('spidername', type=str, help='spider name')
+parser_init.add_argument('--file', type=str, help="file of URLs, one per line, default the spider's seed_urls")
+parser_init.add_argument('--chunk-size', type=int, help='URLs checked and pushed at once, default SEED_CHUNK_SIZE')
+parser_init.add_argument('--max-queue', type=int, help='pause while the queue is longer, default SEED_MAX_QUEUE')
+parser_init.add_argument('--rpush', action='store_true', help='append URLs to the tail of the queue')
+
+parser_bloom = subparsers.add_parser('bloom', help='Manage bloom filters of the project')
+bloom_subparsers = parser_bloom.add_subparsers(dest='bloom_command', title='Available commands', metavar='')
+
+parser_init = bloom_subparsers.add_parser('migrate',
+                                         help='Move the Redis SET dupefilter of a spider into BloomDupeFilter')
+parser_init.add_argument('spidername', type=str, help='spider name')
+parser_init.add_argument('--batch-size', default=10000, type=int, help='fingerprints per round trip')
+parser_init.add_argument('--delete', action='store_true', help='delete the SET after migration')
+
+parser_init = bloom_subparsers.add_parser('rebuild', help='Rebuild the bloom filter of items from the Mysql table')
+parser_init.add_argument('item', type=str,
+                         help='path of the Item class stored in the table, e.g. project.items.DemoItem')
+parser_init.add_argument('--chunk-size', default=10000, type=int, help='rows fetched at once')
+parser_init.add_argument('--local', action='store_true',
+                         help='build the bitmaps in memory and replace the Redis keys')
+
+bloom_subparsers.add_parser('snapshot', help='Copy the local bloom filter of BLOOM_BACKEND into Redis')
+bloom_subparsers.add_parser('restore', help='Replace the local bloom filter of BLOOM_BACKEND by the one in Redis')
+
+parser_init = bloom_subparsers.add_parser('reshard', help='Move bloom filter blocks after BLOOM_REDIS_NODES changed')
+parser_init.add_argument('old_nodes', nargs='+', type=str, help='Redis URLs of the previous BLOOM_REDIS_NODES')
+
 # show help info when no args
 if len(sys.argv[1:]) == 0:
     parser.print_help()
@@ -89,6 +119,16 @@ def cmd():
         startproject(args.projectname)
     elif command == 'genspider':
         genspider(args.spidername)
+    elif command == 'seed':
+        seed(args.spidername, args.file, args.chunk_size, args.max_queue, args.rpush)
+    elif command == 'bloom' and args.bloom_command == 'migrate':
+        bloom_migrate(args.spidername, args.batch_size, args.delete)
+    elif command == 'bloom' and args.bloom_command == 'rebuild':
+        bloom_rebuild(args.item, args.chunk_size, args.local)
+    elif command == 'bloom' and args.bloom_command in ('snapshot', 'restore'):
+        bloom_snapshot(args.bloom_command == 'restore')
+    elif command == 'bloom' and args.bloom_command == 'reshard':
+        bloom_reshard(args.old_nodes)
     else:
         parser.print_help()
         parser.exit()
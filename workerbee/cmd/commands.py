@@ -1,9 +1,12 @@
 # -*- coding: utf-8 -*-
 
+import sys
+import time
 from os.path import join, exists, abspath
 from os import getcwd, makedirs
 from jinja2 import Environment, PackageLoader, select_autoescape
 from scrapy.utils.project import get_project_settings
+from scrapy_redis import connection
 
 # Define template environment(place to hold templates)
 ENV = Environment(loader=PackageLoader('workerbee'), autoescape=select_autoescape(['j2']))
@@ -33,11 +36,10 @@ def startproject(projectname):
 
 
 def genspider(spidername):
-    execute_path = abspath(getcwd())
-    if not exists(join(execute_path, 'scrapy.cfg')):
-        print("\033[1;31mPlease execute the command in the path where exist scrapy.cfg\033[0m")
+    if not _in_project():
         return
 
+    execute_path = abspath(getcwd())
     spidername_c = spidername.capitalize()
     projectname = get_project_settings()['BOT_NAME']
     file_path = join(execute_path, projectname, 'spiders', spidername + '.py')
@@ -46,6 +48,123 @@ def genspider(spidername):
     print("Created spider '%s' using template in module:\n    %s.spiders.%s" % (spidername, projectname, spidername))
 
 
+def bloom_migrate(spidername, batch_size, delete):
+    if not _in_project():
+        return
+
+    from workerbee.filter import BloomDupeFilter
+
+    settings = get_project_settings()
+    start = time.time()
+    count = BloomDupeFilter.migrate(
+        connection.from_settings(settings), settings, spidername, batch_size=batch_size, delete=delete
+    )
+    print("Migrated %d request fingerprints of spider '%s' into bloom filter in %.1fs"
+          % (count, spidername, time.time() - start))
+
+
+def bloom_rebuild(item, chunk_size, local):
+    if not _in_project():
+        return
+
+    from scrapy.utils.misc import load_object
+    from workerbee.pipelines import MysqlPipeline
+
+    def progress(count, elapsed):
+        sys.stdout.write('\r%d rows, %d rows/s' % (count, count / elapsed if elapsed else 0))
+        sys.stdout.flush()
+
+    settings = get_project_settings()
+    start = time.time()
+    count = MysqlPipeline.rebuild(settings, load_object(item), chunk_size=chunk_size, local=local, progress=progress)
+    elapsed = time.time() - start
+    print("\nRebuilt bloom filter from %d rows of table '%s' in %.1fs, %d rows/s"
+          % (count, settings.get('MYSQL_TABLE'), elapsed, count / elapsed if elapsed else 0))
+
+
+def bloom_snapshot(restore):
+    if not _in_project():
+        return
+
+    from workerbee.backends import RedisBackend
+    from workerbee.filter import bloomfilter_from_settings
+
+    settings = get_project_settings()
+    redis_server = connection.from_settings(settings)
+    bloomfilter = bloomfilter_from_settings(redis_server, settings)
+    if isinstance(bloomfilter.backend, RedisBackend):
+        print("\033[1;31mBLOOM_BACKEND is redis, nothing to copy\033[0m")
+        return
+    start = time.time()
+    if restore:
+        bloomfilter.copy_from(RedisBackend(redis_server))
+    else:
+        bloomfilter.copy_to(RedisBackend(redis_server))
+    bloomfilter.close()
+    print("%s %d blocks of bloom filter '%s' in %.1fs" % (
+        'Restored' if restore else 'Saved', bloomfilter.blockNum, bloomfilter.key, time.time() - start))
+
+
+def bloom_reshard(old_nodes):
+    if not _in_project():
+        return
+
+    from workerbee.backends import ShardedRedisBackend
+    from workerbee.filter import bloomfilter_from_settings
+
+    settings = get_project_settings()
+    bloomfilter = bloomfilter_from_settings(connection.from_settings(settings), settings)
+    if not isinstance(bloomfilter.backend, ShardedRedisBackend):
+        print("\033[1;31mBLOOM_BACKEND is not sharded\033[0m")
+        return
+    start = time.time()
+    keys = [bloomfilter.key + str(n) for n in range(bloomfilter.blockNum)]
+    old = ShardedRedisBackend.from_urls(old_nodes, segment_bits=bloomfilter.backend.segment_bits)
+    moved = bloomfilter.backend.reshard(old, keys)
+    old.close()
+    bloomfilter.close()
+    print("Moved %d segments of %d blocks of bloom filter '%s' in %.1fs" % (
+        moved, len(keys), bloomfilter.key, time.time() - start))
+
+
+def seed(spidername, file, chunk_size, max_queue, rpush):
+    if not _in_project():
+        return
+
+    from scrapy.spiderloader import SpiderLoader
+    from workerbee.seed import Seeder, read_urls
+
+    settings = get_project_settings()
+    spidercls = SpiderLoader.from_settings(settings).load(spidername)
+    redis_key = (getattr(spidercls, 'redis_key', None) or '%(name)s:start_urls') % {'name': spidername}
+    if file:
+        urls = read_urls(file)
+    elif hasattr(spidercls, 'seed_urls'):
+        urls = spidercls().seed_urls()
+    else:
+        print("\033[1;31mGive a file of URLs or define seed_urls in spider '%s'\033[0m" % spidername)
+        return
+
+    server = connection.from_settings(settings)
+    seeder = Seeder.from_settings(server, settings, spidername, redis_key)
+    seeder.chunk_size = chunk_size or seeder.chunk_size
+    seeder.max_queue = max_queue if max_queue is not None else seeder.max_queue
+    if rpush and seeder.command != 'sadd':
+        seeder.command = 'rpush'
+    start = time.time()
+    pushed, skipped, invalid = seeder.seed(urls)
+    elapsed = time.time() - start
+    print("Seeded '%s': %d URLs pushed, %d already seen, %d invalid, in %.1fs, %d URLs/s"
+          % (redis_key, pushed, skipped, invalid, elapsed, (pushed + skipped + invalid) / elapsed if elapsed else 0))
+
+
+def _in_project():
+    if not exists(join(abspath(getcwd()), 'scrapy.cfg')):
+        print("\033[1;31mPlease execute the command in the path where exist scrapy.cfg\033[0m")
+        return False
+    return True
+
+
 def _make_file(file_path, content):
     """
     :param file_path: file path(include file name)
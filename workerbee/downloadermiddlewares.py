@@ -1,17 +1,108 @@
 # -*- coding: utf-8 -*-
 
+import time
+import queue
+import random
+import inspect
+import logging
+from collections import deque
+from functools import partial
 from scrapy import signals
-from scrapy.exceptions import IgnoreRequest
+from scrapy.exceptions import IgnoreRequest, DontCloseSpider
+from scrapy.http import HtmlResponse
+from scrapy.utils.misc import load_object
+from scrapy.utils.defer import maybe_deferred_to_future
+from scrapy.utils.httpobj import urlparse_cached
 from scrapy.core.downloader.handlers.http11 import TunnelError
-from twisted.internet import defer
+from twisted.internet import defer, reactor, threads
+from twisted.python.threadpool import ThreadPool
 from twisted.web.client import ResponseFailed
 from twisted.internet.error import TimeoutError, DNSLookupError, ConnectionRefusedError, ConnectionDone, ConnectError,\
     ConnectionLost, TCPTimedOutError
+from workerbee.request import RequestFingerprinter
+from workerbee.rendercache import RenderCache
 from selenium import webdriver
 from selenium.webdriver.chrome.options import Options
 
+logger = logging.getLogger(__name__)
+
+
+class RetryScheduled(IgnoreRequest):
+    """
+    The request was handed back to the reactor and a copy of it will be crawled again later.
+    The dropped request carries meta retry_scheduled=True, errbacks can tell it from a failed request.
+    """
+
+
+class DomainHealth(object):
+    """
+    Retry budget and circuit breaker of one domain.
+
+    The budget is a token bucket of burst tokens refilled by ratio for every first attempt,
+    so retries stay below about ratio of the traffic. The breaker opens for cooldown seconds when
+    at least min_requests outcomes in the last window seconds failed more often than threshold.
+    """
+
+    def __init__(self, ratio=0.2, burst=10, window=60, min_requests=20, threshold=0.5, cooldown=30):
+        self.ratio = ratio
+        self.burst = burst
+        self.window = window
+        self.min_requests = min_requests
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.tokens = float(burst)
+        self.open_until = 0
+        self.outcomes = deque()
+        self.failures = 0
+
+    def record(self, failed, first_attempt, now=None):
+        """
+        Record the outcome of a download
+        :return: True if this outcome opened the breaker
+        """
+        now = time.time() if now is None else now
+        if first_attempt:
+            self.tokens = min(self.burst, self.tokens + self.ratio)
+        self.outcomes.append((now, failed))
+        self.failures += failed
+        while self.outcomes and self.outcomes[0][0] < now - self.window:
+            self.failures -= self.outcomes.popleft()[1]
+        if self.threshold and len(self.outcomes) >= self.min_requests \
+                and self.failures >= self.threshold * len(self.outcomes) and not self.is_open(now):
+            self.open_until = now + self.cooldown
+            self.outcomes.clear()
+            self.failures = 0
+            return True
+        return False
+
+    def is_open(self, now=None):
+        return (time.time() if now is None else now) < self.open_until
+
+    def withdraw(self):
+        """
+        Take a token for one retry
+        :return: False if the budget is exhausted
+        """
+        if not self.ratio:
+            return True
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
 
 class RetryMiddleware(object):
+    """
+    Retries failed downloads after an exponential backoff with full jitter. A delayed retry waits in the
+    reactor, not in a download slot, and is crawled again when due. Every domain has its own retry budget
+    and circuit breaker, requests to a domain whose breaker is open are put off until it closes,
+    so failing domains do not drag down healthy ones.
+
+    A delayed or put off request is dropped by raising RetryScheduled, which calls its errback like any
+    IgnoreRequest. It is marked with meta retry_scheduled=True and counted as retry/scheduled, errbacks
+    should skip it as its copy is crawled later. IgnoreRequest raised by other middlewares (robots.txt,
+    offsite) is not a failure of the domain and never opens its breaker.
+    """
 
     EXCEPTIONS_TO_RETRY = (
         defer.TimeoutError, TimeoutError, DNSLookupError, ConnectionRefusedError,
@@ -20,10 +111,25 @@ class RetryMiddleware(object):
     )
 
     def __init__(self, crawler):
+        settings = crawler.settings
         self.crawler = crawler
-        self.max_retry_times = crawler.settings.getint('RETRY_TIMES')
-        self.retry_http_codes = set(int(x) for x in crawler.settings.getlist('RETRY_HTTP_CODES'))
+        self.max_retry_times = settings.getint('RETRY_TIMES')
+        self.retry_http_codes = set(int(x) for x in settings.getlist('RETRY_HTTP_CODES'))
+        self.backoff_base = settings.getfloat('RETRY_BACKOFF_BASE', 1.0)
+        self.backoff_max = settings.getfloat('RETRY_BACKOFF_MAX', 60.0)
+        self.health_params = dict(
+            ratio=settings.getfloat('RETRY_BUDGET_RATIO', 0.2),
+            burst=settings.getint('RETRY_BUDGET_BURST', 10),
+            window=settings.getfloat('RETRY_BREAKER_WINDOW', 60),
+            min_requests=settings.getint('RETRY_BREAKER_MIN_REQUESTS', 20),
+            threshold=settings.getfloat('RETRY_BREAKER_THRESHOLD', 0.5),
+            cooldown=settings.getfloat('RETRY_BREAKER_COOLDOWN', 30),
+        )
+        self.domains = {}
+        self.delayed = set()
         crawler.signals.connect(self.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(self.spider_idle, signal=signals.spider_idle)
+        crawler.signals.connect(self.spider_closed, signal=signals.spider_closed)
 
     @classmethod
     def from_crawler(cls, crawler):
@@ -32,47 +138,296 @@ class RetryMiddleware(object):
     def spider_opened(self, spider):
         self.crawler.stats.set_value('request_ignore_count', 0)
 
+    def spider_idle(self, spider):
+        # retries waiting in the reactor are not in the scheduler, keep the spider open for them
+        if self.delayed:
+            raise DontCloseSpider
+
+    def spider_closed(self, spider):
+        for call in list(self.delayed):
+            if call.active():
+                call.cancel()
+        self.delayed.clear()
+
+    def _health(self, request):
+        domain = urlparse_cached(request).hostname or ''
+        if domain not in self.domains:
+            self.domains[domain] = DomainHealth(**self.health_params)
+        return domain, self.domains[domain]
+
+    def _inc(self, domain, key):
+        self.crawler.stats.inc_value('retry/%s' % key)
+        self.crawler.stats.inc_value('retry/domain/%s/%s' % (domain, key))
+
+    def process_request(self, request, spider):
+        domain, health = self._health(request)
+        if health.is_open():
+            self._inc(domain, 'paused')
+            self._schedule(request.copy(), spider, health.open_until - time.time() + random.uniform(0, 1))
+            self._mark_scheduled(request)
+            raise RetryScheduled('Domain %s paused by circuit breaker' % domain)
+
     def process_response(self, request, response, spider):
         if request.meta.get('dont_retry', False):
             return response
-        if response.status in self.retry_http_codes:
-            return self._retry(request, spider) or response
+        failed = response.status in self.retry_http_codes
+        self._record(request, failed)
+        if failed:
+            return self._retry(request, spider, retry_after=self._retry_after(response)) or response
         return response
 
     def process_exception(self, request, exception, spider):
+        if isinstance(exception, RetryScheduled):
+            return None
         if isinstance(exception, self.EXCEPTIONS_TO_RETRY):
+            # requests ignored on purpose say nothing about the health of the domain
+            if not isinstance(exception, IgnoreRequest):
+                self._record(request, True)
             return self._retry(request, spider)
 
-    def _retry(self, request, spider):
+    def _record(self, request, failed):
+        domain, health = self._health(request)
+        if health.record(failed, not request.meta.get('retry_times', 0)):
+            self._inc(domain, 'breaker_opened')
+            logger.warning('Too many failures on %s, pause it for %ds', domain, health.cooldown)
+
+    @staticmethod
+    def _retry_after(response):
+        value = response.headers.get('Retry-After')
+        try:
+            return float(value) if value else 0
+        except ValueError:
+            return 0
+
+    def _backoff(self, retries, retry_after=0):
         """
-        Retry the request if the limit is not reached or ignore the request
-        :return: new Request or None
+        return seconds to wait before retry number retries, full jitter over the exponential delay
+        """
+        delay = min(self.backoff_max, self.backoff_base * 2 ** (retries - 1))
+        return max(random.uniform(0, delay), min(retry_after, self.backoff_max))
+
+    def _retry(self, request, spider, retry_after=0):
         """
+        Retry the request if the limit and the budget of its domain allow it or ignore the request
+        :return: new Request to retry at once, None if ignored
+        :raise RetryScheduled: if the retry is delayed
+        """
+        domain, health = self._health(request)
         if not request.meta.get('dont_retry', False):
             retries = request.meta.get('retry_times', 0) + 1
             # retry
             if retries < self.max_retry_times:
-                retryreq = request.copy()
-                retryreq.meta['retry_times'] = retries
-                return retryreq
+                if health.withdraw():
+                    retryreq = request.copy()
+                    retryreq.meta['retry_times'] = retries
+                    self._inc(domain, 'count')
+                    delay = self._backoff(retries, retry_after) if self.backoff_base else 0
+                    if not delay:
+                        return retryreq
+                    self._schedule(retryreq, spider, delay)
+                    self._mark_scheduled(request)
+                    raise RetryScheduled('Retry %s in %.1fs' % (request.url, delay))
+                self._inc(domain, 'budget_exhausted')
         # ignore
+        self._inc(domain, 'gave_up')
         self.crawler.stats.inc_value('request_ignore_count')
         spider.logger.warning("Page Loading Failed: %s , gave up" % request.url)
 
+    def _mark_scheduled(self, request):
+        """
+        Mark the request dropped by RetryScheduled, its copy is crawled later
+        """
+        request.meta['retry_scheduled'] = True
+        self.crawler.stats.inc_value('retry/scheduled')
+
+    def _schedule(self, request, spider, delay):
+        """
+        Crawl request again after delay seconds, it holds no download slot meanwhile
+        """
+        call = reactor.callLater(max(delay, 0), self._crawl, request, spider)
+        self.delayed.add(call)
+        self.crawler.stats.max_value('retry/max_delayed', len(self.delayed))
+
+    def _crawl(self, request, spider):
+        # the running call is no longer active
+        self.delayed = set(call for call in self.delayed if call.active())
+        engine = self.crawler.engine
+        if 'spider' in inspect.signature(engine.crawl).parameters:
+            engine.crawl(request, spider)
+        else:
+            engine.crawl(request)
+
+
+def chrome_driver(settings):
+    """
+    Default SELENIUM_DRIVER_FACTORY, a headless Chrome
+    :param settings: Scrapy settings
+    """
+    options = Options()
+    options.add_argument("--headless")
+    options.add_argument("--disable-gpu")
+    options.add_argument('--no-sandbox')
+
+    proxy = settings.get('SELENIUM_PROXY')
+    if proxy:
+        options.add_argument("-proxy-server=%s" % proxy)
+    block = settings.getbool('SELENIUM_BLOCK_RESOURCES', True)
+    if block:
+        # images and stylesheets are not needed to build the DOM
+        options.add_argument('--blink-settings=imagesEnabled=false')
+        options.add_experimental_option('prefs', {'profile.managed_default_content_settings.images': 2})
+    browser = webdriver.Chrome(options=options)
+    browser.set_page_load_timeout(settings.getfloat('SELENIUM_PAGE_LOAD_TIMEOUT', 30))
+    if block:
+        # Chrome has no content setting for stylesheets, they are blocked through the DevTools protocol
+        browser.execute_cdp_cmd('Network.enable', {})
+        browser.execute_cdp_cmd('Network.setBlockedURLs', {'urls': ['*.css', '*.css?*']})
+    return browser
+
+
+class BrowserPool(object):
+    """
+    Browsers shared by the threads of a thread pool, each thread takes one for a whole page.
+
+    Browsers are started when first needed, and restarted after max_pages pages or when one fails,
+    a crashed browser never serves another page.
+    """
+
+    def __init__(self, factory, size=2, max_pages=100):
+        """
+        :param factory: callable returning a new WebDriver
+        :param size: max number of browsers
+        :param max_pages: pages loaded by a browser before it is restarted, 0 for no limit
+        """
+        self.factory = factory
+        self.size = size
+        self.max_pages = max_pages
+        self.started = 0
+        self.recycled = 0
+        self.crashed = 0
+        self._idle = queue.LifoQueue()
+        for _ in range(size):
+            self._idle.put((None, 0))
+
+    def render(self, url):
+        """
+        Load url in a browser, blocks, run it in a thread
+        :return: URL after redirects and the rendered DOM
+        """
+        browser, pages = self._idle.get()
+        try:
+            if browser is None:
+                browser, pages = self.factory(), 0
+                self.started += 1
+            browser.get(url)
+            result = browser.current_url, browser.page_source
+        except Exception:
+            self.crashed += 1
+            self._quit(browser)
+            self._idle.put((None, 0))
+            raise
+        pages += 1
+        if self.max_pages and pages >= self.max_pages:
+            self.recycled += 1
+            self._quit(browser)
+            browser, pages = None, 0
+        self._idle.put((browser, pages))
+        return result
+
+    @staticmethod
+    def _quit(browser):
+        if browser is None:
+            return
+        try:
+            browser.quit()
+        except Exception as e:
+            logger.debug('Failed to quit browser: %s', e)
+
+    def close(self):
+        """
+        Quit all idle browsers
+        """
+        while True:
+            try:
+                browser, _ = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._quit(browser)
+
 
 class SeleniumChromeMiddleware(object):
+    """
+    Renders requests with meta render=True in a pool of browsers, each browser runs in its own thread
+    so the reactor is never blocked. Other requests are downloaded as usual.
+    """
 
     def __init__(self, crawler):
-        # create a headless browser
-        options = Options()
-        options.add_argument("--headless")
-        options.add_argument("--disable-gpu")
-        options.add_argument('--no-sandbox')
-
-        proxy = crawler.settings.get('SELENIUM_PROXY')
-        if proxy:
-            options.add_argument("-proxy-server=%s" % proxy)
-        self.browser = webdriver.Chrome(options=options)
-
-    def __del__(self):
-        self.browser.quit()
+        settings = crawler.settings
+        self.crawler = crawler
+        self.factory = partial(load_object(settings.get('SELENIUM_DRIVER_FACTORY', chrome_driver)), settings)
+        size = settings.getint('SELENIUM_POOL_SIZE', 2)
+        self.pool = BrowserPool(self.factory, size=size, max_pages=settings.getint('SELENIUM_MAX_PAGES', 100))
+        self.threadpool = ThreadPool(minthreads=0, maxthreads=size, name='SeleniumChromeMiddleware')
+        self.cache = RenderCache.from_settings(settings, name=getattr(crawler.spidercls, 'name', None) or 'render')
+        self.request_fingerprint = RequestFingerprinter.from_settings(settings, raw=False)
+        self._browser = None
+        crawler.signals.connect(self.spider_closed, signal=signals.spider_closed)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    @property
+    def browser(self):
+        """
+        A browser outside of the pool for subclasses which drive it themselves, started when first used
+        """
+        if self._browser is None:
+            self._browser = self.factory()
+        return self._browser
+
+    async def process_request(self, request, spider):
+        if not request.meta.get('render', False):
+            return None
+        if self.cache is not None and not request.meta.get('render_refresh', False):
+            # look up in the reactor thread pool, cache hits never wait for a browser
+            entry = await maybe_deferred_to_future(
+                threads.deferToThread(self.cache.get, self.request_fingerprint(request))
+            )
+            if entry is not None:
+                url, html = entry
+                return HtmlResponse(url, body=html, encoding='utf-8', request=request, flags=['cached'])
+        if not self.threadpool.started:
+            self.threadpool.start()
+        result = await maybe_deferred_to_future(
+            threads.deferToThreadPool(reactor, self.threadpool, self._render_page, request)
+        )
+        return self._rendered(result, request)
+
+    def _render_page(self, request):
+        """
+        Run in a browser thread
+        """
+        url, html = self.pool.render(request.url)
+        if self.cache is not None:
+            self.cache.set(self.request_fingerprint(request), url, html, ttl=request.meta.get('render_cache_ttl'))
+        return url, html
+
+    def _rendered(self, result, request):
+        url, html = result
+        self.crawler.stats.inc_value('selenium/rendered')
+        return HtmlResponse(url, body=html, encoding='utf-8', request=request)
+
+    def spider_closed(self, spider):
+        self.crawler.stats.set_value('selenium/browsers_started', self.pool.started)
+        self.crawler.stats.set_value('selenium/browsers_recycled', self.pool.recycled)
+        self.crawler.stats.set_value('selenium/browsers_crashed', self.pool.crashed)
+        if self.threadpool.started:
+            self.threadpool.stop()
+        self.pool.close()
+        if self._browser is not None:
+            BrowserPool._quit(self._browser)
+            self._browser = None
+        if self.cache is not None:
+            self.cache.publish(self.crawler.stats)
+            self.cache.close()
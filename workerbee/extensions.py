@@ -1,12 +1,17 @@
 # -*- coding: utf-8 -*-
 
 import logging
+import threading
 import time
-import requests
 from scrapy import signals
 from scrapy.exceptions import NotConfigured
 from scrapy_redis import connection
-from twisted.internet import reactor, task
+from twisted.internet import defer, reactor, task
+from twisted.web import server
+
+from workerbee.metrics import StatsSampler, MetricsResource, FeedbackClient, prometheus_text
+from workerbee.profiling import Profiler
+from workerbee.seed import Seeder, read_urls
 
 logger = logging.getLogger(__name__)
 
@@ -56,12 +61,19 @@ class AutoStart(object):
     """
     This extensions can add the start url to redis to start spider automatically.
 
+    Start URLs are streamed by a Seeder from the file SEED_FILE, else from the spider's seed_urls generator,
+    else the single spider.start_url is pushed. Seeding runs in a thread of its own, not in the reactor thread pool
+    which also resolves DNS, as it blocks while the queue is full. A generator must not touch the reactor.
+
     Only supports RedisSpider.
     """
 
     def __init__(self, crawler):
+        self.crawler = crawler
         self.redis_server = connection.from_settings(crawler.settings)
+        self.seeder = None
         crawler.signals.connect(self.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(self.spider_closed, signal=signals.spider_closed)
 
     @classmethod
     def from_crawler(cls, crawler):
@@ -70,8 +82,41 @@ class AutoStart(object):
         return cls(crawler)
 
     def spider_opened(self, spider):
-        self.redis_server.lpush(spider.redis_key, spider.start_url)
-        logger.info("Add spider %s's start urls: %s" % (spider.name, spider.start_url))
+        seed_file = self.crawler.settings.get('SEED_FILE')
+        if seed_file:
+            urls = read_urls(seed_file)
+        elif hasattr(spider, 'seed_urls'):
+            urls = spider.seed_urls()
+        else:
+            self.redis_server.lpush(spider.redis_key, spider.start_url)
+            logger.info("Add spider %s's start urls: %s" % (spider.name, spider.start_url))
+            return
+
+        self.seeder = Seeder.from_settings(self.redis_server, self.crawler.settings, spider.name, spider.redis_key)
+        thread = threading.Thread(target=self._seed, args=(self.seeder, urls, spider), name='workerbee-seeder')
+        thread.daemon = True
+        thread.start()
+
+    def _seed(self, seeder, urls, spider):
+        # runs in the seeder thread, results go back to the reactor thread
+        try:
+            result = seeder.seed(urls)
+        except Exception as e:
+            reactor.callFromThread(logger.error, "Failed to seed spider %s: %s" % (spider.name, e))
+        else:
+            reactor.callFromThread(self._seeded, result, spider)
+
+    def _seeded(self, result, spider):
+        pushed, skipped, invalid = result
+        self.crawler.stats.set_value('seed/pushed', pushed)
+        self.crawler.stats.set_value('seed/skipped', skipped)
+        self.crawler.stats.set_value('seed/invalid', invalid)
+        logger.info("Add spider %s's start urls: %d pushed, %d already seen, %d invalid"
+                    % (spider.name, pushed, skipped, invalid))
+
+    def spider_closed(self, spider):
+        if self.seeder is not None:
+            self.seeder.stop()
 
 
 class ClearRequests(object):
@@ -102,6 +147,10 @@ class Monitor(object):
     Forces spiders to be closed and report reason to the server after certain conditions are met.
     Feedback the spider's running stats and report to server.
 
+    Stats are sampled every MONITOR_METRICS_INTERVAL seconds into rates, served in Prometheus text format
+    on MONITOR_METRICS_PORT and, with MONITOR_PUSH_METRICS, posted to the server. Every post goes through
+    Twisted's HTTP client with retries, reporting never blocks the reactor.
+
     Feedback function only support PyHive.
     """
 
@@ -134,6 +183,20 @@ class Monitor(object):
         self.server_api = crawler.settings.get('MONITOR_SERVER_API')
         if self.feedback and not self.server_api:
             raise NotConfigured
+        self.client = FeedbackClient(
+            timeout=crawler.settings.getfloat('MONITOR_FEEDBACK_TIMEOUT', 5),
+            retries=crawler.settings.getint('MONITOR_FEEDBACK_RETRIES', 3)
+        )
+        self.posting = set()
+
+        self.sampler = StatsSampler(crawler.stats)
+        self.metrics_task = None
+        self.metrics_interval = crawler.settings.getfloat('MONITOR_METRICS_INTERVAL', 60)
+        self.metrics_port = crawler.settings.getint('MONITOR_METRICS_PORT', 0)
+        self.metrics_host = crawler.settings.get('MONITOR_METRICS_HOST', '127.0.0.1')
+        self.metrics_listener = None
+        self.push_metrics = self.feedback and crawler.settings.getbool('MONITOR_PUSH_METRICS', False)
+        self.profiler = Profiler.from_crawler(crawler)
 
         if self.close_on.get('spidererror'):
             crawler.stats.set_value('spider_error_count', 0)
@@ -170,15 +233,53 @@ class Monitor(object):
             self.check_request_drop_task = task.LoopingCall(self._check_ignore, spider)
             self.check_request_drop_task.start(10, now=True)  # once per 10 second
 
+        if self.metrics_interval:
+            self.metrics_task = task.LoopingCall(self._sample, spider)
+            self.metrics_task.start(self.metrics_interval, now=True)
+        if self.metrics_port:
+            site = server.Site(MetricsResource(lambda: self.metrics_text(spider)))
+            self.metrics_listener = reactor.listenTCP(self.metrics_port, site, interface=self.metrics_host)
+            logger.info('Serving metrics of spider %s on http://%s:%d/metrics',
+                        spider.name, self.metrics_host, self.metrics_listener.getHost().port)
+
     def spider_closed(self, spider):
         timeout_task = getattr(self, 'timeout_task', False)
         if timeout_task and timeout_task.active():
             timeout_task.cancel()
 
-        if self.check_request_drop_task.running:
+        if self.check_request_drop_task is not None and self.check_request_drop_task.running:
             self.check_request_drop_task.stop()
+        if self.metrics_task is not None and self.metrics_task.running:
+            self.metrics_task.stop()
+        self.sampler.sample()
 
         self._log_and_feedback(spider)
+        # the engine waits for the last feedback before the crawl finishes
+        pending = list(self.posting)
+        if self.metrics_listener is not None:
+            pending.append(defer.maybeDeferred(self.metrics_listener.stopListening))
+        return defer.DeferredList(pending)
+
+    def metrics_text(self, spider):
+        """
+        return the latest snapshot and the current stats in Prometheus text format
+        """
+        return prometheus_text(spider.name, self.sampler.snapshot, self.crawler.stats.get_stats())
+
+    def _sample(self, spider):
+        snapshot = self.sampler.sample()
+        if self.profiler is not None:
+            self.profiler.publish(self.crawler.stats)
+        if self.push_metrics and 'pages_per_second' in snapshot:
+            data = self._feedback_data(False, '')
+            data.update(running=True, **dict((key, round(value, 3)) for key, value in snapshot.items()
+                                             if key.endswith('_per_second') or key == 'error_rate'))
+            self._post(spider, data)
+
+    def _post(self, spider, data):
+        d = self.client.post(self.server_api.replace('<spider_name>', spider.name), data)
+        self.posting.add(d)
+        d.addBoth(lambda _: self.posting.discard(d))
 
     def _check_ignore(self, spider):
         if self.crawler.stats.get_value('request_ignore_count', 0) > self.close_on['requestignore']:
@@ -191,26 +292,31 @@ class Monitor(object):
         if error:
             logger.error(msg)
 
+        data = self._feedback_data(error, msg)
+        msg = "Spider %s totally\ncrawled %d pages, ignored %d pages, parsed fail %d pages, " \
+              "scraped %d items, dropped %d items (unchanged %d), error %d items"
+        logger.info(msg % (spider.name, data['pageReceived'], data['pageIgnored'], data['pageError'],
+                           data['itemScraped'], data['itemDropped'], data['itemUnchanged'], data['itemError']),
+                    extra={'spider': spider})
+        if self.profiler is not None:
+            for line in self.profiler.summary():
+                logger.info(line, extra={'spider': spider})
+
+        if self.feedback:
+            self._post(spider, data)
+
+    def _feedback_data(self, error, msg):
         page_received = self.crawler.stats.get_value('response_received_count', 0)
         page_ignored = self.crawler.stats.get_value('request_ignore_count', 0)
         page_parsed_error = self.crawler.stats.get_value('spider_error_count', 0)
         item_scraped = self.crawler.stats.get_value('item_scraped_count', 0)
         item_dropped = self.crawler.stats.get_value('item_dropped_count', 0)
+        item_unchanged = self.crawler.stats.get_value('item_unchanged_count', 0)
         item_error = self.crawler.stats.get_value('item_error_count', 0)
 
-        msg = "Spider %s totally\ncrawled %d pages, ignored %d pages, parsed fail %d pages, " \
-              "scraped %d items, dropped %d items, error %d items"
-        logger.info(msg % (spider.name, page_received, page_ignored, page_parsed_error,
-                           item_scraped, item_dropped, item_error), extra={'spider': spider})
-
-        if self.feedback:
-            data = {
-                'pageReceived': page_received, 'pageIgnored': page_ignored, 'pageError': page_parsed_error,
-                'itemScraped': item_scraped, 'itemDropped': item_dropped, 'itemError': item_error,
-                'error': error, 'msg': msg,
-            }
-            try:
-                api = self.server_api.replace('<spider_name>', spider.name)
-                requests.post(api, data=data, timeout=5)
-            except Exception as e:
-                logger.error(e)
+        return {
+            'pageReceived': page_received, 'pageIgnored': page_ignored, 'pageError': page_parsed_error,
+            'itemScraped': item_scraped, 'itemDropped': item_dropped, 'itemUnchanged': item_unchanged,
+            'itemError': item_error,
+            'error': error, 'msg': msg,
+        }
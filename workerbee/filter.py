@@ -1,42 +1,196 @@
 # -*- coding: utf-8 -*-
 
+import math
+import time
+import logging
+import hashlib
+from redis.exceptions import ResponseError
+from twisted.internet import defer, task, threads
+from scrapy import signals
+from scrapy.settings import Settings
+from scrapy.utils.misc import load_object
+from scrapy.utils.python import to_bytes, to_unicode
 from scrapy_redis.dupefilter import RFPDupeFilter
 
-from workerbee.request import request_fingerprint
+from workerbee.backends import RedisBackend, ShardedRedisBackend, MmapBackend
+from workerbee.cache import LRUCache
+from workerbee.profiling import Profiler, DUPEFILTER_STAGES
+from workerbee.request import RequestFingerprinter
+
+logger = logging.getLogger(__name__)
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# max size of Redis String is 512M
+MAX_BIT_SIZE = 1 << 32
 
 
 class SimpleHash(object):
     def __init__(self, cap, seed):
         self.cap = cap
         self.seed = seed
+        # intermediate results only matter modulo a power of two covering (cap - 1)
+        self._mask = (1 << (cap - 1).bit_length()) - 1
 
     def hash(self, value):
         ret = 0
-        for i in range(len(value)):
-            ret += self.seed * ret + ord(value[i])
+        multiplier = self.seed + 1
+        mask = self._mask
+        for c in value:
+            ret = (ret * multiplier + ord(c)) & mask
         return (self.cap - 1) & ret
 
 
+class LegacyHash(object):
+    """
+    Hash engine producing exactly the same offsets as SimpleHash,
+    keeps filters created by previous versions valid
+    """
+
+    SEEDS = [5, 7, 11, 13, 31, 37, 61, 67, 71, 73, 79, 83, 89, 97, 101, 103]
+
+    def __init__(self, cap, hash_count=7):
+        """
+        :param cap: bit size of one block
+        :param hash_count: number of offsets per value
+        """
+        if hash_count > len(self.SEEDS):
+            raise ValueError('LegacyHash supports at most %d hash functions' % len(self.SEEDS))
+        self.cap = cap
+        self.seeds = self.SEEDS[:hash_count]
+        self.hashfunc = [SimpleHash(cap, seed) for seed in self.seeds]
+
+    def offsets(self, value):
+        return [f.hash(value) for f in self.hashfunc]
+
+    def offsets_many(self, values):
+        if np is None or len(values) < 2:
+            return [self.offsets(value) for value in values]
+
+        # group by length, then run every seed over every character column at once,
+        # uint64 arithmetic wraps modulo 2 ** 64 which keeps the low bits exact
+        result = [None] * len(values)
+        groups = {}
+        for index, value in enumerate(values):
+            groups.setdefault(len(value), []).append(index)
+        multipliers = np.array(self.seeds, dtype=np.uint64) + np.uint64(1)
+        mask = np.uint64(self.cap - 1)
+        for length, indexes in groups.items():
+            codes = np.frombuffer(
+                ''.join(values[i] for i in indexes).encode('utf-32-le'), dtype='<u4'
+            ).reshape(len(indexes), length).astype(np.uint64)
+            ret = np.zeros((len(indexes), len(self.seeds)), dtype=np.uint64)
+            for column in range(length):
+                ret = ret * multipliers + codes[:, column, None]
+            for i, offsets in zip(indexes, (ret & mask).tolist()):
+                result[i] = offsets
+        return result
+
+
+class DigestHash(object):
+    """
+    Hash engine deriving offsets straight from the hex digest of the fingerprint by double hashing:
+    offset_i = (h1 + i * h2) mod cap
+    """
+
+    def __init__(self, cap, hash_count=7):
+        """
+        :param cap: bit size of one block
+        :param hash_count: number of offsets per value
+        """
+        self.cap = cap
+        self.hash_count = hash_count
+
+    @staticmethod
+    def _split(value):
+        """
+        return two 64-bit integers taken from the digest,
+        values which are not a hex digest of at least 128 bits are digested by blake2b first
+        """
+        try:
+            if len(value) >= 32:
+                return int(value[-32:-16], 16), int(value[-16:], 16) | 1
+        except ValueError:
+            pass
+        digest = hashlib.blake2b(to_bytes(value), digest_size=16).digest()
+        return int.from_bytes(digest[:8], 'big'), int.from_bytes(digest[8:], 'big') | 1
+
+    def offsets(self, value):
+        h1, h2 = self._split(value)
+        return [((h1 + i * h2) & 0xFFFFFFFFFFFFFFFF) % self.cap for i in range(self.hash_count)]
+
+    def offsets_many(self, values):
+        if np is None or len(values) < 2:
+            return [self.offsets(value) for value in values]
+
+        h = np.array([self._split(value) for value in values], dtype=np.uint64)
+        steps = np.arange(self.hash_count, dtype=np.uint64)
+        ret = (h[:, 0, None] + steps * h[:, 1, None]) % np.uint64(self.cap)
+        return ret.tolist()
+
+
+HASH_ENGINES = {
+    'legacy': LegacyHash,
+    'digest': DigestHash,
+}
+
+
 class BloomFilter(object):
     """
     Bloom Filter
     """
 
-    def __init__(self, redis_server, blocknum=1, key='bloomfilter'):
+    def __init__(self, redis_server, blocknum=1, key='bloomfilter', hash_mode='legacy', cache=None,
+                 bit_size=1 << 31, hash_count=7, backend=None):
         """
         :param redis_server: Redis client instance
         :param blocknum: one blockNum for about 90,000,000; if you have more strings for filtering, increase it.
         :param key: the key's name in Redis
+        :param hash_mode: 'legacy' keeps offsets of previous versions, 'digest' derives them from the fingerprint
+        :param cache: optional LRUCache of values known to exist, asked before Redis
+        :param bit_size: bit size of one block, default 256M
+        :param hash_count: number of bits set for each value
+        :param backend: storage of the blocks, default RedisBackend of redis_server
         """
+        if hash_mode not in HASH_ENGINES:
+            raise ValueError('Unknown hash mode: %s' % hash_mode)
+        if bit_size > MAX_BIT_SIZE:
+            raise ValueError('Bit size of one block must not exceed %d, increase blocknum' % MAX_BIT_SIZE)
         self.server = redis_server
-        # max size of Redis String is 512M, now use 256M
-        self.bit_size = 1 << 31
-        self.seeds = [5, 7, 11, 13, 31, 37, 61]
+        self.bit_size = bit_size
+        self.hash_count = hash_count
         self.key = key
         self.blockNum = blocknum
-        self.hashfunc = []
-        for seed in self.seeds:
-            self.hashfunc.append(SimpleHash(self.bit_size, seed))
+        self.hasher = HASH_ENGINES[hash_mode](self.bit_size, self.hash_count)
+        self.cache = cache
+        self.backend = backend if backend is not None else RedisBackend(redis_server)
+
+    @classmethod
+    def for_capacity(cls, redis_server, expected_items, false_positive_rate, blocknum=1, key='bloomfilter',
+                     hash_mode='digest', cache=None, backend=None):
+        """
+        Build a filter sized for expected_items at false_positive_rate
+        """
+        bit_size, hash_count = optimal_size(int(math.ceil(expected_items / blocknum)), false_positive_rate)
+        if hash_mode == 'legacy':
+            # legacy offsets are masked with (bit_size - 1)
+            bit_size = 1 << (bit_size - 1).bit_length()
+        else:
+            bit_size = (bit_size + 7) // 8 * 8
+        return cls(redis_server, blocknum=blocknum, key=key, hash_mode=hash_mode, cache=cache,
+                   bit_size=bit_size, hash_count=hash_count, backend=backend)
+
+    def fill(self, count):
+        """
+        return the expected share of bits set after count values were inserted
+        """
+        return 1 - math.exp(-self.hash_count * count / (self.bit_size * self.blockNum))
+
+    def _block_key(self, str_input):
+        return self.key + str(int(str_input[0:2], 16) % self.blockNum)
 
     def isContains(self, str_input):
         """
@@ -44,21 +198,652 @@ class BloomFilter(object):
         """
         if not str_input:
             return False
-        key = self.key + str(int(str_input[0:2], 16) % self.blockNum)
-        bitfield_operation = self.server.bitfield(key)
-        for f in self.hashfunc:
-            bitfield_operation.get('u1', f.hash(str_input))
-        return all(self.server.execute_command(*bitfield_operation.command))
+        if self.cache is not None and str_input in self.cache:
+            return True
+        exist = all(self._bitfield_many([str_input], ['GET', 'u1'], [False])[0][2])
+        if exist and self.cache is not None:
+            self.cache.add(str_input)
+        return exist
+
+    def insert(self, str_input):
+        """
+        return True if already exist else False
+        """
+        exist = all(self._bitfield_many([str_input], ['SET', 'u1', 1], [False])[0][2])
+        if self.cache is not None:
+            self.cache.add(str_input)
+        return exist
+
+    def check_many(self, values):
+        """
+        Check many values in one pipelined round trip
+        :param values: list of fingerprints
+        :return: list of bool, True if already exist
+        """
+        cached = self._cached(values)
+        return self._found(values, cached, self._bitfield_many(values, ['GET', 'u1'], cached))
+
+    def check_and_insert(self, values, undo_log=None):
+        """
+        Insert many values in one pipelined round trip, the old bits returned by BITFIELD SET tell
+        whether each value was already present, so check and insert is atomic for every value
+        :param values: list of fingerprints
+        :param undo_log: optional list, extended with the (value, key, offsets) turned on for each value
+        :return: list of bool, True if already exist
+        """
+        cached = self._cached(values)
+        return self._inserted(values, cached, self._bitfield_many(values, ['SET', 'u1', 1], cached), undo_log)
+
+    def undo(self, undo_log):
+        """
+        Turn off the bits turned on by check_and_insert. Values inserted meanwhile may share some of them and
+        would be reported missing again, setting bits only after the guarded write succeeded avoids the undo
+        :param undo_log: list filled by check_and_insert
+        """
+        groups = self._undo_groups(undo_log)
+        if groups:
+            self.backend.bitfield(groups, ['SET', 'u1', 0])
+
+    async def acheck_and_insert(self, client, values, undo_log=None):
+        """
+        check_and_insert on an asyncio Redis client, the blocks must be stored in the Redis of client
+        :param client: redis.asyncio client instance
+        """
+        cached = self._cached(values)
+        groups = self._group(values, cached)
+        replies = []
+        if groups:
+            pipe = client.pipeline(transaction=False)
+            RedisBackend(client).queue(pipe, groups, ['SET', 'u1', 1])
+            replies = await pipe.execute()
+        return self._inserted(values, cached, self._collect(values, groups, replies), undo_log)
+
+    async def acheck_many(self, client, values):
+        """
+        check_many on an asyncio Redis client, the blocks must be stored in the Redis of client
+        :param client: redis.asyncio client instance
+        """
+        cached = self._cached(values)
+        groups = self._group(values, cached)
+        replies = []
+        if groups:
+            pipe = client.pipeline(transaction=False)
+            RedisBackend(client).queue(pipe, groups, ['GET', 'u1'])
+            replies = await pipe.execute()
+        return self._found(values, cached, self._collect(values, groups, replies))
+
+    def bitmaps(self):
+        """
+        return empty local bit arrays of all blocks, filled by set_local and written by write_local
+        """
+        return {self.key + str(n): bytearray((self.bit_size + 7) // 8) for n in range(self.blockNum)}
+
+    def set_local(self, bitmaps, values):
+        """
+        Set the bits of values in local bit arrays, in Redis bit order: offset 0 is the high bit of byte 0
+        :param bitmaps: dict returned by bitmaps
+        :param values: list of fingerprints
+        """
+        values = [value for value in values if value]
+        groups = {}
+        for value, offsets in zip(values, self.hasher.offsets_many(values)):
+            groups.setdefault(self._block_key(value), []).extend(offsets)
+        for key, offsets in groups.items():
+            bitmap = bitmaps[key]
+            if np is not None:
+                offsets = np.array(offsets, dtype=np.uint64)
+                masks = np.right_shift(np.uint8(0x80), (offsets & np.uint64(7)).astype(np.uint8))
+                np.bitwise_or.at(np.frombuffer(bitmap, dtype=np.uint8), offsets >> np.uint64(3), masks)
+            else:
+                for offset in offsets:
+                    bitmap[offset >> 3] |= 0x80 >> (offset & 7)
+
+    def write_local(self, bitmaps, chunk_size=1 << 24):
+        """
+        Replace the blocks of the backend by local bit arrays
+        :param bitmaps: dict returned by bitmaps
+        :param chunk_size: bytes sent by one SETRANGE to Redis
+        """
+        for key, bitmap in bitmaps.items():
+            self.backend.replace(key, bitmap, chunk_size)
+        if self.cache is not None:
+            self.cache.clear()
+
+    def copy_to(self, backend):
+        """
+        Copy every block to another backend, e.g. snapshot a MmapBackend into Redis
+        """
+        for n in range(self.blockNum):
+            backend.replace(self.key + str(n), self.backend.read(self.key + str(n)))
+
+    def copy_from(self, backend):
+        """
+        Replace every block by the one of another backend, e.g. restore a MmapBackend from Redis
+        """
+        for n in range(self.blockNum):
+            self.backend.replace(self.key + str(n), backend.read(self.key + str(n)))
+        if self.cache is not None:
+            self.cache.clear()
+
+    def start(self):
+        """
+        Start the periodic work of the backend, e.g. the flushes of a MmapBackend, call it in the reactor thread
+        """
+        if hasattr(self.backend, 'start'):
+            self.backend.start()
+
+    def close(self):
+        self.backend.close()
+
+    def _cached(self, values):
+        if self.cache is None:
+            return [False] * len(values)
+        return [bool(value) and value in self.cache for value in values]
+
+    def _found(self, values, cached, collected):
+        """
+        Turn the bits of a lookup into the result of check_many
+        :param collected: list of (key, offsets, bits) returned by _collect
+        """
+        result = []
+        for value, hit, (_, _, bits) in zip(values, cached, collected):
+            exist = hit or bool(bits) and all(bits)
+            if exist and not hit and self.cache is not None:
+                self.cache.add(value)
+            result.append(exist)
+        return result
+
+    def _inserted(self, values, cached, collected, undo_log):
+        """
+        Turn the old bits of an insert into the result of check_and_insert
+        :param collected: list of (key, offsets, old bits) returned by _collect
+        """
+        result = []
+        for value, hit, (key, offsets, bits) in zip(values, cached, collected):
+            result.append(hit or bool(bits) and all(bits))
+            if value and self.cache is not None:
+                self.cache.add(value)
+            if undo_log is not None:
+                undo_log.append((value, key, [offset for offset, bit in zip(offsets, bits) if not bit]))
+        return result
+
+    def _undo_groups(self, undo_log):
+        """
+        :return: dict of block key to list of (None, offsets) turned on by the logged inserts
+        """
+        groups = {}
+        for value, key, offsets in undo_log:
+            if self.cache is not None:
+                self.cache.discard(value)
+            if offsets:
+                groups.setdefault(key, []).append((None, offsets))
+        return groups
+
+    def _bitfield_many(self, values, operation, skip):
+        """
+        Run one BITFIELD command per block key in a single pipeline
+        :param operation: BITFIELD sub command without offset, e.g. ['GET', 'u1']
+        :param skip: list of bool, True for values which need no Redis access
+        :return: list of (key, offsets, bits) for each value, empty for empty or skipped values
+        """
+        groups = self._group(values, skip)
+        return self._collect(values, groups, self.backend.bitfield(groups, operation) if groups else [])
+
+    def _group(self, values, skip):
+        """
+        :return: dict of block key to list of (index, offsets)
+        """
+        groups = {}
+        indexes = [i for i, value in enumerate(values) if value and not skip[i]]
+        all_offsets = self.hasher.offsets_many([values[i] for i in indexes])
+        for index, offsets in zip(indexes, all_offsets):
+            groups.setdefault(self._block_key(values[index]), []).append((index, offsets))
+        return groups
+
+    def _queue(self, pipe, values, operation, skip):
+        """
+        Queue BITFIELD commands of values into a Redis pipe
+        :return: groups of (index, offsets) by block key, one command queued for each
+        """
+        groups = self._group(values, skip)
+        self.backend.queue(pipe, groups, operation)
+        return groups
+
+    def _collect(self, values, groups, replies):
+        """
+        Split replies of the commands queued by _queue
+        :return: list of (key, offsets, bits) for each value
+        """
+        result = [(None, [], [])] * len(values)
+        for (key, entries), bits in zip(groups.items(), replies):
+            for n, (index, offsets) in enumerate(entries):
+                result[index] = (key, offsets, bits[n * self.hash_count:(n + 1) * self.hash_count])
+        return result
+
+
+class ScalableBloomFilter(object):
+    """
+    Scalable Bloom Filter
+
+    Starts with one sub-filter sized for expected_items, a new larger sub-filter with a tighter error rate is
+    added when the estimated fill ratio of the newest one crosses the threshold, values are inserted into the
+    newest sub-filter and looked up in all of them. The sum of error rates stays below false_positive_rate.
+    """
+
+    def __init__(self, redis_server, expected_items, false_positive_rate, blocknum=1, key='bloomfilter',
+                 hash_mode='digest', cache=None, growth=2, tightening=0.5, fill_ratio=0.5):
+        """
+        :param redis_server: Redis client instance
+        :param expected_items: capacity of the first sub-filter
+        :param false_positive_rate: bound of the false positive rate of the whole filter
+        :param blocknum: block number of every sub-filter
+        :param key: the key's prefix in Redis
+        :param hash_mode: hash engine of sub-filters
+        :param cache: optional LRUCache of values known to exist, asked before Redis
+        :param growth: capacity of each sub-filter compared with the previous one
+        :param tightening: error rate of each sub-filter compared with the previous one
+        :param fill_ratio: expected share of bits set in the newest sub-filter before a new one is added
+        """
+        self.server = redis_server
+        self.expected_items = expected_items
+        self.false_positive_rate = false_positive_rate
+        self.blockNum = blocknum
+        self.key = key
+        self.meta_key = key + ':meta'
+        self.hash_mode = hash_mode
+        self.cache = cache
+        self.growth = growth
+        self.tightening = tightening
+        self.fill_ratio = fill_ratio
+        self.filters = []
+        self.server.hsetnx(self.meta_key, 'filters', 1)
+        self._refresh(int(self.server.hget(self.meta_key, 'filters')))
+
+    def _refresh(self, number):
+        while len(self.filters) < number:
+            i = len(self.filters)
+            rate = self.false_positive_rate * (1 - self.tightening) * self.tightening ** i
+            items = min(self.expected_items * self.growth ** i, max_capacity(rate, self.blockNum))
+            self.filters.append(BloomFilter.for_capacity(
+                self.server, items, rate, blocknum=self.blockNum, key='%s:%d:' % (self.key, i),
+                hash_mode=self.hash_mode
+            ))
+
+    def isContains(self, str_input):
+        """
+        return True if already exist else False
+        """
+        return self.check_many([str_input])[0]
+
+    def insert(self, str_input):
+        """
+        return True if already exist else False
+        """
+        return self.check_and_insert([str_input])[0]
+
+    def check_many(self, values):
+        """
+        Check many values against all sub-filters in one pipelined round trip
+        :param values: list of fingerprints
+        :return: list of bool, True if already exist
+        """
+        cached = self._cached(values)
+        exist, _, _ = self._run(values, cached, False, None)
+        if self.cache is not None:
+            for value, hit, found in zip(values, cached, exist):
+                if found and not hit:
+                    self.cache.add(value)
+        return exist
+
+    def check_and_insert(self, values, undo_log=None):
+        """
+        Check many values against the older sub-filters, then insert the ones they miss into the newest
+        sub-filter, one pipelined round trip each
+        :param values: list of fingerprints
+        :param undo_log: optional list, extended with the (value, key, offsets) turned on for each value
+        :return: list of bool, True if already exist
+        """
+        cached = self._cached(values)
+        exist, current, added = self._run(values, cached, True, undo_log)
+        if self.cache is not None:
+            for value in values:
+                if value:
+                    self.cache.add(value)
+        if added:
+            self._grow(current, added)
+        return exist
+
+    def undo(self, undo_log):
+        """
+        Turn off the bits turned on by check_and_insert
+        :param undo_log: list filled by check_and_insert
+        """
+        if self.cache is not None:
+            for value, _, _ in undo_log:
+                self.cache.discard(value)
+        # entries carry their block keys, any sub-filter can turn the bits off
+        self.filters[-1].undo(undo_log)
+
+    def _cached(self, values):
+        if self.cache is None:
+            return [False] * len(values)
+        return [bool(value) and value in self.cache for value in values]
+
+    def _run(self, values, cached, insert, undo_log):
+        """
+        GET bits from every sub-filter, if insert SET bits in the newest one for the values none of the older
+        ones contains. The number of sub-filters is read in every round trip, sub-filters added by other workers
+        are looked up as soon as they appear
+        :return: (exist, sub-filter whose bits were set, number of values added to it)
+        """
+        exist = list(cached)
+        current, added = None, 0
+        checked = 0
+        while True:
+            # the newest sub-filter is set, not looked up, once all older ones are checked
+            last = len(self.filters) if current is not None or not insert else len(self.filters) - 1
+            setting = current is None and insert and checked == last
+            pipe = self.server.pipeline(transaction=False)
+            pipe.hget(self.meta_key, 'filters')
+            queued = [(f, f._queue(pipe, values, ['GET', 'u1'], exist)) for f in self.filters[checked:last]]
+            if setting:
+                queued.append((self.filters[-1], self.filters[-1]._queue(pipe, values, ['SET', 'u1', 1], exist)))
+            replies = pipe.execute()
+
+            start = 1
+            for f, groups in queued:
+                result = f._collect(values, groups, replies[start:start + len(groups)])
+                start += len(groups)
+                for index, (key, offsets, bits) in enumerate(result):
+                    if not bits:
+                        continue
+                    if all(bits):
+                        exist[index] = True
+                    elif setting and f is self.filters[-1]:
+                        added += 1
+                    if setting and f is self.filters[-1] and undo_log is not None:
+                        undo_log.append((values[index], key, [o for o, bit in zip(offsets, bits) if not bit]))
+            if setting:
+                current = self.filters[-1]
+                last = len(self.filters)
+            checked = last
+
+            number = int(replies[0] or 1)
+            if number > len(self.filters):
+                self._refresh(number)
+            elif current is not None or not insert:
+                return exist, current, added
+
+    def _grow(self, current, added):
+        """
+        Count new values of the newest sub-filter, add a sub-filter when it is full enough
+        """
+        index = self.filters.index(current)
+        pipe = self.server.pipeline(transaction=False)
+        pipe.hincrby(self.meta_key, 'count:%d' % index, added)
+        pipe.hget(self.meta_key, 'filters')
+        count, number = pipe.execute()
+        number = int(number)
+        if number == index + 1 and current.fill(count) >= self.fill_ratio:
+            # only the first worker crossing the threshold adds the sub-filter
+            if self.server.hsetnx(self.meta_key, 'grown:%d' % index, 1):
+                self.server.hset(self.meta_key, 'filters', index + 2)
+                number = index + 2
+        self._refresh(number)
+
+
+class GenerationalBloomFilter(object):
+    """
+    Time-windowed Bloom Filter
+
+    Made of one sub-filter per time window, values are inserted into the generation of the current window
+    and looked up in all live generations, so a value is forgotten between ttl * (generations - 1) / generations
+    and ttl after it was inserted. Every generation key expires in Redis one window after its generation left
+    the live ones, even if no worker runs anymore, workers rotating to a new window also drop expired
+    generations at once with UNLINK.
+    """
+
+    # filter is refreshed periodically, MysqlPipeline also asks it in upsert mode
+    expires = True
+
+    # KEYS: keys of one block in live generations, oldest first
+    # ARGV: hash count, 1 to insert, expire time of the newest generation in ms, offsets of every value
+    # return for each value -1 if found in any generation, else the mask of bits turned on in the newest one
+    SCRIPT = """
+    local k = tonumber(ARGV[1])
+    local insert = ARGV[2] == '1'
+    local written = false
+    local result = {}
+    for v = 0, (#ARGV - 3) / k - 1 do
+        local found = false
+        for g = 1, #KEYS do
+            found = true
+            for i = 1, k do
+                if redis.call('GETBIT', KEYS[g], ARGV[3 + v * k + i]) == 0 then
+                    found = false
+                    break
+                end
+            end
+            if found then
+                break
+            end
+        end
+        local mask = 0
+        if found then
+            mask = -1
+        elseif insert then
+            for i = 1, k do
+                if redis.call('SETBIT', KEYS[#KEYS], ARGV[3 + v * k + i], 1) == 0 then
+                    mask = mask + 2 ^ (i - 1)
+                end
+            end
+            written = true
+        end
+        result[v + 1] = mask
+    end
+    if written and redis.call('PTTL', KEYS[#KEYS]) < 0 then
+        redis.call('PEXPIREAT', KEYS[#KEYS], ARGV[3])
+    end
+    return result
+    """
+
+    def __init__(self, redis_server, expected_items, false_positive_rate, ttl, generations=4, blocknum=1,
+                 key='bloomfilter', hash_mode='digest', cache=None):
+        """
+        :param redis_server: Redis client instance
+        :param expected_items: capacity of one generation
+        :param false_positive_rate: bound of the false positive rate of the whole filter
+        :param ttl: seconds covered by all live generations
+        :param generations: number of live generations
+        :param blocknum: block number of every generation
+        :param key: the key's prefix in Redis
+        :param hash_mode: hash engine of generations
+        :param cache: optional LRUCache of values known to exist, asked before Redis
+        """
+        self.server = redis_server
+        self.expected_items = expected_items
+        self.false_positive_rate = false_positive_rate
+        self.window = float(ttl) / generations
+        self.generations = generations
+        self.blockNum = blocknum
+        self.key = key
+        self.hash_mode = hash_mode
+        self.cache = cache
+        self.script = redis_server.register_script(self.SCRIPT)
+        self.generation = None
+        self.expire_at = None
+        self.filters = []
+        self._rotate()
+
+    def _generation_filter(self, generation):
+        return BloomFilter.for_capacity(
+            self.server, self.expected_items, self.false_positive_rate / self.generations,
+            blocknum=self.blockNum, key='%s:g%d:' % (self.key, generation), hash_mode=self.hash_mode
+        )
+
+    def _rotate(self):
+        """
+        Move to the generation of the current window and drop the expired ones
+        """
+        generation = int(time.time() // self.window)
+        if generation == self.generation:
+            return
+        first = generation - self.generations + 1
+        # drop what the previous window left, or a few older generations after a restart
+        start = self.generation - self.generations + 1 if self.generation is not None else first - self.generations
+        expired = [
+            self._generation_filter(g).key + str(i) for g in range(start, first) for i in range(self.blockNum)
+        ]
+        if expired:
+            # UNLINK frees memory in a background thread of Redis
+            self.server.unlink(*expired)
+        self.filters = [self._generation_filter(g) for g in range(first, generation + 1)]
+        self.generation = generation
+        # the generation is read until the end of window generation + generations - 1, keep one more window
+        self.expire_at = int((generation + self.generations + 1) * self.window * 1000)
+        if self.cache is not None:
+            self.cache.clear()
+
+    def isContains(self, str_input):
+        """
+        return True if already exist else False
+        """
+        return self.check_many([str_input])[0]
 
     def insert(self, str_input):
         """
         return True if already exist else False
         """
-        key = self.key + str(int(str_input[0:2], 16) % self.blockNum)
-        bitfield_operation = self.server.bitfield(key)
-        for f in self.hashfunc:
-            bitfield_operation.set('u1', f.hash(str_input), 1)
-        return all(self.server.execute_command(*bitfield_operation.command))
+        return self.check_and_insert([str_input])[0]
+
+    def check_many(self, values):
+        """
+        Check many values against all live generations in one pipelined round trip
+        :param values: list of fingerprints
+        :return: list of bool, True if already exist
+        """
+        return self._run(values, False, None)
+
+    def check_and_insert(self, values, undo_log=None):
+        """
+        Insert values missing from every live generation into the newest one, atomically per block
+        :param values: list of fingerprints
+        :param undo_log: optional list, extended with the (value, key, offsets) turned on for each value
+        :return: list of bool, True if already exist
+        """
+        return self._run(values, True, undo_log)
+
+    def undo(self, undo_log):
+        """
+        Turn off the bits turned on by check_and_insert
+        :param undo_log: list filled by check_and_insert
+        """
+        if self.cache is not None:
+            for value, _, _ in undo_log:
+                self.cache.discard(value)
+        self.filters[-1].undo(undo_log)
+
+    def _run(self, values, insert, undo_log):
+        self._rotate()
+        current = self.filters[-1]
+        exist = [self.cache is not None and bool(value) and value in self.cache for value in values]
+        indexes = [i for i, value in enumerate(values) if value and not exist[i]]
+
+        groups = {}
+        for index, offsets in zip(indexes, current.hasher.offsets_many([values[i] for i in indexes])):
+            block = current._block_key(values[index])[len(current.key):]
+            groups.setdefault(block, []).append((index, offsets))
+        pipe = self.server.pipeline(transaction=False)
+        for block, entries in groups.items():
+            args = [current.hash_count, 1 if insert else 0, self.expire_at]
+            for _, offsets in entries:
+                args += offsets
+            self.script(keys=[f.key + block for f in self.filters], args=args, client=pipe)
+        replies = pipe.execute() if groups else []
+
+        for (block, entries), masks in zip(groups.items(), replies):
+            for (index, offsets), mask in zip(entries, masks):
+                exist[index] = mask == -1
+                if undo_log is not None:
+                    flipped = [] if mask == -1 else [offset for i, offset in enumerate(offsets) if mask >> i & 1]
+                    undo_log.append((values[index], current.key + block, flipped))
+        if self.cache is not None:
+            for value, found in zip(values, exist):
+                if value and (found or insert):
+                    self.cache.add(value)
+        return exist
+
+
+def optimal_size(expected_items, false_positive_rate):
+    """
+    return total bit size and hash count of a bloom filter for the capacity and error rate
+    """
+    if expected_items <= 0 or not 0 < false_positive_rate < 1:
+        raise ValueError('expected_items must be positive and false_positive_rate between 0 and 1')
+    bit_size = int(math.ceil(-expected_items * math.log(false_positive_rate) / math.log(2) ** 2))
+    hash_count = max(1, int(round(bit_size / expected_items * math.log(2))))
+    return bit_size, hash_count
+
+
+def max_capacity(false_positive_rate, blocknum):
+    """
+    return the largest capacity blocknum blocks can hold at the error rate
+    """
+    return int(MAX_BIT_SIZE * blocknum * math.log(2) ** 2 / -math.log(false_positive_rate))
+
+
+def bloomfilter_from_settings(redis_server, settings, key='bloomfilter', cache=None):
+    """
+    Build the bloom filter configured by settings
+    :param redis_server: Redis client instance
+    :param settings: Scrapy settings
+    :param key: the key's name in Redis
+    :param cache: optional LRUCache
+    :return: BloomFilter, ScalableBloomFilter or GenerationalBloomFilter
+    """
+    blocknum = settings.getint('REDIS_BLOCKNUM', 2)
+    expected_items = settings.getint('BLOOM_EXPECTED_ITEMS', 0)
+    false_positive_rate = settings.getfloat('BLOOM_FALSE_POSITIVE_RATE', 0.0001)
+    ttl_days = settings.getfloat('BLOOM_TTL_DAYS', 0)
+    # checked before any backend is built, a mmap backend creates its directory
+    if settings.get('BLOOM_BACKEND', 'redis') != 'redis' and (ttl_days or settings.getbool('BLOOM_SCALABLE', False)):
+        raise ValueError('Scalable and generational bloom filters only support the redis backend')
+    if ttl_days:
+        return GenerationalBloomFilter(
+            redis_server, expected_items or 1000000, false_positive_rate, ttl_days * 86400,
+            generations=settings.getint('BLOOM_GENERATIONS', 4), blocknum=blocknum, key=key,
+            hash_mode=settings.get('BLOOM_HASH', 'digest'), cache=cache
+        )
+    if settings.getbool('BLOOM_SCALABLE', False):
+        return ScalableBloomFilter(
+            redis_server, expected_items or 1000000, false_positive_rate, blocknum=blocknum, key=key,
+            hash_mode=settings.get('BLOOM_HASH', 'digest'), cache=cache,
+            growth=settings.getint('BLOOM_SCALABLE_GROWTH', 2),
+            fill_ratio=settings.getfloat('BLOOM_SCALABLE_FILL_RATIO', 0.5)
+        )
+    backend = backend_from_settings(redis_server, settings)
+    if expected_items:
+        return BloomFilter.for_capacity(
+            redis_server, expected_items, false_positive_rate, blocknum=blocknum, key=key,
+            hash_mode=settings.get('BLOOM_HASH', 'digest'), cache=cache, backend=backend
+        )
+    return BloomFilter(redis_server, blocknum=blocknum, key=key, hash_mode=settings.get('BLOOM_HASH', 'legacy'),
+                       cache=cache, backend=backend)
+
+
+def backend_from_settings(redis_server, settings):
+    """
+    Build the block storage configured by BLOOM_BACKEND: 'redis', 'sharded', 'mmap' or the path of a backend class
+    with a from_settings class method
+    """
+    backend = settings.get('BLOOM_BACKEND', 'redis')
+    if backend == 'redis':
+        return RedisBackend(redis_server)
+    if backend == 'sharded':
+        return ShardedRedisBackend.from_settings(settings)
+    if backend == 'mmap':
+        return MmapBackend.from_settings(settings)
+    return load_object(backend).from_settings(settings)
 
 
 class RFPDupeFilterAlter(RFPDupeFilter):
@@ -67,6 +852,57 @@ class RFPDupeFilterAlter(RFPDupeFilter):
     This class can also be used with default scrapy-redis's scheduler.
     """
 
+    def __init__(self, server, key, debug=False, cache=None, fingerprinter=None):
+        """
+        :param cache: optional LRUCache of fingerprints known to exist, asked before Redis
+        :param fingerprinter: RequestFingerprinter, version 1 if None
+        """
+        super(RFPDupeFilterAlter, self).__init__(server, key, debug=debug)
+        self.cache = cache
+        self.fingerprinter = fingerprinter or self.make_fingerprinter(Settings())
+        self.profiler = None
+
+    @classmethod
+    def from_spider(cls, spider):
+        df = super(RFPDupeFilterAlter, cls).from_spider(spider)
+        df.cache = LRUCache.from_settings(spider.settings)
+        df.fingerprinter = cls.make_fingerprinter(spider.settings)
+        df.key = df.fingerprinter.versioned_key(df.key)
+        crawler = getattr(spider, 'crawler', None)
+        df.profiler = Profiler.from_crawler(crawler)
+        if df.profiler is not None:
+            df.fingerprinter = df.profiler.wrap(df.fingerprinter, 'request_fingerprint')
+            df.profiler.instrument(df, DUPEFILTER_STAGES)
+        if df.cache is not None and crawler is not None:
+            crawler.signals.connect(df.spider_closed, signal=signals.spider_closed)
+            df.stats = crawler.stats
+        return df
+
+    @classmethod
+    def from_spider_name(cls, server, settings, spider_name):
+        """
+        return the dupefilter of a spider outside of a crawl, e.g. to check start URLs before seeding
+        """
+        fingerprinter = cls.make_fingerprinter(settings)
+        return cls(server, key=fingerprinter.versioned_key(spider_name + ':dupefilter'), fingerprinter=fingerprinter)
+
+    @classmethod
+    def make_fingerprinter(cls, settings):
+        """
+        return the RequestFingerprinter of this dupefilter, MysqlPipeline commits the same fingerprints
+        """
+        return RequestFingerprinter.from_settings(settings)
+
+    @classmethod
+    def fingerprint_writer(cls, server, settings, spider_name):
+        """
+        return the writer MysqlPipeline commits request fingerprints with
+        """
+        return FingerprintWriter.from_settings(server, settings, spider_name)
+
+    def spider_closed(self, spider):
+        self.cache.publish(self.stats, 'l1cache/dupefilter')
+
     def request_seen(self, request):
         """
         Returns True if request was already seen.
@@ -77,8 +913,304 @@ class RFPDupeFilterAlter(RFPDupeFilter):
         -------
         bool
         """
-        fp = request_fingerprint(request)
+        fp = self.fingerprinter(request)
+        if self.cache is not None and fp in self.cache:
+            return True
 
         # This returns the number of values ismember, one if already exists
         ismember = self.server.sismember(self.key, fp)
+        if ismember and self.cache is not None:
+            self.cache.add(fp)
         return ismember
+
+    def requests_seen(self, requests):
+        """
+        Check many requests with one SMISMEMBER, falls back to pipelined SISMEMBER before Redis 6.2
+        :param requests: list of scrapy.http.Request
+        :return: list of bool, True if request was already seen
+        """
+        fps = [self.fingerprinter(request) for request in requests]
+        seen = [self.cache is not None and fp in self.cache for fp in fps]
+        unknown = [fp for fp, hit in zip(fps, seen) if not hit]
+        if unknown:
+            try:
+                result = iter(self.server.execute_command('SMISMEMBER', self.key, *unknown))
+            except ResponseError:
+                pipe = self.server.pipeline(transaction=False)
+                for fp in unknown:
+                    pipe.sismember(self.key, fp)
+                result = iter(pipe.execute())
+            for i, fp in enumerate(fps):
+                if not seen[i]:
+                    seen[i] = bool(next(result))
+                    if seen[i] and self.cache is not None:
+                        self.cache.add(fp)
+        return seen
+
+
+class FingerprintWriter(object):
+    """
+    Commits request fingerprints to the dupefilter in batches.
+
+    Fingerprints are buffered on the reactor thread and sent as multi-member SADDs through one Redis pipeline
+    in a worker thread, when the buffer is full, when the flush interval elapses and when the spider closes.
+    """
+
+    # members of one SADD command
+    CHUNK_SIZE = 1000
+
+    def __init__(self, server, key, batch_size=100, flush_interval=1.0):
+        """
+        :param server: Redis client instance
+        :param key: Redis key of the dupefilter
+        :param batch_size: fingerprints buffered before a flush
+        :param flush_interval: max seconds a fingerprint waits in the buffer
+        """
+        self.server = server
+        self.key = key
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.buffer = []
+        self.flushing = set()
+        self.flush_task = None
+
+    @classmethod
+    def from_settings(cls, server, settings, spider_name):
+        return cls(
+            server, RequestFingerprinter.from_settings(settings).versioned_key(spider_name + ':dupefilter'),
+            batch_size=settings.getint('FINGERPRINT_BATCH_SIZE', 100),
+            flush_interval=settings.getfloat('FINGERPRINT_FLUSH_INTERVAL', 1.0)
+        )
+
+    def start(self):
+        self.flush_task = task.LoopingCall(self.flush)
+        self.flush_task.start(self.flush_interval, now=False)
+
+    def add(self, fingerprints):
+        """
+        Queue fingerprints whose items are already stored
+        """
+        self.buffer.extend(fingerprints)
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        fingerprints, self.buffer = self.buffer, []
+        d = threads.deferToThread(self.write, fingerprints)
+        self.flushing.add(d)
+        d.addCallbacks(self._written, self._write_failed, errbackArgs=(fingerprints,))
+        d.addBoth(lambda _: self.flushing.discard(d))
+
+    def write(self, fingerprints):
+        pipe = self.server.pipeline(transaction=False)
+        for i in range(0, len(fingerprints), self.CHUNK_SIZE):
+            pipe.sadd(self.key, *fingerprints[i:i + self.CHUNK_SIZE])
+        pipe.execute()
+
+    def _written(self, result):
+        pass
+
+    def _write_failed(self, failure, fingerprints):
+        logger.error('Failed to commit %d request fingerprints: %s', len(fingerprints), failure.value)
+        # keep them for the next flush
+        self.buffer.extend(fingerprints)
+
+    def close(self):
+        """
+        Flush the buffer and wait for writes in flight, fingerprints of failed writes are retried once
+        :return: Deferred
+        """
+        if self.flush_task is not None and self.flush_task.running:
+            self.flush_task.stop()
+        self.flush()
+        d = defer.DeferredList(list(self.flushing))
+        d.addCallback(lambda _: self.buffer and threads.deferToThread(self.write, self.buffer))
+        d.addCallback(lambda result: result and self._written(result))
+        return d
+
+
+class BloomFingerprintWriter(FingerprintWriter):
+    """
+    Commits request fingerprints into the bloom filter of BloomDupeFilter
+    """
+
+    def __init__(self, bloomfilter, batch_size=100, flush_interval=1.0):
+        super(BloomFingerprintWriter, self).__init__(
+            bloomfilter.server, bloomfilter.key, batch_size=batch_size, flush_interval=flush_interval
+        )
+        self.bloomfilter = bloomfilter
+
+    def write(self, fingerprints):
+        self.bloomfilter.check_and_insert(fingerprints)
+
+
+class FailureCounter(FingerprintWriter):
+    """
+    Counts failed downloads of request fingerprints in a Redis hash, in batches like FingerprintWriter.
+
+    A fingerprint reaching max_failures is removed from the hash and queued in the writer of the dupefilter,
+    so a request which keeps failing is given up on after max_failures crawls.
+    """
+
+    def __init__(self, server, key, writer, max_failures=3, batch_size=100, flush_interval=1.0):
+        """
+        :param key: Redis hash of failure counts
+        :param writer: FingerprintWriter of the dupefilter
+        :param max_failures: failures before the fingerprint is committed
+        """
+        super(FailureCounter, self).__init__(server, key, batch_size=batch_size, flush_interval=flush_interval)
+        self.writer = writer
+        self.max_failures = max_failures
+
+    def write(self, fingerprints):
+        """
+        :return: fingerprints which reached max_failures
+        """
+        pipe = self.server.pipeline(transaction=False)
+        for fp in fingerprints:
+            pipe.hincrby(self.key, fp, 1)
+        counts = pipe.execute()
+        exhausted = list(set(fp for fp, count in zip(fingerprints, counts) if count >= self.max_failures))
+        if exhausted:
+            self.server.hdel(self.key, *exhausted)
+        return exhausted
+
+    def _written(self, exhausted):
+        if exhausted:
+            self.writer.add(exhausted)
+
+
+def fingerprinter_from_settings(settings):
+    """
+    return the RequestFingerprinter of DUPEFILTER_CLASS
+    """
+    dupefilter_cls = load_object(settings.get('DUPEFILTER_CLASS') or 'workerbee.filter.RFPDupeFilterAlter')
+    if hasattr(dupefilter_cls, 'make_fingerprinter'):
+        return dupefilter_cls.make_fingerprinter(settings)
+    return RequestFingerprinter.from_settings(settings)
+
+
+def fingerprint_writer_from_settings(server, settings, spider_name):
+    """
+    return the RequestFingerprinter and the FingerprintWriter of DUPEFILTER_CLASS,
+    fingerprints committed outside of the dupefilter must be computed and stored the same way
+    """
+    dupefilter_cls = load_object(settings.get('DUPEFILTER_CLASS') or 'workerbee.filter.RFPDupeFilterAlter')
+    fingerprinter = fingerprinter_from_settings(settings)
+    if hasattr(dupefilter_cls, 'fingerprint_writer'):
+        writer = dupefilter_cls.fingerprint_writer(server, settings, spider_name)
+    else:
+        writer = FingerprintWriter.from_settings(server, settings, spider_name)
+    return fingerprinter, writer
+
+
+class BloomDupeFilter(RFPDupeFilterAlter):
+    """
+    Request duplicates filter keeping fingerprints in a bloom filter instead of a Redis SET.
+
+    Memory is fixed by DUPEFILTER_BLOOM_EXPECTED_ITEMS and DUPEFILTER_BLOOM_FALSE_POSITIVE_RATE,
+    a false positive means a new request is filtered. Like RFPDupeFilterAlter it only checks,
+    fingerprints are committed by MysqlPipeline.
+    """
+
+    def __init__(self, server, key, debug=False, cache=None, fingerprinter=None, bloomfilter=None):
+        """
+        :param bloomfilter: filter of request fingerprints, built from default settings if None
+        """
+        super(BloomDupeFilter, self).__init__(server, key, debug=debug, cache=cache, fingerprinter=fingerprinter)
+        self.bloomfilter = bloomfilter or self.make_bloomfilter(server, Settings(), key)
+
+    @classmethod
+    def from_spider(cls, spider):
+        df = super(BloomDupeFilter, cls).from_spider(spider)
+        df.bloomfilter = cls.make_bloomfilter(df.server, spider.settings, df.key)
+        if df.profiler is not None:
+            df.profiler.instrument_bloomfilter(df.bloomfilter)
+        return df
+
+    @classmethod
+    def from_spider_name(cls, server, settings, spider_name):
+        fingerprinter = cls.make_fingerprinter(settings)
+        key = fingerprinter.versioned_key(spider_name + ':dupefilter')
+        bloomfilter = cls.make_bloomfilter(server, settings, key)
+        return cls(server, key=key, fingerprinter=fingerprinter, bloomfilter=bloomfilter)
+
+    @classmethod
+    def make_fingerprinter(cls, settings):
+        # offsets and blocks are derived from hex fingerprints, the filter stores bits, not fingerprints
+        return RequestFingerprinter.from_settings(settings, raw=False)
+
+    @staticmethod
+    def make_bloomfilter(server, settings, key):
+        return BloomFilter.for_capacity(
+            server,
+            settings.getint('DUPEFILTER_BLOOM_EXPECTED_ITEMS', 10000000),
+            settings.getfloat('DUPEFILTER_BLOOM_FALSE_POSITIVE_RATE', 0.00001),
+            blocknum=settings.getint('DUPEFILTER_BLOOM_BLOCKNUM', 1),
+            key=key + ':bloom'
+        )
+
+    @classmethod
+    def fingerprint_writer(cls, server, settings, spider_name):
+        return BloomFingerprintWriter(
+            cls.make_bloomfilter(
+                server, settings, cls.make_fingerprinter(settings).versioned_key(spider_name + ':dupefilter')
+            ),
+            batch_size=settings.getint('FINGERPRINT_BATCH_SIZE', 100),
+            flush_interval=settings.getfloat('FINGERPRINT_FLUSH_INTERVAL', 1.0)
+        )
+
+    @classmethod
+    def migrate(cls, server, settings, spider_name, batch_size=10000, delete=False):
+        """
+        Stream the fingerprints of the Redis SET dupefilter into the bloom filter with SSCAN
+        :param server: Redis client instance
+        :param settings: Scrapy settings
+        :param spider_name: spider name
+        :param batch_size: fingerprints read and written per round trip
+        :param delete: UNLINK the SET after migration
+        :return: number of fingerprints migrated
+        """
+        key = cls.make_fingerprinter(settings).versioned_key(spider_name + ':dupefilter')
+        bloomfilter = cls.make_bloomfilter(server, settings, key)
+        count = 0
+        batch = []
+        for fp in server.sscan_iter(key, count=batch_size):
+            # raw version 2 fingerprints are 16 bytes, hex ones 32 or 40 characters
+            batch.append(fp.hex() if len(fp) == 16 else to_unicode(fp))
+            if len(batch) >= batch_size:
+                bloomfilter.check_and_insert(batch)
+                count += len(batch)
+                batch = []
+        if batch:
+            bloomfilter.check_and_insert(batch)
+            count += len(batch)
+        if delete:
+            server.unlink(key)
+        return count
+
+    def request_seen(self, request):
+        fp = self.fingerprinter(request)
+        if self.cache is not None and fp in self.cache:
+            return True
+
+        seen = self.bloomfilter.isContains(fp)
+        if seen and self.cache is not None:
+            self.cache.add(fp)
+        return seen
+
+    def requests_seen(self, requests):
+        fps = [self.fingerprinter(request) for request in requests]
+        seen = [self.cache is not None and fp in self.cache for fp in fps]
+        found = iter(self.bloomfilter.check_many([fp for fp, hit in zip(fps, seen) if not hit]))
+        for i, fp in enumerate(fps):
+            if not seen[i]:
+                seen[i] = next(found)
+                if seen[i] and self.cache is not None:
+                    self.cache.add(fp)
+        return seen
+
+    def clear(self):
+        self.server.delete(*[self.bloomfilter.key + str(i) for i in range(self.bloomfilter.blockNum)])
@@ -9,7 +9,7 @@ class Item(scrapy.Item, ABC):
     WorkBee Item
     """
 
-    # save the request of item
+    # save the request of item, ItemStampMiddleware replaces it by a stamp
     request = scrapy.Field()
 
     # return fingerprint of item
@@ -23,3 +23,18 @@ class Item(scrapy.Item, ABC):
     @abstractmethod
     def make_fingerprint(self):
         pass
+
+    def stamp(self, request_fp, dont_filter=False):
+        """
+        Keep the fingerprint of the item's request instead of the Request object, it is not a field
+        so it is neither stored nor exported
+        :param request_fp: request fingerprint computed by the dupefilter's fingerprinter
+        :param dont_filter: dont_filter of the request, its fingerprint is never committed
+        """
+        self._request_stamp = (request_fp, dont_filter)
+
+    def request_stamp(self):
+        """
+        return (request fingerprint, dont_filter) set by stamp, None if not stamped
+        """
+        return getattr(self, '_request_stamp', None)
@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import base64
+import decimal
+import logging
+import datetime
+import scrapy
+from scrapy.utils.misc import load_object
+
+logger = logging.getLogger(__name__)
+
+# tags of values JSON has no type for, a tagged value is an object with a single tag key
+TYPES = (
+    ('$bytes', bytes, lambda v: base64.b64encode(v).decode('ascii'), base64.b64decode),
+    ('$datetime', datetime.datetime, datetime.datetime.isoformat, datetime.datetime.fromisoformat),
+    ('$date', datetime.date, datetime.date.isoformat, datetime.date.fromisoformat),
+    ('$time', datetime.time, datetime.time.isoformat, datetime.time.fromisoformat),
+    ('$decimal', decimal.Decimal, str, decimal.Decimal),
+)
+DECODERS = dict((tag, decode) for tag, _, _, decode in TYPES)
+# a dict which would read as a tagged value is written as a list of pairs under this tag
+DICT_TAG = '$dict'
+
+
+def encode_value(value):
+    """
+    return value made of JSON types, other types tagged, unknown types as str
+    """
+    if value is None or isinstance(value, (str, bool, int, float)):
+        return value
+    if isinstance(value, dict):
+        if len(value) == 1 and (next(iter(value)) in DECODERS or next(iter(value)) == DICT_TAG):
+            return {DICT_TAG: [[encode_value(k), encode_value(v)] for k, v in value.items()]}
+        return dict((k, encode_value(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return [encode_value(v) for v in value]
+    # datetime before date, it is a subclass
+    for tag, cls, encode, _ in TYPES:
+        if isinstance(value, cls):
+            return {tag: encode(value)}
+    return str(value)
+
+
+def decode_value(value):
+    """
+    Reverse of encode_value
+    """
+    if isinstance(value, list):
+        return [decode_value(v) for v in value]
+    if not isinstance(value, dict):
+        return value
+    if len(value) == 1:
+        tag, data = next(iter(value.items()))
+        if tag in DECODERS:
+            return DECODERS[tag](data)
+        if tag == DICT_TAG:
+            return dict((decode_value(k), decode_value(v)) for k, v in data)
+    return dict((k, decode_value(v)) for k, v in value.items())
+
+
+def item_classes():
+    """
+    return dict of path to class of every loaded scrapy.Item subclass
+    """
+    classes = {}
+    pending = [scrapy.Item]
+    while pending:
+        cls = pending.pop()
+        classes['%s.%s' % (cls.__module__, cls.__name__)] = cls
+        pending.extend(cls.__subclasses__())
+    return classes
+
+
+class SpillJournal(object):
+    """
+    Append-only local journal of items which could not be written to Mysql yet.
+
+    Every item is one JSON line of its class path and fields. bytes, datetime, date, time and Decimal
+    values are tagged, so they are replayed with their own types. Replay only builds allowed item classes,
+    by default the loaded scrapy.Item subclasses, a journal never makes the crawler import or call
+    anything else. Lines which cannot be decoded are logged and skipped. Offsets are byte offsets,
+    the journal is read and written in binary mode.
+
+    Replay first renames the journal, so items spilled while replaying go to a new file, and reads
+    the renamed file in chunks. Only the offset of the last committed chunk is kept, after a crash
+    the unfinished file is replayed again from the start and items already written are filtered out
+    as duplicates.
+    """
+
+    def __init__(self, path, allowed=None):
+        """
+        :param path: journal file, the replayed part is kept next to it with suffix .replay
+        :param allowed: item classes replay may build, None for every loaded scrapy.Item subclass
+        """
+        self.path = path
+        self.allowed = dict(('%s.%s' % (cls.__module__, cls.__name__), cls) for cls in allowed or ())
+        self.allow_loaded = allowed is None
+        self.replay_path = path + '.replay'
+        self.offset = 0
+        self._next_offset = 0
+        self._file = None
+        self._reader = None
+
+    @classmethod
+    def from_settings(cls, settings, name):
+        """
+        return a journal in MYSQL_SPILL_DIR, None if spilling is disabled
+        :param name: journal file name without extension
+        """
+        directory = settings.get('MYSQL_SPILL_DIR')
+        if not directory:
+            return None
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        allowed = [load_object(path) for path in settings.getlist('MYSQL_SPILL_ITEM_CLASSES')] or None
+        return cls(os.path.join(directory, name + '.journal'), allowed)
+
+    @property
+    def replaying(self):
+        """
+        True if a rotated journal is waiting to be replayed
+        """
+        return os.path.exists(self.replay_path)
+
+    def append(self, item):
+        """
+        Write one item, flushed to the OS at once so a crash of the process does not lose it
+        """
+        if self._file is None:
+            self._file = open(self.path, 'ab')
+        path = '%s.%s' % (type(item).__module__, type(item).__name__)
+        # classes spilled by this process are replayed even if missing from an explicit allow-list
+        self.allowed.setdefault(path, type(item))
+        record = {'class': path, 'item': encode_value(dict(item))}
+        self._file.write(json.dumps(record, ensure_ascii=False).encode('utf-8') + b'\n')
+        self._file.flush()
+
+    def sync(self):
+        """
+        Flush appended items to disk
+        """
+        if self._file is not None:
+            os.fsync(self._file.fileno())
+
+    def rotate(self):
+        """
+        Move the journal aside for replay, unless an unfinished replay is left
+        :return: True if there is anything to replay
+        """
+        if self.replaying:
+            return True
+        if self._file is not None:
+            self.sync()
+            self._file.close()
+            self._file = None
+        if not os.path.exists(self.path) or not os.path.getsize(self.path):
+            return False
+        os.rename(self.path, self.replay_path)
+        self.offset = 0
+        return True
+
+    def read(self, size):
+        """
+        Read the next chunk of the replayed journal, it is consumed only by commit
+        :param size: max number of items
+        :return: list of items
+        """
+        if self._reader is None:
+            self._reader = open(self.replay_path, 'rb')
+        self._reader.seek(self.offset)
+        items = []
+        while len(items) < size:
+            start = self._reader.tell()
+            line = self._reader.readline()
+            if not line:
+                break
+            if not line.endswith(b'\n'):
+                # a record cut short by a crash
+                logger.warning('Skip truncated record at byte %d of %s', start, self.replay_path)
+                continue
+            try:
+                items.append(self._decode(line))
+            except Exception as e:
+                logger.error('Skip undecodable record at byte %d of %s: %r', start, self.replay_path, e)
+        self._next_offset = self._reader.tell()
+        return items
+
+    def _decode(self, line):
+        """
+        return the item of one journal line
+        :raise ValueError: if the line is malformed or its class is not allowed
+        """
+        record = json.loads(line.decode('utf-8'))
+        cls = self.allowed.get(record['class'])
+        if cls is None and self.allow_loaded:
+            self.allowed.update(item_classes())
+            cls = self.allowed.get(record['class'])
+        if cls is None:
+            raise ValueError('Item class %s is not allowed' % record['class'])
+        return cls(**decode_value(record['item']))
+
+    def commit(self):
+        """
+        Mark the last chunk read as written, the replayed journal is removed once fully consumed
+        """
+        self.offset = self._next_offset
+        if self.offset >= os.path.getsize(self.replay_path):
+            self._reader.close()
+            self._reader = None
+            os.remove(self.replay_path)
+            self.offset = 0
+
+    def close(self):
+        if self._file is not None:
+            self.sync()
+            self._file.close()
+            self._file = None
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
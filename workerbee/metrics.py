@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+
+import re
+import time
+import logging
+from io import BytesIO
+from urllib.parse import urlencode
+from twisted.internet import reactor, task
+from twisted.web import resource
+from twisted.web.client import Agent, FileBodyProducer, readBody
+from twisted.web.http_headers import Headers
+
+logger = logging.getLogger(__name__)
+
+# rate name to the stats counters it sums
+RATES = {
+    'pages': ('response_received_count',),
+    'items': ('item_scraped_count',),
+    'drops': ('item_dropped_count',),
+    'ignored': ('request_ignore_count',),
+    'errors': ('spider_error_count', 'item_error_count'),
+}
+
+
+class StatsSampler(object):
+    """
+    Periodic snapshots of Scrapy stats with the rates of the main counters since the previous snapshot
+    """
+
+    def __init__(self, stats):
+        """
+        :param stats: Scrapy stats collector
+        """
+        self.stats = stats
+        self.snapshot = None
+        self._last = None
+
+    def sample(self, now=None):
+        """
+        Take a snapshot
+        :return: dict of counter totals, '<rate>_per_second' rates and error_rate, the share of pages failing
+        """
+        now = time.time() if now is None else now
+        totals = dict((name, sum(self.stats.get_value(key, 0) or 0 for key in keys)) for name, keys in RATES.items())
+        snapshot = dict(('%s_total' % name, value) for name, value in totals.items())
+        if self._last is not None and now > self._last[0]:
+            elapsed = now - self._last[0]
+            for name, value in totals.items():
+                snapshot['%s_per_second' % name] = (value - self._last[1][name]) / elapsed
+            pages = totals['pages'] - self._last[1]['pages']
+            snapshot['error_rate'] = (totals['errors'] - self._last[1]['errors']) / pages if pages else 0.0
+        self._last = (now, totals)
+        snapshot['timestamp'] = now
+        self.snapshot = snapshot
+        return snapshot
+
+
+def metric_name(key):
+    """
+    return a Prometheus metric name for a stats key, e.g. downloader/response_count -> downloader_response_count
+    """
+    name = re.sub(r'[^a-zA-Z0-9_]', '_', key)
+    return '_' + name if name[0].isdigit() else name
+
+
+def prometheus_text(spider_name, snapshot, stats):
+    """
+    Render a snapshot and all numeric stats in the Prometheus text exposition format
+    :param spider_name: value of the spider label
+    :param snapshot: dict returned by StatsSampler.sample, None before the first one
+    :param stats: dict of Scrapy stats
+    """
+    label = '{spider="%s"}' % spider_name.replace('\\', '\\\\').replace('"', '\\"')
+    lines = []
+    for key, value in sorted((snapshot or {}).items()):
+        if key == 'timestamp':
+            continue
+        name = 'workerbee_' + key
+        lines.append('# TYPE %s %s' % (name, 'counter' if key.endswith('_total') else 'gauge'))
+        lines.append('%s%s %s' % (name, label, float(value)))
+    for key, value in sorted(stats.items()):
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            lines.append('scrapy_%s%s %s' % (metric_name(key), label, float(value)))
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsResource(resource.Resource):
+    """
+    twisted.web resource serving the metrics of a crawler in Prometheus text format
+    """
+
+    isLeaf = True
+
+    def __init__(self, render_text):
+        """
+        :param render_text: callable returning the current metrics text
+        """
+        resource.Resource.__init__(self)
+        self.render_text = render_text
+
+    def render_GET(self, request):
+        request.setHeader(b'Content-Type', b'text/plain; version=0.0.4; charset=utf-8')
+        return self.render_text().encode('utf-8')
+
+
+class FeedbackError(Exception):
+    """
+    The server answered a feedback with an error status
+    """
+
+    def __init__(self, status, retry):
+        super(FeedbackError, self).__init__('HTTP status %d' % status)
+        self.retry = retry
+
+
+class FeedbackClient(object):
+    """
+    Posts form encoded feedback with Twisted's HTTP client, so reporting never blocks the reactor.
+    Connection errors, timeouts and 5xx answers are retried after an exponential backoff.
+    """
+
+    def __init__(self, timeout=5, retries=3, backoff=1.0):
+        """
+        :param timeout: seconds one attempt may take
+        :param retries: attempts after the first one
+        :param backoff: seconds before the first retry, doubled for every next one
+        """
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.agent = Agent(reactor, connectTimeout=timeout)
+
+    def post(self, url, data):
+        """
+        :param url: feedback API
+        :param data: dict of form fields
+        :return: Deferred firing with True once posted, False if every attempt failed, it never errbacks
+        """
+        body = urlencode(data).encode('utf-8')
+        return self._attempt(url, body, 0)
+
+    def _attempt(self, url, body, attempt):
+        d = self.agent.request(
+            b'POST', url.encode('utf-8'),
+            Headers({b'Content-Type': [b'application/x-www-form-urlencoded']}),
+            FileBodyProducer(BytesIO(body))
+        )
+        d.addCallback(self._answered)
+        d.addTimeout(self.timeout, reactor)
+        d.addErrback(self._failed, url, body, attempt)
+        return d
+
+    @staticmethod
+    def _answered(response):
+        if response.code >= 400:
+            raise FeedbackError(response.code, retry=response.code >= 500)
+        # drain the body so the connection is released
+        return readBody(response).addCallback(lambda _: True)
+
+    def _failed(self, failure, url, body, attempt):
+        retry = not failure.check(FeedbackError) or failure.value.retry
+        if not retry or attempt >= self.retries:
+            logger.error('Failed to post feedback to %s: %s', url, failure.value)
+            return False
+        delay = self.backoff * 2 ** attempt
+        logger.warning('Failed to post feedback to %s: %s, retry in %.1fs', url, failure.value, delay)
+        return task.deferLater(reactor, delay, self._attempt, url, body, attempt + 1)
@@ -1,119 +1,685 @@
 # -*- coding: utf-8 -*-
 
+import json
+import math
+import time
+import asyncio
 import MySQLdb
+import MySQLdb.cursors
+import hashlib
 import logging
 from twisted.enterprise import adbapi
+from twisted.internet import defer, task, threads
+from twisted.python.failure import Failure
 from scrapy_redis import connection
-from scrapy.exceptions import DropItem
+from scrapy.exceptions import DropItem, NotConfigured
+from scrapy.settings import Settings
+from scrapy.utils.defer import deferred_to_future
+from scrapy.utils.python import to_bytes
+from scrapy.utils.reactor import is_asyncio_reactor_installed
 
-from workerbee.request import request_fingerprint
-from workerbee.filter import BloomFilter
+from workerbee.backends import RedisBackend
+from workerbee.cache import LRUCache
+from workerbee.journal import SpillJournal
+from workerbee.filter import bloomfilter_from_settings, BloomFilter, fingerprint_writer_from_settings
+from workerbee.profiling import Profiler, WRITER_STAGES
 
 logger = logging.getLogger(__name__)
 
+try:
+    import aiomysql
+    import pymysql
+    import redis.asyncio
+except ImportError:
+    aiomysql = None
+
+
+class UnchangedItem(DropItem):
+    """
+    Item dropped because the stored record has the same content
+    """
+
+
+def content_hash(item):
+    """
+    return an 8-byte digest of the item's content
+    """
+    data = json.dumps(dict(item), sort_keys=True, default=str, ensure_ascii=False)
+    return hashlib.blake2b(to_bytes(data), digest_size=8).digest()
+
+
+def connection_params(settings):
+    """
+    return MySQLdb connection arguments configured by settings
+    """
+    return {
+        'host': settings.get('MYSQL_HOST', 'localhost'),
+        'port': settings.getint('MYSQL_PORT', 3306),
+        'user': settings.get('MYSQL_USER', 'root'),
+        'passwd': settings.get('MYSQL_PASSWORD'),
+        'db': settings.get('MYSQL_DB'),
+        'charset': settings.get('MYSQL_CHARSET', 'utf8'),
+    }
+
 
 class MysqlPipeline(object):
     """
     Pushes serialized item into Mysql DB
     """
 
-    def __init__(self, redis_server, mysql_pool, table, upsert, blocknum):
+    def __init__(self, redis_server, mysql_pool, table, upsert, bloomfilter, batch_size=1, flush_interval=1.0,
+                 settings=None, skip_unchanged=False, spill_pending=1000, replay_interval=5.0,
+                 content_ttl=30 * 86400):
         """
         Initialize pipeline.
         :param redis_server: Redis client instance
         :param mysql_pool: Mysql connection pool
         :param table: Mysql table to save item
         :param upsert: True if use update or create to add data & avoid data filter
+        :param bloomfilter: filter of item fingerprints
+        :param batch_size: items written by one multi-row INSERT, 1 writes every item at once
+        :param flush_interval: max seconds an item waits in the buffer
+        :param settings: Scrapy settings, used to build the fingerprint writer when the spider opens
+        :param skip_unchanged: True if upsert only items whose content hash differs from the stored one
+        :param spill_pending: max items waiting for Mysql before new ones are spilled to the journal
+        :param replay_interval: seconds between attempts to write the journal back to Mysql
+        :param content_ttl: seconds a content hash is kept at most after it was saved, 0 keeps it forever
         """
+        self.stats = None
         self.redis_server = redis_server
-        self.bloomfilter = BloomFilter(redis_server, blocknum=blocknum)
+        self.bloomfilter = bloomfilter
         self.mysql_pool = mysql_pool
         self.table = table
         self.upsert = upsert
+        # a filter which forgets old values also limits how often upsert rewrites a record, otherwise upsert
+        # writes every item. Stored items are marked in the filter either way, it is shared with other spiders
+        # and bloom rebuild
+        self.use_filter = not upsert or getattr(bloomfilter, 'expires', False)
+        self.skip_unchanged = upsert and skip_unchanged
+        # content hashes of stored records, keyed by item fingerprint
+        self.content_key = '%s:content' % table
+        self.content_ttl = content_ttl
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.buffer = []
+        self.flushing = set()
+        self.writing = set()
+        self.flush_task = None
+        self.settings = settings if settings is not None else Settings()
+        self.fingerprint_writer = None
+        self.request_fingerprint = None
+        self._sql_templates = {}
+        # items are spilled to the journal when too many are waiting or the database is unreachable
+        self.journal = None
+        self.spill_pending = spill_pending
+        self.replay_interval = replay_interval
+        self.replay_task = None
+        self.replay_done = None
+        self.in_flight = 0
+        self.db_down = False
+        self.profiler = None
 
     @classmethod
     def from_settings(cls, settings):
+        redis_server = connection.from_settings(settings)
         params = {
-            'redis_server': connection.from_settings(settings),
-            'mysql_pool': adbapi.ConnectionPool(
-                'MySQLdb',
-                host=settings.get('MYSQL_HOST', 'localhost'),
-                port=settings.getint('MYSQL_PORT', 3306),
-                user=settings.get('MYSQL_USER', 'root'),
-                passwd=settings.get('MYSQL_PASSWORD'),
-                db=settings.get('MYSQL_DB'),
-                charset=settings.get('MYSQL_CHARSET', 'utf8'),
-            ),
+            'redis_server': redis_server,
+            'mysql_pool': adbapi.ConnectionPool('MySQLdb', **connection_params(settings)),
             'table': settings.get('MYSQL_TABLE'),
             'upsert': settings.getbool('MYSQL_UPSERT', False),
-            'blocknum': settings.getint('REDIS_BLOCKNUM', 2)
+            'bloomfilter': bloomfilter_from_settings(redis_server, settings, cache=LRUCache.from_settings(settings)),
+            'batch_size': settings.getint('MYSQL_BATCH_SIZE', 1),
+            'flush_interval': settings.getfloat('MYSQL_FLUSH_INTERVAL', 1.0),
+            'settings': settings,
+            'skip_unchanged': settings.getbool('MYSQL_UPSERT_SKIP_UNCHANGED', False),
+            'spill_pending': settings.getint('MYSQL_SPILL_MAX_PENDING', 1000),
+            'replay_interval': settings.getfloat('MYSQL_SPILL_REPLAY_INTERVAL', 5.0),
+            'content_ttl': settings.getfloat('MYSQL_CONTENT_HASH_TTL_DAYS', 30) * 86400,
         }
         return cls(**params)
 
     @classmethod
     def from_crawler(cls, crawler):
-        return cls.from_settings(crawler.settings)
+        pipeline = cls.from_settings(crawler.settings)
+        pipeline.stats = crawler.stats
+        profiler = pipeline.profiler = Profiler.from_crawler(crawler)
+        if profiler is not None:
+            profiler.instrument_bloomfilter(pipeline.bloomfilter)
+            profiler.instrument(pipeline, {'_generate_sql': 'sql/generate'})
+            pipeline._process_item = profiler.wrap_interaction(pipeline._process_item)
+            pipeline._process_batch = profiler.wrap_interaction(pipeline._process_batch)
+        return pipeline
+
+    @classmethod
+    def rebuild(cls, settings, item_cls, chunk_size=10000, local=False, progress=None):
+        """
+        Rebuild the bloom filter from the Mysql table, when its Redis keys were lost or resized.
+        Rows are streamed by a server-side cursor and fingerprints recomputed by item_cls.make_fingerprint
+        :param settings: Scrapy settings
+        :param item_cls: Item class stored in MYSQL_TABLE
+        :param chunk_size: rows fetched and inserted into the filter at once
+        :param local: True to build the bit arrays in memory and replace the Redis keys,
+                      only for a fixed size BloomFilter, else bits are added by pipelined BITFIELD batches
+        :param progress: optional callable, called with rows read so far and seconds elapsed after every chunk
+        :return: number of rows read
+        """
+        bloomfilter = bloomfilter_from_settings(connection.from_settings(settings), settings)
+        if local and type(bloomfilter) is not BloomFilter:
+            raise ValueError('Local rebuild only supports a fixed size bloom filter')
+        bitmaps = bloomfilter.bitmaps() if local else None
+
+        conn = MySQLdb.connect(cursorclass=MySQLdb.cursors.SSCursor, **connection_params(settings))
+        start = time.time()
+        count = 0
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT * FROM `{}`'.format(settings.get('MYSQL_TABLE')))
+            columns = [(n, column[0]) for n, column in enumerate(cursor.description) if column[0] in item_cls.fields]
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                fingerprints = []
+                for row in rows:
+                    item = item_cls(**{name: row[n] for n, name in columns})
+                    item.make_fingerprint()
+                    fingerprints.append(item.fingerprint())
+                if local:
+                    bloomfilter.set_local(bitmaps, fingerprints)
+                else:
+                    bloomfilter.check_and_insert(fingerprints)
+                count += len(rows)
+                if progress is not None:
+                    progress(count, time.time() - start)
+            cursor.close()
+        finally:
+            conn.close()
+        if local:
+            bloomfilter.write_local(bitmaps)
+        return count
+
+    def open_spider(self, spider):
+        self.fingerprint_writer = self._make_fingerprint_writer(spider)
+        self.fingerprint_writer.start()
+        if hasattr(self.bloomfilter, 'start'):
+            self.bloomfilter.start()
+        if self.batch_size > 1:
+            self.flush_task = task.LoopingCall(self._flush, spider)
+            self.flush_task.start(self.flush_interval, now=False)
+        self.journal = SpillJournal.from_settings(self.settings, '%s.%s' % (spider.name, self.table))
+        if self.journal is not None:
+            # the first run replays what a crashed crawl left behind
+            self.replay_task = task.LoopingCall(self._replay, spider)
+            self.replay_done = self.replay_task.start(self.replay_interval, now=True)
+            self.replay_done.addErrback(lambda failure: logger.error('Journal replay stopped: %s', failure.value))
+
+    def _make_fingerprint_writer(self, spider):
+        # the dupefilter decides how request fingerprints are computed and where they are committed
+        self.request_fingerprint, writer = fingerprint_writer_from_settings(
+            self.redis_server, self.settings, spider.name)
+        if self.profiler is not None:
+            self.request_fingerprint = self.profiler.wrap(self.request_fingerprint, 'request_fingerprint')
+            self.profiler.instrument(writer, WRITER_STAGES)
+        return writer
+
+    def _request_fp(self, item):
+        """
+        return the request fingerprint to commit once the item is stored, None if there is none
+        """
+        stamp = item.request_stamp() if hasattr(item, 'request_stamp') else None
+        if stamp is not None:
+            request_fp, dont_filter = stamp
+            return None if dont_filter else request_fp
+        # not stamped by ItemStampMiddleware, computed here so no Request is kept alive while the item waits
+        request = item.pop('request', None)
+        return self.request_fingerprint(request) if request and not request.dont_filter else None
 
     def process_item(self, item, spider):
-        return self.mysql_pool.runInteraction(self._process_item, item, spider)
+        request_fp = self._request_fp(item)
+        if self.journal is not None and (self.db_down or self.in_flight + len(self.buffer) >= self.spill_pending):
+            self._spill([item], [request_fp])
+            return item
+        if self.batch_size <= 1:
+            self.in_flight += 1
+            d = self.mysql_pool.runInteraction(self._process_item, item, spider)
+            d.addBoth(self._item_done, item, request_fp)
+            return d
+
+        d = defer.Deferred()
+        self.buffer.append((item, item.fingerprint(), request_fp, d))
+        if len(self.buffer) >= self.batch_size:
+            self._flush(spider)
+        return d
+
+    def _item_done(self, result, item, request_fp):
+        """
+        Commit the request fingerprint once the item is stored or known to exist
+        """
+        self.in_flight -= 1
+        if self._should_spill(result):
+            self._spill([item], [request_fp])
+            return item
+        if request_fp and (not isinstance(result, Failure) or result.check(DropItem)):
+            self.fingerprint_writer.add([request_fp])
+        if isinstance(result, Failure):
+            if result.check(UnchangedItem) and self.stats is not None:
+                self.stats.inc_value('item_unchanged_count')
+        else:
+            self._mark_stored([(result, result.fingerprint())])
+        return result
 
     def _process_item(self, tb, item, spider):
-        request = item.pop('request', None)
         item_fingerprint = item.fingerprint()
-        data_exist = True
-        if self.upsert or not self.bloomfilter.isContains(item_fingerprint):
-            sql, values = self._generate_sql(item)
-            try:
-                tb.execute(sql, values)
-            except MySQLdb.IntegrityError as e:
-                logger.debug(e)
-            else:
-                data_exist = False
-                self.bloomfilter.insert(item_fingerprint)
-        self._add_fingerprint(request, spider.name)
-        if data_exist:
-            raise DropItem
+        # the bits of a written item are set once its transaction committed, see _mark_stored, a concurrent
+        # duplicate is left to the unique key meanwhile and an item whose write fails stays unseen
+        if self.use_filter and self.bloomfilter.check_many([item_fingerprint])[0]:
+            raise DropItem('Duplicate item')
+        if self.skip_unchanged and self._content_hashes([item_fingerprint])[0] == content_hash(item):
+            raise UnchangedItem('Unchanged item')
+        sql, values = self._generate_sql(item)
+        try:
+            tb.execute(sql, values)
+        except MySQLdb.IntegrityError as e:
+            logger.debug(e)
+            # the record is stored already
+            self.bloomfilter.check_and_insert([item_fingerprint])
+            raise DropItem('Duplicate item')
         return item
 
-    def _generate_sql(self, data):
-        def columns(d):
-            return ', '.join(['`{}`'.format(k) for k in d])
-
-        def values(d):
-            return [v for v in d.values()]
-
-        def placeholders(d):
-            return ', '.join(['%s'] * len(d))
-
-        def on_duplicate_placeholders(d):
-            return ', '.join(['`{}` = %s'.format(k) for k in d])
-
-        if self.upsert:
-            sql_template = 'INSERT INTO `{}` ( {} ) VALUES ( {} ) ON DUPLICATE KEY UPDATE {}'
-            return (
-                sql_template.format(
-                    self.table,
-                    columns(data),
-                    placeholders(data),
-                    on_duplicate_placeholders(data)
-                ),
-                values(data) + values(data)
-            )
+    def _flush(self, spider):
+        """
+        Write buffered items in one interaction, then fire the Deferred of every item
+        """
+        if not self.buffer:
+            return
+        entries, self.buffer = self.buffer, []
+        self.in_flight += len(entries)
+        d = self.mysql_pool.runInteraction(self._process_batch, entries, spider)
+        self.flushing.add(d)
+        d.addBoth(self._batch_done, entries, d)
+
+    def _batch_done(self, result, entries, d):
+        self.flushing.discard(d)
+        self.in_flight -= len(entries)
+        if self._should_spill(result):
+            self._spill([entry[0] for entry in entries], [entry[2] for entry in entries])
+            for item, _, _, item_d in entries:
+                item_d.callback(item)
+            return
+        if not isinstance(result, Failure):
+            self.fingerprint_writer.add([entry[2] for entry in entries if entry[2]])
+            self._mark_stored([(item, fp) for (item, fp, _, _), error in zip(entries, result) if error is None])
+            if self.stats is not None:
+                self.stats.inc_value('item_unchanged_count', sum(isinstance(e, UnchangedItem) for e in result))
+        for n, (item, _, _, item_d) in enumerate(entries):
+            if isinstance(result, Failure):
+                item_d.errback(result)
+            elif result[n] is None:
+                item_d.callback(item)
+            else:
+                item_d.errback(Failure(result[n]))
+
+    def _process_batch(self, tb, entries, spider):
+        """
+        Filter and insert a batch of items, keeping per-item semantics of _process_item
+        :param entries: list of (item, item fingerprint, request fingerprint, Deferred)
+        :return: list of None for written items, DropItem for the others
+        """
+        result = [DropItem('Duplicate item')] * len(entries)
+        if not self.use_filter:
+            pending = list(range(len(entries)))
         else:
-            sql_template = 'INSERT INTO `{}` ( {} ) VALUES ( {} )'
-            return (
-                sql_template.format(
-                    self.table,
-                    columns(data),
-                    placeholders(data)
-                ),
-                values(data)
+            exist = self.bloomfilter.check_many([entry[1] for entry in entries])
+            pending = [n for n, found in enumerate(exist) if not found]
+        if self.skip_unchanged and pending:
+            stored = self._content_hashes([entries[n][1] for n in pending])
+            unchanged = set(n for n, old in zip(pending, stored) if old == content_hash(entries[n][0]))
+            for n in unchanged:
+                result[n] = UnchangedItem('Unchanged item')
+            pending = [n for n in pending if n not in unchanged]
+
+        # one multi-row statement per column set
+        groups = {}
+        for n in pending:
+            groups.setdefault(tuple(entries[n][0].keys()), []).append(n)
+        duplicated = []
+        for columns, indexes in groups.items():
+            rows = [[entries[n][0][k] for k in columns] for n in indexes]
+            try:
+                tb.executemany(self._sql_template(columns), rows)
+            except MySQLdb.IntegrityError:
+                # fall back to one statement per row to find out which ones are duplicated
+                sql = self._sql_template(columns, batch=False)
+                for n, row in zip(indexes, rows):
+                    try:
+                        tb.execute(sql, row + row if self.upsert else row)
+                    except MySQLdb.IntegrityError as e:
+                        logger.debug(e)
+                        duplicated.append(entries[n][1])
+                    else:
+                        result[n] = None
+            else:
+                for n in indexes:
+                    result[n] = None
+        # written items are marked once the transaction committed, like in _process_item
+        if duplicated:
+            self.bloomfilter.check_and_insert(duplicated)
+        return result
+
+    def _should_spill(self, result):
+        """
+        return True if the write failed because the database is unreachable and the items can be journaled
+        """
+        if self.journal is None or not isinstance(result, Failure) or not result.check(MySQLdb.OperationalError):
+            return False
+        if not self.db_down:
+            logger.warning('Mysql unavailable, spill items to %s: %s', self.journal.path, result.value)
+            self.db_down = True
+        return True
+
+    def _spill(self, items, request_fps):
+        """
+        Journal items instead of writing them, their request fingerprints are committed at once
+        """
+        for item in items:
+            self.journal.append(item)
+        self.fingerprint_writer.add([fp for fp in request_fps if fp])
+        if self.stats is not None:
+            self.stats.inc_value('mysql/spill/spilled', len(items))
+
+    def _replay(self, spider):
+        """
+        Write the journal back to Mysql in batches, stops at the first chunk the database cannot take
+        """
+        self.journal.sync()
+        if not self.journal.rotate():
+            self.db_down = False
+            return
+        return self._replay_chunk(None, spider)
+
+    def _replay_chunk(self, _, spider):
+        if not self.journal.replaying:
+            # look for items spilled meanwhile
+            return self._replay(spider)
+        items = self.journal.read(max(self.batch_size, 100))
+        if not items:
+            self.journal.commit()
+            return self._replay(spider)
+        entries = [(item, item.fingerprint(), None, None) for item in items]
+        d = self.mysql_pool.runInteraction(self._process_batch, entries, spider)
+        d.addCallbacks(self._replay_done, self._replay_failed, callbackArgs=(entries, spider),
+                       errbackArgs=(entries, spider))
+        return d
+
+    def _replay_done(self, result, entries, spider):
+        self.journal.commit()
+        self._mark_stored([(item, fp) for (item, fp, _, _), error in zip(entries, result) if error is None])
+        if self.stats is not None:
+            self.stats.inc_value('mysql/spill/replayed', len(entries))
+            self.stats.inc_value('item_unchanged_count', sum(isinstance(e, UnchangedItem) for e in result))
+        return self._replay_chunk(None, spider)
+
+    def _replay_failed(self, failure, entries, spider):
+        if failure.check(MySQLdb.OperationalError):
+            self.db_down = True
+            logger.debug('Mysql still unavailable, retry replay in %.1fs: %s', self.replay_interval, failure.value)
+            return
+        # the chunk would fail again on every replay, skip it like a failed item
+        logger.error('Failed to replay %d items from %s: %s', len(entries), self.journal.replay_path, failure.value)
+        self.journal.commit()
+        if self.stats is not None:
+            self.stats.inc_value('mysql/spill/failed', len(entries))
+        return self._replay_chunk(None, spider)
+
+    def _sql_template(self, columns, batch=True):
+        """
+        return the cached INSERT statement of a column set
+        :param columns: tuple of column names
+        :param batch: True for executemany, the upsert form then takes new values from VALUES()
+        """
+        template = self._sql_templates.get((columns, batch))
+        if template is None:
+            template = 'INSERT INTO `{}` ( {} ) VALUES ( {} )'.format(
+                self.table,
+                ', '.join(['`{}`'.format(k) for k in columns]),
+                ', '.join(['%s'] * len(columns))
             )
+            if self.upsert and batch:
+                template += ' ON DUPLICATE KEY UPDATE ' + ', '.join(
+                    ['`{0}` = VALUES(`{0}`)'.format(k) for k in columns])
+            elif self.upsert:
+                template += ' ON DUPLICATE KEY UPDATE ' + ', '.join(['`{}` = %s'.format(k) for k in columns])
+            self._sql_templates[(columns, batch)] = template
+        return template
+
+    def _generate_sql(self, data):
+        values = [v for v in data.values()]
+        sql = self._sql_template(tuple(data.keys()), batch=False)
+        return sql, values + values if self.upsert else values
+
+    def _mark_stored(self, entries):
+        """
+        Set the filter bits and save the content hashes of stored records in a worker thread, after their
+        transaction committed
+        :param entries: list of (item, item fingerprint)
+        """
+        if entries:
+            d = threads.deferToThread(self._write_marks, entries)
+            self.writing.add(d)
+            d.addErrback(lambda failure: logger.error('Failed to mark stored items: %s', failure.value))
+            d.addBoth(lambda _: self.writing.discard(d))
+
+    def _write_marks(self, entries):
+        self.bloomfilter.check_and_insert([fp for _, fp in entries])
+        if self.skip_unchanged:
+            pipe = self.redis_server.pipeline(transaction=False)
+            self._queue_content_save(pipe, {fp: content_hash(item) for item, fp in entries})
+            pipe.execute()
+
+    def _content_keys(self):
+        """
+        With a TTL content hashes are saved in generations of half the TTL, each expired by Redis one generation
+        after the next one started, a hash is found for at least half the TTL and at most the TTL
+        :return: keys to look up, the one to save to first, and its expiry as a Unix time or None
+        """
+        if not self.content_ttl:
+            return [self.content_key], None
+        window = self.content_ttl / 2
+        generation = int(time.time() // window)
+        keys = ['%s:%d' % (self.content_key, generation), '%s:%d' % (self.content_key, generation - 1)]
+        return keys, int(math.ceil((generation + 2) * window))
+
+    def _queue_content_lookup(self, pipe, fingerprints):
+        for key in self._content_keys()[0]:
+            pipe.hmget(key, fingerprints)
 
-    def _add_fingerprint(self, request, spider_name):
-        if request and not request.dont_filter:
-            fp = request_fingerprint(request)
-            self.redis_server.sadd(spider_name + ':dupefilter', fp)
+    def _queue_content_save(self, pipe, mapping):
+        keys, expire_at = self._content_keys()
+        pipe.hset(keys[0], mapping=mapping)
+        if expire_at is not None:
+            pipe.expireat(keys[0], expire_at)
+
+    @staticmethod
+    def _newest_hashes(replies):
+        """
+        :param replies: HMGET replies queued by _queue_content_lookup
+        :return: the newest content hash of every fingerprint, None if there is none
+        """
+        return [next((h for h in hashes if h is not None), None) for hashes in zip(*replies)]
+
+    def _content_hashes(self, fingerprints):
+        pipe = self.redis_server.pipeline(transaction=False)
+        self._queue_content_lookup(pipe, fingerprints)
+        return self._newest_hashes(pipe.execute())
 
     def close_spider(self, spider):
+        if self.flush_task is not None and self.flush_task.running:
+            self.flush_task.stop()
+        self._flush(spider)
+        d = defer.DeferredList(list(self.flushing))
+        if self.replay_task is not None:
+            # a last replay writes what was spilled while the spider ran
+            if self.replay_task.running:
+                self.replay_task.stop()
+            d.addBoth(lambda _: self.replay_done)
+            d.addBoth(lambda _: self._replay(spider))
+        d.addBoth(lambda _: defer.DeferredList(list(self.writing)))
+        d.addBoth(lambda _: self.fingerprint_writer.close())
+        d.addBoth(self._close, spider)
+        return d
+
+    def _close(self, result, spider):
+        if self.stats is not None and self.bloomfilter.cache is not None:
+            self.bloomfilter.cache.publish(self.stats, 'l1cache/bloomfilter')
+        if self.journal is not None:
+            self.journal.close()
+        if hasattr(self.bloomfilter, 'close'):
+            self.bloomfilter.close()
+        self.mysql_pool.close()
+        return result
+
+
+class AsyncMysqlPipeline(MysqlPipeline):
+    """
+    Pushes serialized item into Mysql DB with aiomysql and redis.asyncio, needs the asyncio reactor:
+    TWISTED_REACTOR = 'twisted.internet.asyncioreactor.AsyncioSelectorReactor'
+
+    Items are written one by one with the semantics of MysqlPipeline, at most max_in_flight at once
+    over a pool of pool_size connections, no thread is involved except for the fingerprint writer.
+    Buffered writes and the spill journal are not supported.
+    """
+
+    def __init__(self, redis_server, table, upsert, bloomfilter, settings=None, skip_unchanged=False, pool_size=10,
+                 max_in_flight=100, redis_settings=None, content_ttl=30 * 86400):
+        """
+        :param pool_size: max number of Mysql connections
+        :param max_in_flight: max number of items written at once, more wait in process_item
+        :param redis_settings: settings of the redis.asyncio client, see async_redis_settings
+        """
+        super(AsyncMysqlPipeline, self).__init__(redis_server, None, table, upsert, bloomfilter, settings=settings,
+                                                 skip_unchanged=skip_unchanged, content_ttl=content_ttl)
+        self.pool_size = pool_size
+        self.max_in_flight = max_in_flight
+        self.redis_settings = redis_settings
+        self.client = None
+        self.semaphore = None
+
+    @classmethod
+    def from_settings(cls, settings):
+        if aiomysql is None:
+            raise NotConfigured('AsyncMysqlPipeline requires aiomysql')
+        redis_server = connection.from_settings(settings)
+        params = {
+            'redis_server': redis_server,
+            'table': settings.get('MYSQL_TABLE'),
+            'upsert': settings.getbool('MYSQL_UPSERT', False),
+            'bloomfilter': bloomfilter_from_settings(redis_server, settings, cache=LRUCache.from_settings(settings)),
+            'settings': settings,
+            'skip_unchanged': settings.getbool('MYSQL_UPSERT_SKIP_UNCHANGED', False),
+            'pool_size': settings.getint('MYSQL_POOL_SIZE', 10),
+            'max_in_flight': settings.getint('MYSQL_MAX_IN_FLIGHT', 100),
+            'redis_settings': cls.async_redis_settings(settings),
+            'content_ttl': settings.getfloat('MYSQL_CONTENT_HASH_TTL_DAYS', 30) * 86400,
+        }
+        return cls(**params)
+
+    @staticmethod
+    def async_redis_settings(settings):
+        """
+        return settings making scrapy-redis build a redis.asyncio client with the same connection settings.
+        REDIS_PARAMS is overridden at its own priority, a project setting of a higher priority would win otherwise.
+        """
+        redis_settings = Settings(settings)
+        redis_settings.set('REDIS_PARAMS', dict(settings.getdict('REDIS_PARAMS'), redis_cls=redis.asyncio.Redis),
+                           priority=settings.getpriority('REDIS_PARAMS') or 'project')
+        return redis_settings
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not is_asyncio_reactor_installed():
+            raise NotConfigured('AsyncMysqlPipeline requires the asyncio reactor')
+        return super(AsyncMysqlPipeline, cls).from_crawler(crawler)
+
+    async def open_spider(self, spider):
+        self.fingerprint_writer = self._make_fingerprint_writer(spider)
+        self.fingerprint_writer.start()
+        if hasattr(self.bloomfilter, 'start'):
+            self.bloomfilter.start()
+        params = connection_params(self.settings)
+        params['password'] = params.pop('passwd') or ''
+        self.mysql_pool = await aiomysql.create_pool(minsize=1, maxsize=self.pool_size, **params)
+        if self.redis_settings is None:
+            self.redis_settings = self.async_redis_settings(self.settings)
+        self.client = connection.get_redis_from_settings(self.redis_settings)
+        self.semaphore = asyncio.Semaphore(self.max_in_flight)
+
+    async def process_item(self, item, spider):
+        request_fp = self._request_fp(item)
+        async with self.semaphore:
+            try:
+                await self._process_item_async(item)
+            except DropItem as e:
+                if request_fp:
+                    self.fingerprint_writer.add([request_fp])
+                if isinstance(e, UnchangedItem) and self.stats is not None:
+                    self.stats.inc_value('item_unchanged_count')
+                raise
+            if request_fp:
+                self.fingerprint_writer.add([request_fp])
+            if self.skip_unchanged:
+                pipe = self.client.pipeline(transaction=False)
+                self._queue_content_save(pipe, {item.fingerprint(): content_hash(item)})
+                await pipe.execute()
+        return item
+
+    async def _process_item_async(self, item):
+        item_fingerprint = item.fingerprint()
+        if self.use_filter and (await self._check_many([item_fingerprint]))[0]:
+            raise DropItem('Duplicate item')
+        if self.skip_unchanged:
+            pipe = self.client.pipeline(transaction=False)
+            self._queue_content_lookup(pipe, [item_fingerprint])
+            if self._newest_hashes(await pipe.execute())[0] == content_hash(item):
+                raise UnchangedItem('Unchanged item')
+        sql, values = self._generate_sql(item)
+        try:
+            async with self.mysql_pool.acquire() as conn:
+                try:
+                    async with conn.cursor() as cursor:
+                        await cursor.execute(sql, values)
+                    await conn.commit()
+                except BaseException:
+                    await conn.rollback()
+                    raise
+        except pymysql.IntegrityError as e:
+            logger.debug(e)
+            await self._check_and_insert([item_fingerprint])
+            raise DropItem('Duplicate item')
+        # committed, a write which failed above left the filter untouched
+        await self._check_and_insert([item_fingerprint])
+
+    def _native(self):
+        """
+        return True if the filter can run on the asyncio client, other filters and backends have none
+        """
+        return type(self.bloomfilter) is BloomFilter and type(self.bloomfilter.backend) is RedisBackend
+
+    async def _check_many(self, values):
+        if self._native():
+            return await self.bloomfilter.acheck_many(self.client, values)
+        return await asyncio.get_running_loop().run_in_executor(None, self.bloomfilter.check_many, values)
+
+    async def _check_and_insert(self, values):
+        if self._native():
+            return await self.bloomfilter.acheck_and_insert(self.client, values)
+        return await asyncio.get_running_loop().run_in_executor(None, self.bloomfilter.check_and_insert, values)
+
+    async def close_spider(self, spider):
+        await deferred_to_future(self.fingerprint_writer.close())
+        if self.stats is not None and self.bloomfilter.cache is not None:
+            self.bloomfilter.cache.publish(self.stats, 'l1cache/bloomfilter')
+        if hasattr(self.bloomfilter, 'close'):
+            self.bloomfilter.close()
         self.mysql_pool.close()
+        await self.mysql_pool.wait_closed()
+        await self.client.aclose()
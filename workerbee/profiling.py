@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+
+import time
+import logging
+import threading
+from collections import deque
+from scrapy import signals
+
+logger = logging.getLogger(__name__)
+
+# method name to stage name of every instrumented component
+BLOOM_STAGES = {
+    'isContains': 'bloom/isContains',
+    'insert': 'bloom/insert',
+    'check_many': 'bloom/check_many',
+    'check_and_insert': 'bloom/check_and_insert',
+}
+HASH_STAGES = {
+    'offsets_many': 'bloom/hash',
+}
+DUPEFILTER_STAGES = {
+    'request_seen': 'dupefilter/request_seen',
+    'requests_seen': 'dupefilter/requests_seen',
+}
+WRITER_STAGES = {
+    'write': 'fingerprint/commit',
+}
+PERCENTILES = (50, 90, 99)
+
+
+class Stage(object):
+    """
+    Call count, total time and the latest latencies of one stage
+    """
+
+    def __init__(self, samples):
+        """
+        :param samples: latencies kept for percentiles
+        """
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.latencies = deque(maxlen=samples)
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        with self._lock:
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+            self.latencies.append(seconds)
+
+    def percentiles(self):
+        """
+        return dict of percentile to seconds over the kept latencies, empty before the first call
+        """
+        with self._lock:
+            latencies = sorted(self.latencies)
+        if not latencies:
+            return {}
+        return dict((p, latencies[min(len(latencies) - 1, len(latencies) * p // 100)]) for p in PERCENTILES)
+
+
+class Profiler(object):
+    """
+    Latency of hot path stages: request fingerprints, bloom filter hashing and round trips, SQL generation
+    and execution, fingerprint commits and dupefilter checks.
+
+    Nothing is patched while profiling is disabled. Enabled, the methods of instrumented objects are replaced
+    by timed wrappers on the instance only, stages left out of WORKERBEE_PROFILE_STAGES keep their own methods.
+    """
+
+    def __init__(self, stages=None, samples=10000):
+        """
+        :param stages: stage names or prefixes to time, e.g. ['bloom', 'sql/execute'], None for all
+        :param samples: latest latencies of each stage kept for percentiles
+        """
+        self.stages = frozenset(stages) if stages is not None else None
+        self.samples = samples
+        self.timings = {}
+        self.stats = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls, settings):
+        """
+        return a profiler configured by WORKERBEE_PROFILE_STAGES, None if disabled
+        """
+        value = settings.get('WORKERBEE_PROFILE_STAGES')
+        if not value:
+            return None
+        if value is True or value in ('1', 'True', 'true', 'all'):
+            stages = None
+        else:
+            stages = settings.getlist('WORKERBEE_PROFILE_STAGES')
+        return cls(stages, samples=settings.getint('WORKERBEE_PROFILE_SAMPLES', 10000))
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        """
+        return the profiler shared by every component of a crawler, None if disabled
+        """
+        if crawler is None:
+            return None
+        if not hasattr(crawler, 'workerbee_profiler'):
+            profiler = crawler.workerbee_profiler = cls.from_settings(crawler.settings)
+            if profiler is not None:
+                crawler.signals.connect(profiler.spider_closed, signal=signals.spider_closed)
+                profiler.stats = crawler.stats
+        return crawler.workerbee_profiler
+
+    def spider_closed(self, spider):
+        self.publish(self.stats)
+
+    def enabled(self, stage):
+        return self.stages is None or stage in self.stages or stage.split('/')[0] in self.stages
+
+    def stage(self, name):
+        timing = self.timings.get(name)
+        if timing is None:
+            with self._lock:
+                timing = self.timings.setdefault(name, Stage(self.samples))
+        return timing
+
+    def wrap(self, func, stage):
+        """
+        return func timed as stage, func itself if the stage is disabled
+        """
+        if func is None or not self.enabled(stage):
+            return func
+        record = self.stage(stage).record
+        clock = time.perf_counter
+
+        def timed(*args, **kwargs):
+            start = clock()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                record(clock() - start)
+
+        return timed
+
+    def instrument(self, obj, stages):
+        """
+        Replace methods of obj by timed wrappers
+        :param obj: instance to instrument, None is ignored
+        :param stages: dict of method name to stage name, missing methods are skipped
+        :return: obj
+        """
+        if obj is None:
+            return obj
+        for method, stage in stages.items():
+            func = getattr(obj, method, None)
+            if func is not None and self.enabled(stage):
+                setattr(obj, method, self.wrap(func, stage))
+        return obj
+
+    def instrument_bloomfilter(self, bloomfilter):
+        self.instrument(bloomfilter, BLOOM_STAGES)
+        self.instrument(getattr(bloomfilter, 'hasher', None), HASH_STAGES)
+        return bloomfilter
+
+    def wrap_interaction(self, func):
+        """
+        return a runInteraction function whose transaction times execute and executemany as sql stages
+        """
+        if not self.enabled('sql/execute') and not self.enabled('sql/executemany'):
+            return func
+
+        def interaction(tb, *args, **kwargs):
+            return func(TimedTransaction(tb, self), *args, **kwargs)
+
+        return interaction
+
+    def publish(self, stats, prefix='profile'):
+        """
+        Report call counts, mean, max and percentile latencies in milliseconds to Scrapy stats
+        :param stats: Scrapy stats collector
+        :param prefix: stats key prefix
+        """
+        for name, timing in list(self.timings.items()):
+            if not timing.count:
+                continue
+            key = '%s/%s' % (prefix, name)
+            stats.set_value(key + '/count', timing.count)
+            stats.set_value(key + '/mean_ms', round(timing.total / timing.count * 1000, 3))
+            stats.set_value(key + '/max_ms', round(timing.max * 1000, 3))
+            for p, seconds in timing.percentiles().items():
+                stats.set_value('%s/p%d_ms' % (key, p), round(seconds * 1000, 3))
+
+    def summary(self):
+        """
+        return one log line per stage, slowest total time first
+        """
+        lines = []
+        for name, timing in sorted(self.timings.items(), key=lambda entry: -entry[1].total):
+            if not timing.count:
+                continue
+            percentiles = timing.percentiles()
+            lines.append('Stage %s: %d calls, %.1fs total, p50 %.3fms, p90 %.3fms, p99 %.3fms, max %.3fms' % (
+                name, timing.count, timing.total, percentiles[50] * 1000, percentiles[90] * 1000,
+                percentiles[99] * 1000, timing.max * 1000
+            ))
+        return lines
+
+
+class TimedTransaction(object):
+    """
+    Proxy of an adbapi transaction timing execute and executemany
+    """
+
+    def __init__(self, tb, profiler):
+        self._tb = tb
+        self.execute = profiler.wrap(tb.execute, 'sql/execute')
+        self.executemany = profiler.wrap(tb.executemany, 'sql/executemany')
+
+    def __getattr__(self, name):
+        return getattr(self._tb, name)
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import zlib
+import sqlite3
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class RenderCache(object):
+    """
+    On-disk cache of rendered pages keyed by request fingerprint, in a SQLite database.
+
+    Pages are stored zlib compressed. Every entry expires after its own TTL, and when the compressed
+    size of all entries exceeds max_size the least recently read entries are evicted.
+    Thread safe, SeleniumChromeMiddleware uses it from worker threads.
+    """
+
+    def __init__(self, path, ttl=86400, max_size=1 << 30):
+        """
+        :param path: SQLite database file, its directory is created if missing
+        :param ttl: default seconds an entry stays valid, 0 for no expiry
+        :param max_size: max compressed bytes of all entries, 0 for no limit
+        """
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evicted = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS pages ('
+                         'fp TEXT PRIMARY KEY, url TEXT NOT NULL, body BLOB NOT NULL, '
+                         'expires REAL NOT NULL, accessed REAL NOT NULL, size INTEGER NOT NULL)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS pages_accessed ON pages (accessed)')
+        self.size = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM pages').fetchone()[0]
+
+    @classmethod
+    def from_settings(cls, settings, name='render'):
+        """
+        return a cache in RENDER_CACHE_DIR, None if disabled
+        :param name: database file name without extension
+        """
+        directory = settings.get('RENDER_CACHE_DIR')
+        if not directory:
+            return None
+        return cls(os.path.join(directory, name + '.sqlite'),
+                   ttl=settings.getint('RENDER_CACHE_TTL', 86400),
+                   max_size=settings.getint('RENDER_CACHE_MAX_SIZE', 1 << 30))
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM pages').fetchone()[0]
+
+    def get(self, fp):
+        """
+        :param fp: request fingerprint
+        :return: (url, html) of a valid entry, None if missing or expired
+        """
+        now = time.time()
+        with self._lock:
+            row = self._db.execute('SELECT url, body, expires, size FROM pages WHERE fp = ?', (fp,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            url, body, expires, size = row
+            if expires and expires <= now:
+                self._db.execute('DELETE FROM pages WHERE fp = ?', (fp,))
+                self.size -= size
+                self.expired += 1
+                self.misses += 1
+                return None
+            self._db.execute('UPDATE pages SET accessed = ? WHERE fp = ?', (now, fp))
+            self.hits += 1
+        return url, zlib.decompress(body).decode('utf-8')
+
+    def set(self, fp, url, html, ttl=None):
+        """
+        Store a rendered page, replacing the previous entry of fp
+        :param fp: request fingerprint
+        :param url: URL of the page after redirects
+        :param html: rendered DOM
+        :param ttl: seconds the entry stays valid, default self.ttl, 0 for no expiry
+        """
+        ttl = self.ttl if ttl is None else ttl
+        body = zlib.compress(html.encode('utf-8'))
+        now = time.time()
+        with self._lock:
+            self._db.execute('BEGIN')
+            try:
+                old = self._db.execute('SELECT size FROM pages WHERE fp = ?', (fp,)).fetchone()
+                self._db.execute('INSERT OR REPLACE INTO pages (fp, url, body, expires, accessed, size) '
+                                 'VALUES (?, ?, ?, ?, ?, ?)',
+                                 (fp, url, body, now + ttl if ttl else 0, now, len(body)))
+                size = self.size - (old[0] if old else 0) + len(body)
+                if self.max_size and size > self.max_size:
+                    size -= self._evict(size - self.max_size, fp)
+                self._db.execute('COMMIT')
+            except Exception:
+                self._db.execute('ROLLBACK')
+                raise
+            self.size = size
+
+    def _evict(self, excess, keep):
+        """
+        Delete the least recently read entries until excess bytes are freed, never the entry just written
+        :return: bytes freed
+        """
+        freed, victims = 0, []
+        cursor = self._db.execute('SELECT fp, size FROM pages WHERE fp != ? ORDER BY accessed', (keep,))
+        for fp, size in cursor:
+            if freed >= excess:
+                break
+            victims.append((fp,))
+            freed += size
+        cursor.close()
+        self._db.executemany('DELETE FROM pages WHERE fp = ?', victims)
+        self.evicted += len(victims)
+        return freed
+
+    def delete(self, fp):
+        with self._lock:
+            row = self._db.execute('SELECT size FROM pages WHERE fp = ?', (fp,)).fetchone()
+            if row is not None:
+                self._db.execute('DELETE FROM pages WHERE fp = ?', (fp,))
+                self.size -= row[0]
+
+    def publish(self, stats, prefix='rendercache'):
+        """
+        Report cache counters to Scrapy stats
+        :param stats: Scrapy stats collector
+        :param prefix: stats key prefix
+        """
+        stats.set_value(prefix + '/hits', self.hits)
+        stats.set_value(prefix + '/misses', self.misses)
+        stats.set_value(prefix + '/expired', self.expired)
+        stats.set_value(prefix + '/evicted', self.evicted)
+        stats.set_value(prefix + '/size', self.size)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
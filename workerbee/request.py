@@ -1,11 +1,35 @@
 # -*- coding: utf-8 -*-
 
+import re
 import weakref
 import hashlib
+from urllib.parse import unquote_to_bytes
 from scrapy.utils.python import to_bytes
+from w3lib.url import canonicalize_url as w3lib_canonicalize_url
 
 _fingerprint_cache = weakref.WeakKeyDictionary()
 
+# query parameters which only track the visitor, stripped by canonicalize_url
+TRACKING_PARAMS = frozenset((
+    'utm_source', 'utm_medium', 'utm_campaign', 'utm_term', 'utm_content', 'utm_id',
+    'gclid', 'dclid', 'fbclid', 'msclkid', 'yclid', 'mc_cid', 'mc_eid', '_ga', '_gl', 'spm',
+))
+
+DEFAULT_PORTS = {'http': ':80', 'https': ':443'}
+
+# URLs w3lib's canonicalize_url leaves as they are apart from case, order and empty parameters: no userinfo,
+# no character it would escape, no percent-escape but upper case ones of non-ASCII bytes, which Scrapy makes,
+# and every query parameter a name=value pair. Runs of characters between escapes, an alternation per character
+# backtracks several times slower
+_ESCAPE = '%[89A-F][0-9A-F]'
+_PATH_CHARS = r"[A-Za-z0-9!$&'()*+,\-./:;=@\[\]_|~]*"
+_QUERY_CHARS = r'[A-Za-z0-9+\-._~]*(?:%s[A-Za-z0-9+\-._~]*)*' % _ESCAPE
+_SIMPLE_URL = re.compile(
+    r'([A-Za-z][A-Za-z0-9+.\-]*)://([A-Za-z0-9.\-]+)(:[1-9][0-9]*)?'
+    r'(/%s(?:%s%s)*)?' % (_PATH_CHARS, _ESCAPE, _PATH_CHARS) +
+    r'(?:\?&*((?:%s=%s(?:&+%s=%s)*)?)&*)?' % ((_QUERY_CHARS,) * 4)
+)
+
 
 def request_fingerprint(request, include_headers=None):
     """
@@ -30,3 +54,127 @@ def request_fingerprint(request, include_headers=None):
                         fp.update(v)
         cache[include_headers] = fp.hexdigest()
     return cache[include_headers]
+
+
+def canonicalize_url(url, strip_params=TRACKING_PARAMS):
+    """
+    Canonical URL of w3lib's canonicalize_url (lower case scheme and host, IDNA host, no fragment,
+    query parameters sorted with blank values kept, percent-escapes normalized), without default port
+    and tracking parameters.
+    URLs w3lib would not escape are canonicalized with string operations, the others by w3lib.
+    :param url: absolute URL
+    :param strip_params: names of query parameters to remove
+    :return: canonical URL
+    """
+    if '#' in url:
+        url = url.partition('#')[0]
+    match = _SIMPLE_URL.fullmatch(url)
+    if match is None:
+        return _strip(w3lib_canonicalize_url(url), strip_params)
+    scheme, host, port, path, query = match.groups()
+    scheme = scheme.lower()
+    if port == DEFAULT_PORTS.get(scheme):
+        port = None
+    url = scheme + '://' + host.lower() + (port or '') + (path or '/')
+    if query:
+        # sort by name then value like w3lib, '=' sorts before any character of a name
+        params = query.replace('=', '\0').split('&')
+        if '' in params:
+            params = [p for p in params if p]
+        if strip_params:
+            params = [p for p in params if p[:p.index('\0')] not in strip_params]
+        if params:
+            # w3lib compares decoded bytes, escapes sort after any character
+            params.sort(key=unquote_to_bytes if '%' in query else None)
+            url += '?' + '&'.join(params).replace('\0', '=')
+    return url
+
+
+def _strip(url, strip_params):
+    """
+    Remove the default port and tracking parameters from a URL canonicalized by w3lib
+    """
+    url, _, query = url.partition('?')
+    start = url.find('://')
+    if start >= 0:
+        end = url.find('/', start + 3)
+        port = DEFAULT_PORTS.get(url[:start])
+        if port and end > 0 and url.endswith(port, 0, end):
+            url = url[:end - len(port)] + url[end:]
+    if query:
+        params = [p for p in query.split('&') if p.partition('=')[0] not in strip_params]
+        if params:
+            url += '?' + '&'.join(params)
+    return url
+
+
+def request_fingerprint_v2(request, include_headers=None, strip_params=TRACKING_PARAMS):
+    """
+    Fingerprint of the canonical request, a 16-byte blake2b digest
+    :param request: scrapy.Request
+    :param include_headers: http header, default none
+    :param strip_params: query parameters ignored, see canonicalize_url
+    :return: 16 bytes
+    """
+    if include_headers:
+        include_headers = tuple(to_bytes(h.lower()) for h in sorted(include_headers))
+    cache_key = (2, include_headers, strip_params)
+    cache = _fingerprint_cache.setdefault(request, {})
+    if cache_key not in cache:
+        url = canonicalize_url(request.url, strip_params)
+        fp = hashlib.blake2b(
+            b'\0'.join((request.method.encode('ascii'), url.encode('utf-8'), request.body or b'')), digest_size=16
+        )
+        if include_headers:
+            for hdr in include_headers:
+                if hdr in request.headers:
+                    fp.update(b'\0' + hdr + b':')
+                    fp.update(b','.join(request.headers.getlist(hdr)))
+        cache[cache_key] = fp.digest()
+    return cache[cache_key]
+
+
+class RequestFingerprinter(object):
+    """
+    Request fingerprint of a configured version.
+
+    Version 1 is the 40-character SHA1 hex string of request_fingerprint. Version 2 hashes the canonical URL
+    with blake2b into 16 bytes, returned as a 32-character hex string or, for compact storage, as raw bytes.
+    Every version keeps its fingerprints under its own Redis key, see versioned_key.
+    """
+
+    def __init__(self, version=1, strip_params=TRACKING_PARAMS, raw=False):
+        """
+        :param version: 1 or 2
+        :param strip_params: names of query parameters ignored by version 2
+        :param raw: version 2 returns bytes instead of hex
+        """
+        if version not in (1, 2):
+            raise ValueError('Unknown fingerprint version: %s' % version)
+        self.version = version
+        self.strip_params = frozenset(strip_params)
+        self.raw = raw and version == 2
+
+    @classmethod
+    def from_settings(cls, settings, raw=None):
+        """
+        :param raw: override FINGERPRINT_RAW, False for consumers which need hex fingerprints
+        """
+        strip_params = settings.getlist('FINGERPRINT_STRIP_PARAMS', TRACKING_PARAMS)
+        return cls(
+            version=settings.getint('FINGERPRINT_VERSION', 1),
+            strip_params=strip_params,
+            raw=settings.getbool('FINGERPRINT_RAW', False) if raw is None else raw
+        )
+
+    def __call__(self, request):
+        if self.version == 1:
+            return request_fingerprint(request)
+        fp = request_fingerprint_v2(request, strip_params=self.strip_params)
+        return fp if self.raw else fp.hex()
+
+    def versioned_key(self, key):
+        """
+        return the Redis key of this version's fingerprints, version 1 keeps the original key
+        """
+        return key if self.version == 1 else '%s:v%d' % (key, self.version)
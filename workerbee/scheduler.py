@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+import time
+import logging
+from scrapy import signals
+from scrapy_redis.scheduler import Scheduler
+from twisted.internet import defer, reactor, threads
+
+logger = logging.getLogger(__name__)
+
+
+class BatchScheduler(Scheduler):
+    """
+    Scrapy-Redis scheduler checking requests against the dupefilter in batches.
+
+    Requests enqueued in the same reactor tick are checked with one request_seen round trip
+    and pushed into the queue in a worker thread, so a slow Redis never blocks the reactor.
+    The dupefilter must provide requests_seen, like RFPDupeFilterAlter and BloomDupeFilter.
+    """
+
+    def __init__(self, server, max_batch_size=1000, **kwargs):
+        """
+        :param max_batch_size: max requests checked by one round trip
+        """
+        super(BatchScheduler, self).__init__(server, **kwargs)
+        self.max_batch_size = max_batch_size
+        self.crawler = None
+        self.pending = []
+        self.in_flight = 0
+        self.flushing = set()
+        self.flush_call = None
+
+    @classmethod
+    def from_settings(cls, settings):
+        scheduler = super(BatchScheduler, cls).from_settings(settings)
+        scheduler.max_batch_size = settings.getint('SCHEDULER_BATCH_SIZE', 1000)
+        return scheduler
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        scheduler = super(BatchScheduler, cls).from_crawler(crawler)
+        scheduler.crawler = crawler
+        return scheduler
+
+    def __len__(self):
+        return len(self.queue) + len(self.pending) + self.in_flight
+
+    def enqueue_request(self, request):
+        self.pending.append(request)
+        if len(self.pending) >= self.max_batch_size:
+            self._flush()
+        elif self.flush_call is None:
+            self.flush_call = reactor.callLater(0, self._flush)
+        return True
+
+    def _flush(self):
+        if self.flush_call is not None and self.flush_call.active():
+            self.flush_call.cancel()
+        self.flush_call = None
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, []
+        self.in_flight += len(batch)
+        d = threads.deferToThread(self._check_and_push, batch)
+        self.flushing.add(d)
+        d.addCallback(self._batch_done, batch)
+        d.addErrback(self._batch_failed, batch)
+        d.addBoth(self._release, batch, d)
+
+    def _check_and_push(self, batch):
+        """
+        Run in a worker thread
+        :return: list of bool, True if request was already seen, and the latency of the check
+        """
+        start = time.time()
+        filtered = [not request.dont_filter for request in batch]
+        seen = iter(self.df.requests_seen([r for r, f in zip(batch, filtered) if f]))
+        result = [f and next(seen) for f in filtered]
+        latency = time.time() - start
+        for request, request_seen in zip(batch, result):
+            if not request_seen:
+                self.queue.push(request)
+        return result, latency
+
+    def _batch_done(self, outcome, batch):
+        result, latency = outcome
+        for request, request_seen in zip(batch, result):
+            if request_seen:
+                self.df.log(request, self.spider)
+                if self.crawler is not None:
+                    self.crawler.signals.send_catch_log(signals.request_dropped, request=request, spider=self.spider)
+        if self.stats:
+            enqueued = result.count(False)
+            self.stats.inc_value('scheduler/enqueued/redis', enqueued)
+            self.stats.inc_value('dupefilter/batch/count')
+            self.stats.inc_value('dupefilter/batch/requests', len(batch))
+            self.stats.max_value('dupefilter/batch/max_size', len(batch))
+            self.stats.inc_value('dupefilter/batch/latency_ms', int(latency * 1000))
+            self.stats.max_value('dupefilter/batch/max_latency_ms', int(latency * 1000))
+
+    def _batch_failed(self, failure, batch):
+        logger.error('Failed to schedule %d requests: %s', len(batch), failure.value, extra={'spider': self.spider})
+
+    def _release(self, _, batch, d):
+        self.in_flight -= len(batch)
+        self.flushing.discard(d)
+
+    def close(self, reason):
+        self._flush()
+        d = defer.DeferredList(list(self.flushing))
+        d.addCallback(lambda _: super(BatchScheduler, self).close(reason))
+        return d
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+
+import time
+import logging
+from scrapy import Request
+from scrapy.utils.misc import load_object
+
+logger = logging.getLogger(__name__)
+
+
+def read_urls(path):
+    """
+    Yield URLs of a file, one per line, blank lines and lines starting with # are skipped
+    """
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                yield line
+
+
+class Seeder(object):
+    """
+    Streams start URLs into the Redis queue of a RedisSpider.
+
+    URLs are read in chunks, checked against the dupefilter with one batched membership check per chunk
+    and pushed with one pipelined command per chunk. Pushing pauses while the queue holds more than
+    max_queue URLs, so seeding millions of URLs does not make Redis memory spike.
+    URLs Scrapy cannot make a Request of are logged, counted as invalid and left out.
+    """
+
+    def __init__(self, server, redis_key, dupefilter=None, chunk_size=1000, max_queue=0, wait=1.0, command='lpush'):
+        """
+        :param server: Redis client instance
+        :param redis_key: start URL key of the spider
+        :param dupefilter: filter with requests_seen, None pushes every URL
+        :param chunk_size: URLs checked and pushed at once
+        :param max_queue: max length of the queue before pushing pauses, 0 for no limit
+        :param wait: seconds between two checks of the queue length
+        :param command: lpush, rpush or sadd when REDIS_START_URLS_AS_SET
+        """
+        self.server = server
+        self.redis_key = redis_key
+        self.dupefilter = dupefilter
+        self.chunk_size = chunk_size
+        self.max_queue = max_queue
+        self.wait = wait
+        self.command = command
+        self.stopped = False
+
+    @classmethod
+    def from_settings(cls, server, settings, spider_name, redis_key):
+        dupefilter_cls = load_object(settings.get('DUPEFILTER_CLASS') or 'workerbee.filter.RFPDupeFilterAlter')
+        dupefilter = None
+        if hasattr(dupefilter_cls, 'from_spider_name') and hasattr(dupefilter_cls, 'requests_seen'):
+            dupefilter = dupefilter_cls.from_spider_name(server, settings, spider_name)
+        if settings.getbool('REDIS_START_URLS_AS_SET'):
+            command = 'sadd'
+        else:
+            command = 'rpush' if settings.getbool('SEED_RPUSH', False) else 'lpush'
+        return cls(
+            server, redis_key, dupefilter,
+            chunk_size=settings.getint('SEED_CHUNK_SIZE', 1000),
+            max_queue=settings.getint('SEED_MAX_QUEUE', 0),
+            wait=settings.getfloat('SEED_WAIT', 1.0),
+            command=command
+        )
+
+    def seed(self, urls):
+        """
+        Blocks while the queue is full, run it in its own thread from the reactor
+        :param urls: iterable of URLs
+        :return: number of URLs pushed, skipped and invalid
+        """
+        pushed = skipped = invalid = 0
+        chunk = []
+        for url in urls:
+            if self.stopped:
+                return pushed, skipped, invalid
+            chunk.append(url)
+            if len(chunk) >= self.chunk_size:
+                count, bad = self._push(chunk)
+                pushed, skipped, invalid = pushed + count, skipped + len(chunk) - count - bad, invalid + bad
+                chunk = []
+        if chunk and not self.stopped:
+            count, bad = self._push(chunk)
+            pushed, skipped, invalid = pushed + count, skipped + len(chunk) - count - bad, invalid + bad
+        return pushed, skipped, invalid
+
+    def _requests(self, urls):
+        """
+        return (URL, Request) of the valid URLs, one bad line does not stop seeding
+        """
+        valid = []
+        for url in urls:
+            try:
+                valid.append((url, Request(url)))
+            except (ValueError, TypeError) as e:
+                logger.warning('Skip invalid start URL %r: %s', url, e)
+        return valid
+
+    def _push(self, chunk):
+        """
+        :return: number of URLs pushed and invalid
+        """
+        # repeated URLs of one chunk are pushed once, the others count as skipped
+        urls = list(dict.fromkeys(chunk))
+        valid = self._requests(urls)
+        invalid = 0
+        if len(valid) < len(urls):
+            good = set(url for url, _ in valid)
+            invalid = sum(1 for url in chunk if url not in good)
+        if self.dupefilter is not None:
+            seen = self.dupefilter.requests_seen([request for _, request in valid])
+            valid = [entry for entry, url_seen in zip(valid, seen) if not url_seen]
+        urls = [url for url, _ in valid]
+        if not urls:
+            return 0, invalid
+        self._wait_for_room()
+        if self.stopped:
+            return 0, invalid
+        pipe = self.server.pipeline(transaction=False)
+        for i in range(0, len(urls), 100):
+            getattr(pipe, self.command)(self.redis_key, *urls[i:i + 100])
+        pipe.execute()
+        return len(urls), invalid
+
+    def _wait_for_room(self):
+        if not self.max_queue:
+            return
+        length = self.server.scard if self.command == 'sadd' else self.server.llen
+        while not self.stopped and length(self.redis_key) >= self.max_queue:
+            time.sleep(self.wait)
+
+    def stop(self):
+        """
+        Make a running seed return after the current chunk
+        """
+        self.stopped = True
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+import logging
+from scrapy import signals, Request
+from scrapy.exceptions import NotConfigured
+from scrapy_redis import connection
+
+from workerbee.filter import FailureCounter, fingerprinter_from_settings, fingerprint_writer_from_settings
+from workerbee.items import Item
+
+logger = logging.getLogger(__name__)
+
+
+class FingerprintCommitMiddleware(object):
+    """
+    Commits request fingerprints of responses whose callback yields no item.
+
+    MysqlPipeline only commits the fingerprints of requests with stored items, so listing pages and empty
+    results are downloaded again by every crawl. Commits go through the FingerprintWriter of the dupefilter.
+    Policies of FINGERPRINT_COMMIT_POLICY:
+        'success'   commit when the callback finished without error
+        'failures'  also commit requests whose callback failed FINGERPRINT_COMMIT_MAX_FAILURES times,
+                    failures are counted across crawls
+        'never'     disabled
+    Requests with dont_filter or meta commit_fingerprint=False are never committed.
+    """
+
+    POLICIES = ('success', 'failures', 'never')
+
+    def __init__(self, crawler, policy='success', max_failures=3):
+        """
+        :param policy: 'success' or 'failures'
+        :param max_failures: failures before a request is committed by policy 'failures'
+        """
+        self.crawler = crawler
+        self.settings = crawler.settings
+        self.stats = crawler.stats
+        self.policy = policy
+        self.max_failures = max_failures
+        self.request_fingerprint = None
+        self.writer = None
+        self.counter = None
+        crawler.signals.connect(self.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(self.spider_closed, signal=signals.spider_closed)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        policy = crawler.settings.get('FINGERPRINT_COMMIT_POLICY', 'success')
+        if policy not in cls.POLICIES:
+            raise ValueError('Unknown fingerprint commit policy: %s' % policy)
+        if policy == 'never':
+            raise NotConfigured
+        return cls(crawler, policy, crawler.settings.getint('FINGERPRINT_COMMIT_MAX_FAILURES', 3))
+
+    def spider_opened(self, spider):
+        server = connection.from_settings(self.settings)
+        self.request_fingerprint, self.writer = fingerprint_writer_from_settings(server, self.settings, spider.name)
+        self.writer.start()
+        if self.policy == 'failures':
+            key = self.request_fingerprint.versioned_key(spider.name + ':dupefilter') + ':failures'
+            self.counter = FailureCounter(server, key, self.writer, self.max_failures,
+                                          batch_size=self.settings.getint('FINGERPRINT_BATCH_SIZE', 100),
+                                          flush_interval=self.settings.getfloat('FINGERPRINT_FLUSH_INTERVAL', 1.0))
+            self.counter.start()
+
+    def spider_closed(self, spider):
+        d = self.counter.close() if self.counter is not None else None
+        if d is None:
+            return self.writer.close()
+        d.addBoth(lambda _: self.writer.close())
+        return d
+
+    def _fingerprint(self, response):
+        request = response.request
+        if request is None or request.dont_filter or not request.meta.get('commit_fingerprint', True):
+            return None
+        return self.request_fingerprint(request)
+
+    def process_spider_output(self, response, result, spider):
+        items = 0
+        for output in result:
+            if not isinstance(output, Request):
+                items += 1
+            yield output
+        self._finished(response, items)
+
+    async def process_spider_output_async(self, response, result, spider):
+        items = 0
+        async for output in result:
+            if not isinstance(output, Request):
+                items += 1
+            yield output
+        self._finished(response, items)
+
+    def _finished(self, response, items):
+        # reached only when the callback finished without error, items are committed by the pipeline
+        if items:
+            return
+        fp = self._fingerprint(response)
+        if fp:
+            self.writer.add([fp])
+            self.stats.inc_value('fingerprint/committed/empty')
+
+    def process_spider_exception(self, response, exception, spider):
+        if self.counter is None:
+            return None
+        fp = self._fingerprint(response)
+        if fp:
+            self.counter.add([fp])
+            self.stats.inc_value('fingerprint/failures')
+        return None
+
+
+class ItemStampMiddleware(object):
+    """
+    Stamps WorkerBee items with the fingerprint and dont_filter flag of their request, so items waiting
+    in the pipelines do not keep Request objects with their meta, headers and body alive.
+
+    A request saved in item['request'] is replaced by its stamp, other items are stamped with the request
+    of the response they come from.
+    """
+
+    def __init__(self, settings):
+        self.request_fingerprint = fingerprinter_from_settings(settings)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler.settings)
+
+    def process_spider_output(self, response, result, spider):
+        for output in result:
+            yield self._stamp(output, response)
+
+    async def process_spider_output_async(self, response, result, spider):
+        async for output in result:
+            yield self._stamp(output, response)
+
+    def _stamp(self, output, response):
+        if isinstance(output, Item) and output.request_stamp() is None:
+            request = output.pop('request', None) or response.request
+            if request is not None:
+                fp = None if request.dont_filter else self.request_fingerprint(request)
+                output.stamp(fp, request.dont_filter)
+        return output